@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Usage: analyze_dumps.py DUMPS_DIR GAMES_CSV [PROCESSES]
+#
+# Replay every dump (as written by dump_game.py) found in DUMPS_DIR,
+# write one row of metrics per game to GAMES_CSV ('-' for standard
+# output) and print aggregate tables on standard error. Games are
+# replayed in memory, so the database is never touched and dumps can
+# be processed in parallel.
+
+import sys
+import os
+import csv
+import json
+import traceback
+from collections import defaultdict
+from multiprocessing import Pool
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "lupus.settings")
+
+import django
+django.setup()
+
+from game.dynamics import Dynamics
+from game.events import PowerOutcomeEvent, TallyAnnouncedEvent
+from game.constants import *
+from game.utils import ratio, print_table
+
+GAME_FIELDS = ['dump', 'ruleset', 'players', 'turns', 'last_turn', 'over', 'winners', 'survivors',
+               'power_uses', 'power_successes', 'stake_votes', 'mean_stake_margin']
+
+def vote_margins(dynamics):
+    """Difference between the two most voted players in each stake
+    vote of the game."""
+    tallies = defaultdict(list)
+    for event in dynamics.events:
+        if isinstance(event, TallyAnnouncedEvent) and event.type == VOTE:
+            tallies[event.turn.pk].append(event.vote_num)
+    margins = []
+    for votes in tallies.values():
+        votes.sort(reverse=True)
+        margins.append(votes[0] - (votes[1] if len(votes) > 1 else 0))
+    return margins
+
+def analyze_dump(path):
+    try:
+        with open(path) as fin:
+            dynamics = Dynamics.from_dump(json.load(fin))
+    except Exception:
+        return path, None, traceback.format_exc()
+
+    # Roles can change during the game, so we take the final ones
+    roles = [(player.role.as_string(), player.alive) for player in dynamics.players if player.role is not None]
+    powers = [(event.power.as_string(), event.success) for event in dynamics.events if isinstance(event, PowerOutcomeEvent)]
+    margins = vote_margins(dynamics)
+
+    row = {
+        'dump': os.path.basename(path),
+        'ruleset': getattr(dynamics, 'ruleset', ''),
+        'players': len(dynamics.players),
+        'turns': len(dynamics.turns),
+        'last_turn': repr(dynamics.current_turn) if dynamics.current_turn is not None else None,
+        'over': dynamics.over,
+        'winners': ' '.join(sorted(dynamics.winners)) if dynamics.winners is not None else '',
+        'survivors': len(dynamics.get_alive_players()),
+        'power_uses': len(powers),
+        'power_successes': len([success for _, success in powers if success]),
+        'stake_votes': len(margins),
+        'mean_stake_margin': '%.2f' % (sum(margins) / len(margins)) if margins else '',
+    }
+    details = {
+        # The teams dealt at the beginning: playing_teams only keeps
+        # the ones still alive
+        'teams': sorted(set(role_class.team for role_class in dynamics.available_roles)),
+        'roles': roles,
+        'powers': powers,
+        'margins': margins,
+    }
+    return path, (row, details), None
+
+def main():
+    dumps_dir = sys.argv[1]
+    csv_path = sys.argv[2]
+    processes = int(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    paths = sorted(os.path.join(dumps_dir, name) for name in os.listdir(dumps_dir) if name.endswith('.json'))
+
+    fout = sys.stdout if csv_path == '-' else open(csv_path, 'w', newline='')
+    writer = csv.DictWriter(fout, fieldnames=GAME_FIELDS)
+    writer.writeheader()
+
+    games = defaultdict(int)
+    wins = defaultdict(int)
+    roles = defaultdict(lambda: [0, 0])
+    powers = defaultdict(lambda: [0, 0])
+    margins = defaultdict(list)
+    failed = 0
+
+    with Pool(processes) as pool:
+        for path, result, error in pool.imap_unordered(analyze_dump, paths, chunksize=4):
+            if result is None:
+                failed += 1
+                print('Could not replay %s:\n%s' % (path, error), file=sys.stderr)
+                continue
+            row, details = result
+            writer.writerow(row)
+
+            ruleset = row['ruleset']
+            if row['over']:
+                for team in details['teams']:
+                    games[ruleset, team] += 1
+                for team in row['winners'].split():
+                    wins[ruleset, team] += 1
+            for role, alive in details['roles']:
+                roles[role][0] += 1
+                roles[role][1] += alive
+            for power, success in details['powers']:
+                powers[power][0] += 1
+                powers[power][1] += success
+            margins[ruleset] += details['margins']
+
+    if fout is not sys.stdout:
+        fout.close()
+
+    print('Analyzed %d dumps (%d could not be replayed)' % (len(paths) - failed, failed), file=sys.stderr)
+    print_table('Win rates of finished games', ['ruleset', 'team', 'games', 'wins', 'rate'],
+                [(ruleset, team, n, wins[ruleset, team], ratio(wins[ruleset, team], n)) for (ruleset, team), n in sorted(games.items())], file=sys.stderr)
+    print_table('Role survival', ['role', 'players', 'survivors', 'rate'],
+                [(role, n, alive, ratio(alive, n)) for role, (n, alive) in sorted(roles.items())], file=sys.stderr)
+    print_table('Power outcomes', ['power', 'uses', 'successes', 'rate'],
+                [(power, n, success, ratio(success, n)) for power, (n, success) in sorted(powers.items())], file=sys.stderr)
+    print_table('Stake vote margins', ['ruleset', 'votes', 'mean', 'min', 'max'],
+                [(ruleset, len(values), ratio(sum(values), len(values)), min(values), max(values)) for ruleset, values in sorted(margins.items()) if values], file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -14,10 +14,12 @@ from game.models import *
 from game.tests import *
 
 def main():
-    for event in Event.objects.all():
-        event = event.as_child()
-        if event.AUTOMATIC:
-            event.delete()
+    # With 'regenerate' the dynamics are rebuilt right away, instead
+    # of at the first request
+    regenerate = 'regenerate' in sys.argv[1:]
+    for game in Game.objects.all():
+        deleted = game.recompute_automatic_events(regenerate=regenerate)
+        print("%s: %d automatic events deleted" % (game.name, deleted))
 
 if __name__ == '__main__':
     main()
@@ -3,6 +3,7 @@
 
 import sys
 import os
+import gzip
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "lupus.settings")
 
@@ -13,8 +14,13 @@ from game.models import *
 
 def main():
     game = Game.get_running_game()
-    dump_game(game, sys.stdout)
-    print >> sys.stdout
+    if 'compact' in sys.argv[1:]:
+        # Compact JSON, gzipped
+        with gzip.open(sys.stdout.buffer, 'wt', encoding='utf-8') as fout:
+            dump_game(game, fout, compact=True)
+    else:
+        dump_game(game, sys.stdout)
+        print(file=sys.stdout)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Usage: estimate_outcomes.py GAME_NAME [RUNS] [PROCESSES] [SEED]
+#
+# Simulate the end of the current turn of game GAME_NAME RUNS times
+# (1000 by default), each time with a different state of the random
+# generator, and print how often each outcome happens. The game is
+# replayed in memory, so the database is only read once; the time
+# taken also measures the speed of the dynamics.
+
+import sys
+import os
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "lupus.settings")
+
+import django
+django.setup()
+
+from game.models import Game
+from game.simulation import get_simulation_data, estimate_outcomes, SIMULATION_WORKERS
+from game.utils import ratio, print_table
+
+def main():
+    game = Game.objects.get(name=sys.argv[1])
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    processes = int(sys.argv[3]) if len(sys.argv) > 3 else SIMULATION_WORKERS
+    seed = int(sys.argv[4]) if len(sys.argv) > 4 else None
+
+    data, end = get_simulation_data(game)
+    frequencies, seconds = estimate_outcomes(data, end, runs, seed=seed, workers=processes)
+
+    print('Simulated %d times the end of %r in %.2f s (%.1f runs per second)' % (runs, game.current_turn, seconds, runs / seconds if seconds > 0 else 0.0))
+    print_table('Deaths', ['player', 'runs', 'rate'],
+                [(username, n, ratio(n, runs)) for username, n in frequencies['dead'].most_common()])
+    print_table('Mayor', ['player', 'runs', 'rate'],
+                [(username, n, ratio(n, runs)) for username, n in frequencies['mayor'].most_common()])
+    print_table('Powers', ['player', 'uses', 'successes', 'rate'],
+                [(username, n, frequencies['powers'][username], ratio(frequencies['powers'][username], n)) for username, n in sorted(frequencies['powers_used'].items())])
+    if frequencies['winners']:
+        print_table('Winners', ['teams', 'runs', 'rate'],
+                    [(teams, n, ratio(n, runs)) for teams, n in frequencies['winners'].most_common()])
+
+if __name__ == '__main__':
+    main()
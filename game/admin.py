@@ -1,4 +1,5 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
 from django.contrib.auth.admin import UserAdmin
 from django.db import models
 from django.utils.html import format_html
@@ -22,6 +23,37 @@ class UserAdmin(UserAdmin):
 admin.site.unregister(User)
 admin.site.register(User, UserAdmin)
 
+class SnapshotChangeList(ChangeList):
+    def get_results(self, request):
+        super().get_results(request)
+        self.model_admin.attach_snapshots(self.result_list)
+
+class SnapshotAdmin(admin.ModelAdmin):
+    """Admin whose columns computed by the dynamics are read from the
+    snapshot of each game, fetched once per page instead of once per
+    cell (see attach_snapshots())."""
+
+    def get_changelist(self, request, **kwargs):
+        return SnapshotChangeList
+
+    def get_game(self, obj):
+        raise NotImplementedError()
+
+    def attach_snapshots(self, objs):
+        snapshots = {}
+        for obj in objs:
+            game = self.get_game(obj)
+            if game.pk not in snapshots:
+                dynamics = game.get_dynamics()
+                snapshots[game.pk] = dynamics.snapshot if dynamics is not None else None
+            obj.admin_snapshot = snapshots[game.pk]
+
+    def get_snapshot_player(self, obj, player):
+        snapshot = getattr(obj, 'admin_snapshot', None)
+        if snapshot is None or player is None:
+            return None
+        return snapshot.players_dict.get(player.pk)
+
 class GameAdmin(admin.ModelAdmin):
     list_display = ('name', 'title', 'current_turn', 'public', 'postgame_info')
     list_display_link = ('current_turn',)
@@ -35,8 +67,62 @@ class TurnAdmin(admin.ModelAdmin):
     list_display = ('as_string', 'game', 'begin', 'end', 'is_current')
     list_filter = ['game']
 
-class PlayerAdmin(admin.ModelAdmin):
+class PlayerAdmin(SnapshotAdmin):
+    def get_game(self, obj):
+        return obj.game
+
+    def team(self, obj):
+        canonical = self.get_snapshot_player(obj, obj)
+        return Player.TEAMS_DICT[canonical.team] if canonical is not None else None
+
+    def role_name(self, obj):
+        canonical = self.get_snapshot_player(obj, obj)
+        if canonical is None:
+            return None
+        return canonical.role.__class__.__name__ if canonical.role is not None else "Unassigned"
+
+    def aura(self, obj):
+        canonical = self.get_snapshot_player(obj, obj)
+        return Player.AURA_COLORS_DICT[canonical.aura] if canonical is not None else None
+
+    def is_mystic(self, obj):
+        canonical = self.get_snapshot_player(obj, obj)
+        return canonical.is_mystic if canonical is not None else None
+    is_mystic.boolean = True
+
+    def alive(self, obj):
+        canonical = self.get_snapshot_player(obj, obj)
+        return canonical.alive if canonical is not None else None
+    alive.boolean = True
+
+    def active(self, obj):
+        canonical = self.get_snapshot_player(obj, obj)
+        return canonical.active if canonical is not None else None
+    active.boolean = True
+
+    # The snapshot answers the same questions of the dynamics
+    def can_use_power(self, obj):
+        canonical = self.get_snapshot_player(obj, obj)
+        return canonical.can_use_power(obj.admin_snapshot, obj.admin_snapshot.current_turn) if canonical is not None else None
+    can_use_power.boolean = True
+
+    def can_vote(self, obj):
+        canonical = self.get_snapshot_player(obj, obj)
+        return canonical.can_vote(obj.admin_snapshot, obj.admin_snapshot.current_turn) if canonical is not None else None
+    can_vote.boolean = True
+
+    def is_mayor(self, obj):
+        canonical = self.get_snapshot_player(obj, obj)
+        return canonical.is_mayor(obj.admin_snapshot) if canonical is not None else None
+    is_mayor.boolean = True
+
+    def is_appointed_mayor(self, obj):
+        canonical = self.get_snapshot_player(obj, obj)
+        return canonical.is_appointed_mayor(obj.admin_snapshot) if canonical is not None else None
+    is_appointed_mayor.boolean = True
+
     list_display = ('full_name', 'game', 'gender', 'team', 'role_name', 'aura', 'is_mystic', 'alive', 'active', 'can_use_power', 'can_vote', 'is_mayor', 'is_appointed_mayor')
+    list_select_related = ('user', 'user__profile', 'game')
     search_fields = ['user__first_name', 'user__last_name']
     list_filter = ['game']
 
@@ -60,10 +146,28 @@ class EventAdmin(admin.ModelAdmin):
 
     list_filter = ['turn__game', 'turn']
     list_display = ('link_to_subclass', 'turn', 'is_automatic', 'timestamp', 'pk')
+    list_select_related = ('turn',)
+
+class CommandEventAdmin(SnapshotAdmin):
+    def get_game(self, obj):
+        return obj.turn.game
+
+    def get_role_name(self, obj, player):
+        canonical = self.get_snapshot_player(obj, player)
+        return canonical.role.name if canonical is not None else None
+
+    def player_role(self, obj):
+        return self.get_role_name(obj, obj.player)
+
+    def target_role(self, obj):
+        return self.get_role_name(obj, obj.target)
+
+    def target2_role(self, obj):
+        return self.get_role_name(obj, obj.target2)
 
-class CommandEventAdmin(admin.ModelAdmin):
     list_filter = ['type', 'turn__game', 'turn']
     list_display = ('event_name', 'turn', 'timestamp', 'player', 'player_role', 'type', 'target', 'target_role', 'target2', 'target2_role', 'role_class', 'multiple_role_class')
+    list_select_related = ('turn__game', 'player__user', 'target__user', 'target2__user')
     search_fields = ['player__user__first_name', 'player__user__last_name']
 
 @admin.register(SeedEvent)
@@ -142,10 +246,23 @@ class PageRequestAdmin(admin.ModelAdmin):
 class ForceVictoryEventAdmin(admin.ModelAdmin):
     list_display = ('winners', )
 
+class PlayerStatusAdmin(admin.ModelAdmin):
+    # Written by the dynamics, only to be looked at
+    list_filter = ['turn__game', 'alive', 'active', 'team']
+    list_display = ('turn', 'player', 'alive', 'active', 'role', 'team', 'aura', 'mayor', 'appointed_mayor')
+    list_select_related = ('turn', 'player__user')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
 admin.site.register(Player, PlayerAdmin)
 admin.site.register(Event, EventAdmin)
 admin.site.register(Game, GameAdmin)
 admin.site.register(Turn, TurnAdmin)
+admin.site.register(PlayerStatus, PlayerStatusAdmin)
 admin.site.register(Announcement, AnnouncementAdmin)
 admin.site.register(Comment, CommentAdmin)
 
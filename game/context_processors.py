@@ -1,4 +1,3 @@
-from .models import Game, Announcement
 from .constants import *
 from .utils import get_now
 
@@ -10,6 +9,7 @@ def context_player_and_game(request):
     return {
         'player': player,
         'game': game,
+        'snapshot': request.snapshot,
         'master': request.master,
         'is_master': request.is_master
     }
@@ -49,14 +49,8 @@ def context_constants(request):
     }
 
 def context_latest_announcement(request):
-    game = request.game
-
     return {
-        'latest_announcement': Announcement.objects
-            .filter(game=game)
-            .filter(visible=True)
-            .order_by('-timestamp')
-            .first()
+        'latest_announcement': request.game_context.latest_announcement
     }
 
 
@@ -70,7 +64,7 @@ def context_lupus(request):
     ]
     result = dict()
     for f in context_functions:
-        result = dict( result.items() | f(request).items() )
+        result.update(f(request))
     return result
 
 
@@ -1,6 +1,9 @@
 #!/usr/bin/python
 # coding=utf8
 
+import asyncio
+from functools import wraps
+
 from django.contrib.auth.views import redirect_to_login
 from django.shortcuts import redirect
 
@@ -10,56 +13,68 @@ def is_staff_check(user):
         return False
     return user.is_staff
 
-def master_required(func):
-    def decorator(request, *args, **kwargs):
-        if request.is_master:
-            return func(request, *args, **kwargs)
-        elif request.user.is_authenticated:
-            return redirect('game:status',game_name=request.game.name)
+def request_check(denied):
+    """Turn denied(request), which returns a response if the request
+    must not reach the view and None otherwise, into a view decorator.
+    Async views stay async."""
+    def view_decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def decorator(request, *args, **kwargs):
+                response = denied(request)
+                if response is not None:
+                    return response
+                return await func(request, *args, **kwargs)
         else:
-            return redirect_to_login(request.get_full_path())
+            @wraps(func)
+            def decorator(request, *args, **kwargs):
+                response = denied(request)
+                if response is not None:
+                    return response
+                return func(request, *args, **kwargs)
+        return decorator
+    return view_decorator
 
-    return decorator
+@request_check
+def master_required(request):
+    if request.is_master:
+        return None
+    elif request.user.is_authenticated:
+        return redirect('game:status',game_name=request.game.name)
+    else:
+        return redirect_to_login(request.get_full_path())
 
-def player_required(func):
+@request_check
+def player_required(request):
     """Checks that the user is logged as a player."""
-    def decorator(request, *args, **kwargs):
-        if request.player is not None:
-            return func(request, *args, **kwargs)
-        else:
-            return redirect('game:pointofview',game_name=request.game.name)
-
-    return decorator
+    if request.player is not None:
+        return None
+    else:
+        return redirect('game:pointofview',game_name=request.game.name)
 
-def player_or_master_required(func):
+@request_check
+def player_or_master_required(request):
     """Checks that the user is taking part in the current game."""
-    def decorator(request, *args, **kwargs):
-        if request.master is not None or (request.player is not None and request.game.started):
-            return func(request, *args, **kwargs)
-        elif request.user.is_authenticated:
-            return redirect('game:status',game_name=request.game.name)
-        else:
-            return redirect_to_login(request.get_full_path())
-
-    return decorator
+    if request.master is not None or (request.player is not None and request.game_context.started):
+        return None
+    elif request.user.is_authenticated:
+        return redirect('game:status',game_name=request.game.name)
+    else:
+        return redirect_to_login(request.get_full_path())
 
 
-def registrations_open(func):
+@request_check
+def registrations_open(request):
     """Checks that the game is not started."""
-    def decorator(request, *args, **kwargs):
-        if request.game is not None and not request.game.started:
-            return func(request, *args, **kwargs)
-        else:
-            return redirect('game:status',game_name=request.game.name)
-
-    return decorator
+    if request.game is not None and not request.game_context.started:
+        return None
+    else:
+        return redirect('game:status',game_name=request.game.name)
 
 
-def can_access_admin_view(func):
-    def decorator(request, *args, **kwargs):
-        if request.is_master or ((request.player or request.master) and request.game.is_over and request.game.postgame_info):
-            return func(request, *args, **kwargs)
-        else:
-            return redirect_to_login(request.get_full_path())
-
-    return decorator
+@request_check
+def can_access_admin_view(request):
+    if request.is_master or ((request.player or request.master) and request.game_context.is_over and request.game.postgame_info):
+        return None
+    else:
+        return redirect_to_login(request.get_full_path())
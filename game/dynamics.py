@@ -1,25 +1,33 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import copy
 import logging
 
-from django.db.models import Q
+from django.conf import settings
 
-from threading import RLock
+from threading import RLock, Condition
 from datetime import datetime, timedelta
+from collections import deque
 import time
 
-from .models import Event, Turn
+from .models import Event, Turn, PlayerStatus
+from .sources import DatabaseEventSource, MemoryEventSource
 from .events import CommandEvent, VoteAnnouncedEvent, TallyAnnouncedEvent, \
     SetMayorEvent, PlayerDiesEvent, PowerOutcomeEvent, StakeFailedEvent, \
     ExileEvent, VictoryEvent, AvailableRoleEvent, RoleKnowledgeEvent
 from .constants import *
 from .utils import get_now
+from .roles.base import TargetOptions
+from .profiling import DynamicsProfiler, NO_SECTION, profiled
+from .snapshot import DynamicsSnapshot
+from .player_state import PlayerStateTable
 
 RELAX_TIME_CHECKS = False
 ANCIENT_DATETIME = datetime(year=1970, month=1, day=1, tzinfo=REF_TZINFO)
 UPDATE_INTERVAL = timedelta(seconds=1)
 FORCE_PREVIEW = False # Enable only when running tests.
+RECENT_RECORDS = 200 # Log records kept by each dynamics for post mortem
 
 # When SINGLE_MODE is set, at most one dynamics can act concurrently
 # on the same game; when SINGLE_MODE is not set automatic events won't
@@ -30,6 +38,42 @@ SINGLE_MODE = False
 
 logger = logging.getLogger(__name__)
 
+class DynamicsLoggerAdapter(logging.LoggerAdapter):
+    """Tag records with the dynamics they come from and keep the
+    most recent ones (debug included, whatever the configured level)
+    in a ring buffer, to be written out when the dynamics fails."""
+
+    def __init__(self, logger, dynamics):
+        super().__init__(logger, {'dynamics': hex(id(dynamics))})
+        self.recent = deque(maxlen=RECENT_RECORDS)
+
+    def log(self, level, msg, *args, **kwargs):
+        # Messages are only rendered when a handler emits them or the
+        # buffer is written out, so callers pass arguments that do not
+        # change afterwards (or copies of them)
+        self.recent.append((datetime.now(), level, msg, args))
+        super().log(level, msg, *args, **kwargs)
+
+    def dump_recent(self):
+        lines = []
+        for timestamp, level, msg, args in self.recent:
+            try:
+                message = str(msg) % args if args else str(msg)
+            except Exception:
+                message = '%s %r' % (msg, args)
+            lines.append('%s %-5s %s' % (timestamp.isoformat(), logging.getLevelName(level), message))
+        self.logger.error('Dynamics failed, last %d log records follow:\n%s', len(lines), '\n'.join(lines), extra=self.extra)
+
+class AdminString:
+    """The message shown to admins about an event, rendered only if
+    the record is emitted or dumped."""
+
+    def __init__(self, event):
+        self.event = event
+
+    def __str__(self):
+        return self.event.to_player_string('admin') or ''
+
 class Movement:
     def __repr__(self):
         return "%r (%r) => %r (%r) %s" % (self.src, self.src.power.name, self.dst, self.dst.power.name, "[Illusione]" if self != self.src.movement else "")
@@ -41,15 +85,26 @@ class Dynamics:
     def __repr__(self):
         return hex(id(self))
 
-    def __init__(self, game, preview=False):
+    def __init__(self, game, preview=False, source=None):
         self.preview = preview
+        if source is None:
+            source = DatabaseEventSource(game)
+        self.source = source
         self.preview_dynamics = None
-        self.logger = logging.LoggerAdapter(logger, {'dynamics': hex(id(self))})
-        self.logger.info("New dynamics for game %(game)s spawned!" % {'game':game.name, 'self':self})
+        self.logger = DynamicsLoggerAdapter(logger, self)
+        self.profiler = DynamicsProfiler() if getattr(settings, 'PROFILE_DYNAMICS', False) else None
+        self.logger.info("New dynamics for game %s spawned!", game.name)
         self.spawned_at = time.time()
         self.game = game
         self.check_mode = False  # Not supported at the moment
         self.update_lock = RLock()
+        self.snapshot = None
+        self.snapshot_version = 0
+        self.commands_cond = Condition()
+        self.pending_commands = []
+        self.next_batch = 0
+        self.flushed_batch = -1
+        self.flushing = False
         self.event_num = 0
         self._updating = False
         self.debug_event_bin = None
@@ -79,8 +134,17 @@ class Dynamics:
                 assert not event.AUTOMATIC, "Please delete automatic events from database using delete_automatic_events.py"
         """
 
+    @classmethod
+    def from_dump(cls, data):
+        """Replay a game dumped by dump_game() entirely in memory,
+        without performing a single query."""
+        source = MemoryEventSource(data)
+        dynamics = cls(source.game, source=source)
+        dynamics.update()
+        return dynamics
+
     def initialize_augmented_structure(self):
-        self.players = list(self.game.player_set.order_by('pk'))
+        self.players = self.source.get_players()
         self.players_dict = {}
         self.random = None
         self.current_turn = None
@@ -116,17 +180,19 @@ class Dynamics:
         self.upcoming_deaths = []
         self.pending_disqualifications = []
         self.movements = []
-        for player in self.players:
+        self.target_options = {}
+        self.target_options_version = None
+        self.player_state = PlayerStateTable(len(self.players))
+        self.player_state.reset('alive', True)
+        self.player_state.reset('active', True)
+        for ordinal, player in enumerate(self.players):
             self.players_dict[player.pk] = player
+            self.player_state.attach(player, ordinal)
             player.team = None
             player.role = None
             player.dead_power = None
-            player.specter = False
             player.aura = None
             player.is_mystic = None
-            player.alive = True
-            player.active = True
-            player.disqualified = False
             player.canonical = True
             player.recorded_vote = None
             player.recorded_elect = None
@@ -134,45 +200,48 @@ class Dynamics:
             player.apparent_aura = None
             player.apparent_role = None
             player.apparent_team = None
-            player.protected_by_guard = False
-            player.protected_by_keeper = False
-            player.temp_dehypnotized = False
-            player.just_dead = False
-            player.just_ghostified = False
-            player.just_transformed = False
-            player.just_resurrected = False
             player.hypnotist = None
-            player.has_permanent_amnesia = False
-            player.has_confusion = False
-            player.cooldown = False
 
     def get_active_players(self):
         """Players are guaranteed to be sorted in a canonical order,
         which does not change neither by restarting the server (but it
         can change if players' data is changed)."""
-        return [player for player in self.players if player.active]
+        return self.player_state.select(self.players, active=True)
 
     def get_inactive_players(self):
         """Players are guaranteed to be sorted in a canonical order,
         which does not change neither by restarting the server (but it
         can change if players' data is changed)."""
-        return [player for player in self.players if not player.active]
+        return self.player_state.select(self.players, active=False)
 
     def get_alive_players(self):
         """Players are guaranteed to be sorted in a canonical order,
         which does not change neither by restarting the server (but it
         can change if players' data is changed)."""
-        return [player for player in self.players if player.alive and player.active]
+        return self.player_state.select(self.players, alive=True, active=True)
 
     def get_dead_players(self):
         """Players are guaranteed to be sorted in a canonical order,
         which does not change neither by restarting the server (but it
         can change if players' data is changed)."""
-        return [player for player in self.players if not player.alive and player.active]
+        return self.player_state.select(self.players, alive=False, active=True)
 
     def get_canonical_player(self, player):
         return self.players_dict[player.pk]
 
+    def get_target_options(self, power):
+        """Return the possible targets of power. They are computed at
+        most once for each state of the dynamics, since they can only
+        change when a new turn or a new event is received."""
+        version = (len(self.turns), self.event_num)
+        if self.target_options_version != version:
+            self.target_options = {}
+            self.target_options_version = version
+        key = (power.player.pk, power.__class__)
+        if key not in self.target_options:
+            self.target_options[key] = TargetOptions(power, self)
+        return self.target_options[key]
+
 
     def get_apparent_aura(self, player):
         return player.apparent_aura
@@ -186,52 +255,110 @@ class Dynamics:
     def get_apparent_team(self, player):
         return player.apparent_team
 
+    def profile(self, name, detail):
+        """Profile a step of the dynamics in a with statement."""
+        if self.profiler is None:
+            return NO_SECTION
+        return self.profiler.section(self.current_turn, '%s %s' % (name, detail))
+
     def get_preview_dynamics(self):
         assert not self.preview
         if self.preview_dynamics is None:
-            self.preview_dynamics = self.__class__(self.game, preview=True)
+            self.preview_dynamics = self.__class__(self.game, preview=True, source=self.source.copy())
         self.logger.info('Loading preview...')
         self.preview_dynamics.update()
         return self.preview_dynamics
 
+    # State that is never shared with a fork (see fork())
+    FORK_EXCLUDED = {'update_lock', 'commands_cond', 'pending_commands', 'logger', 'profiler',
+                     'snapshot', 'preview_dynamics', 'target_options'}
+
+    def fork(self):
+        """Return an independent copy of this dynamics, that can be
+        taken further (for example after MemoryEventSource.append_turn())
+        without changing this one. Everything is copied but the game,
+        the data of the source and the roles of the ruleset, which
+        never change; locks, snapshot, preview, profiler and logger
+        are new. It is much faster than replaying the game."""
+        fork = self.__class__.__new__(self.__class__)
+        memo = {id(self): fork, id(self.game): self.game}
+        data = getattr(self.source, 'data', None)
+        if data is not None:
+            memo[id(data)] = data
+        ruleset_roles = getattr(self, 'ruleset_roles', None)
+        if ruleset_roles is not None:
+            memo[id(ruleset_roles)] = ruleset_roles
+        for name, value in self.__dict__.items():
+            if name not in self.FORK_EXCLUDED:
+                fork.__dict__[name] = copy.deepcopy(value, memo)
+
+        fork.update_lock = RLock()
+        fork.commands_cond = Condition()
+        fork.pending_commands = []
+        fork.logger = DynamicsLoggerAdapter(logger, fork)
+        fork.profiler = None
+        fork.snapshot = None
+        fork.snapshot_version = 0
+        fork.preview_dynamics = None
+        fork.target_options = {}
+        fork.target_options_version = None
+        fork.spawned_at = None
+        return fork
+
     def update(self, lazy=False):
         # If dynamics was updated recently, don't try again to save time
         if lazy and self.last_update + UPDATE_INTERVAL > get_now():
             return
 
         self.last_update = get_now()
-        with self.update_lock:
-            try:
-                if self._updating:
-                    return
-                self._updating = True
-                while self._update_step():
-                    pass
-                self._updating = False
-            except Exception:
-                self.failed = True
-                raise
+        # Lazy updates do not wait for another thread that is already
+        # updating: their readers can use the last published snapshot
+        if not self.update_lock.acquire(blocking=not lazy or self.snapshot is None):
+            return
+        try:
+            if self._updating:
+                return
+            self._updating = True
+            changed = False
+            while self._update_step():
+                changed = True
+            if changed:
+                self._save_player_statuses(self.current_turn)
+            if changed or self.snapshot is None:
+                self.publish_snapshot()
+            self._updating = False
+        except Exception:
+            self.failed = True
+            self.logger.dump_recent()
+            raise
+        finally:
+            self.update_lock.release()
         if self.spawned_at:
-            self.logger.info('First updating finished. Elapsed time: %r' % (time.time() - self.spawned_at))
+            self.logger.info('First updating finished. Elapsed time: %r', time.time() - self.spawned_at)
             self.spawned_at = None
 
 
+    def _save_player_statuses(self, turn):
+        """Give the source the status of the players during turn, so
+        that it can be read without a dynamics (see PlayerStatus)."""
+        if self.preview or turn is None or turn.pk is None:
+            return
+        self.source.save_player_statuses(turn, dict((player.pk, PlayerStatus.get_status(player, self)) for player in self.players))
+
+    def publish_snapshot(self):
+        """Build a read-only view of the current state and make it the
+        one seen by readers (the assignment is atomic)."""
+        self.snapshot_version += 1
+        self.snapshot = DynamicsSnapshot(self, self.snapshot_version)
+
     def _pop_event_from_db(self):
         self.logger.debug("Searching db for events in %r after %s an with pk>%s", self.current_turn, self.last_timestamp_in_turn, self.last_pk_in_turn)
+        if len(self.db_event_queue) == 0:
+            self.db_event_queue += self.source.get_events(self.current_turn, self.last_timestamp_in_turn, self.last_pk_in_turn)
         if len(self.db_event_queue) > 0:
-            return self.db_event_queue.pop(0).as_child()
-
-        try:
-            result = Event.objects.filter(turn=self.current_turn). \
-                filter(Q(timestamp__gt=self.last_timestamp_in_turn) |
-                       (Q(timestamp__gte=self.last_timestamp_in_turn) & Q(pk__gt=self.last_pk_in_turn))). \
-                       order_by('timestamp', 'pk')
-            self.db_event_queue += result
-            event = self.db_event_queue.pop(0)
-        except IndexError:
-            return None
+            return self.db_event_queue.pop(0)
         else:
-            return event.as_child()
+            return None
 
     def _pop_event_from_queue(self):
         if len(self.auto_event_queue) > 0:
@@ -248,7 +375,7 @@ class Dynamics:
                 if self.debug_event_bin is not None:
                     self.debug_event_bin.append(queued_event)
                 if SINGLE_MODE:
-                    queued_event.save()
+                    self.source.save_event(queued_event)
                 else:
                     queued_event.fill_subclass()
                 self._receive_event(queued_event)
@@ -275,23 +402,23 @@ class Dynamics:
             return False
 
         # If no events were found, check for new turns
-        try:
-            if self.current_turn is not None:
-                turn = self.current_turn.next_turn(must_exist=True)
-            else:
-                turn = Turn.first_turn(self.game, must_exist=True)
-        except Turn.DoesNotExist:
+        if self.current_turn is not None:
+            turn = self.source.next_turn(self.current_turn)
+        else:
+            turn = self.source.first_turn()
+
+        if turn is None:
             # Refresh turn since the end might have changed
-            if self.current_turn is not None and self.current_turn.pk is not None:
-                self.current_turn.refresh_from_db()
+            if self.current_turn is not None:
+                self.source.refresh_turn(self.current_turn)
 
             # Check if current_turn has ended: if so, automatically advance turn
             if self.current_turn is not None and self.current_turn.end is not None and self.current_turn.end <= get_now():
-                self.game.advance_turn(current_turn=self.current_turn)
-                return True
+                if self.source.advance_turn(self.current_turn):
+                    return True
 
             if self.preview and self.simulated_turn is None and self.current_turn.phase in [DAY, NIGHT]:
-                self.simulated_turn = self.current_turn.next_turn()
+                self.simulated_turn = self.source.make_next_turn(self.current_turn)
                 self.turns.append(self.simulated_turn)
                 self._receive_turn(self.simulated_turn)
                 return True
@@ -303,7 +430,7 @@ class Dynamics:
         return False
 
     def _check_events_before_turn(self, turn):
-        assert Event.objects.filter(turn=turn).filter(timestamp__lt=turn.begin).count() == 0
+        assert self.source.count_events_before(turn) == 0
 
     def _receive_turn(self, turn):
         # Check that turn that is finishing did not have events before
@@ -311,11 +438,15 @@ class Dynamics:
         if self.current_turn is not None:
             self._check_events_before_turn(self.current_turn)
 
+        # The status of the players at the end of the old turn is
+        # final
+        self._save_player_statuses(self.current_turn)
+
         # Promote the new turn (we also update the old turn from the
         # database, since we expect that end might have been set since
         # last time we obtained it)
         if self.current_turn is not None:
-            self.prev_turn = Turn.objects.get(pk=self.current_turn.pk)
+            self.prev_turn = self.source.reload_turn(self.current_turn)
         self.current_turn = turn
 
         # If this is a preview, automatically put end to previous turn, without saving it to the database.
@@ -388,9 +519,12 @@ class Dynamics:
         self.event_num += 1
 
     def _process_event(self, event):
-        event.apply(self)
-        if event.to_player_string('admin') is not None:
-            self.logger.debug("> %s",event.to_player_string('admin'))
+        with self.profile('apply', event.subclass):
+            event.apply(self)
+        # Events keeping the default to_player_string() have nothing
+        # to say to admins
+        if event.__class__.to_player_string is not Event.to_player_string:
+            self.logger.debug("> %s", AdminString(event))
 
     def inject_event(self, event):
         """This is for non automatic events."""
@@ -400,7 +534,7 @@ class Dynamics:
         event.turn = self.current_turn
         if event.timestamp is None:
             event.timestamp = get_now()
-        event.save()
+        self.source.save_event(event)
 
         if self.debug_event_bin is not None:
             self.debug_event_bin.append(event)
@@ -411,6 +545,72 @@ class Dynamics:
         if FORCE_PREVIEW:
             self.preview_dynamics = self.get_preview_dynamics()
 
+    def submit_command(self, event):
+        """Inject a command coming from a player, grouping it with the
+        commands submitted concurrently: the first thread to arrive
+        stores all the pending commands in a single transaction and
+        updates the dynamics once, while the others wait for their
+        batch to be committed. Return whether the command was accepted
+        (it might come too late for the current phase)."""
+        assert isinstance(event, CommandEvent)
+        assert not self.preview
+        with self.commands_cond:
+            self.pending_commands.append(event)
+            batch = self.next_batch
+            while self.flushed_batch < batch:
+                if self.flushing:
+                    self.commands_cond.wait()
+                    continue
+
+                # Become the leader and flush the whole batch
+                self.flushing = True
+                commands = self.pending_commands
+                self.pending_commands = []
+                self.next_batch += 1
+                self.commands_cond.release()
+                try:
+                    self._flush_commands(commands)
+                finally:
+                    self.commands_cond.acquire()
+                    self.flushing = False
+                    self.flushed_batch = batch
+                    self.commands_cond.notify_all()
+
+            return getattr(event, 'accepted', False)
+
+    def _flush_commands(self, commands):
+        # Commands are stamped when they are stored, so that they
+        # cannot precede events the dynamics has already processed
+        for event in commands:
+            event.accepted = False
+
+        # The commands are stored in the same transaction as the update
+        # applying them: if the flush fails, they are rolled back and
+        # none of them is acknowledged. The lock is taken first, so
+        # that the transaction is never held while waiting for it
+        with self.update_lock, self.source.atomic():
+            now = get_now()
+            accepted = []
+            for event in commands:
+                if self.current_turn is not None and event.check_phase(turn=self.current_turn):
+                    event.turn = self.current_turn
+                    event.timestamp = now
+                    accepted.append(event)
+            self.logger.debug("Flushing %d commands (%d rejected)", len(accepted), len(commands) - len(accepted))
+            self.source.save_events(accepted)
+
+            if self.debug_event_bin is not None:
+                self.debug_event_bin += accepted
+            self.update()
+
+        self.preview_dynamics = None
+
+        if FORCE_PREVIEW:
+            self.preview_dynamics = self.get_preview_dynamics()
+
+        for event in accepted:
+            event.accepted = True
+
     def generate_event(self, event):
         """This is for automatic events."""
         assert event.AUTOMATIC
@@ -430,6 +630,7 @@ class Dynamics:
         """
         self.end_phase_queue.append(event)
 
+    @profiled
     def _compute_entering_creation(self):
         self.logger.debug("Computing creation")
 
@@ -463,11 +664,12 @@ class Dynamics:
         required or if they don't satisfy the rules."""
 
         for player in self.players:
-            if player.role.needs_soothsayer_propositions():
+            if player.role.needs_soothsayer_propositions(self):
                 return player
 
         return None
 
+    @profiled
     def _compute_entering_night(self):
         self.logger.debug("Computing night")
 
@@ -480,6 +682,7 @@ class Dynamics:
 
         self._check_team_exile()
 
+    @profiled
     def _solve_blockers(self, critical_blockers, block_graph, rev_block_graph):
         # First some checks and build the reverse graph
         critical_pks = [x.pk for x in critical_blockers]
@@ -560,6 +763,7 @@ class Dynamics:
 
         return True
 
+    @profiled
     def _compute_entering_dawn(self):
         self.logger.debug("Computing dawn")
 
@@ -624,14 +828,16 @@ class Dynamics:
             self.logger.debug("  > Applying role %r for %r:", player.power, player)
             success = powers_success[player.pk]
             if success:
-                success = player.power.pre_apply_dawn(self)
+                with self.profile('pre_apply_dawn', player.power.__class__.__name__):
+                    success = player.power.pre_apply_dawn(self)
                 self.logger.debug("    Success!" if success else "    Conditions for applying role not met!")
             else:
                 self.logger.debug("    Power blocked!")
             event = PowerOutcomeEvent(player=player, success=success, command=player.power.recorded_command, power=player.power.__class__)
             self.generate_event(event)
             if success:
-                player.power.apply_dawn(self)
+                with self.profile('apply_dawn', player.power.__class__.__name__):
+                    player.power.apply_dawn(self)
 
         players = self.get_active_players()
         self.random.shuffle(players)
@@ -652,19 +858,18 @@ class Dynamics:
             player.apparent_mystic = None
             player.apparent_role = None
             player.apparent_team = None
-            player.protected_by_guard = False
-            player.protected_by_keeper = False
             player.movement = None
-            player.just_ghostified = False
-            player.just_transformed = False
-            player.just_resurrected = False
-            player.has_confusion = False
+        for flag in ['protected_by_guard', 'protected_by_keeper', 'just_ghostified',
+                     'just_transformed', 'just_resurrected', 'has_confusion']:
+            self.player_state.reset(flag)
 
         self._end_of_main_phase()
 
+    @profiled
     def _compute_entering_day(self):
         self.logger.debug("Computing day")
 
+    @profiled
     def _compute_entering_sunset(self):
         self.logger.debug("Computing sunset")
 
@@ -696,8 +901,8 @@ class Dynamics:
         self.electoral_frauds = []
 
         # Unrecord all elect and vote events, and remove hypnotist immunity
+        self.player_state.reset('temp_dehypnotized')
         for player in self.players:
-            player.temp_dehypnotized = False
             player.recorded_vote = None
             player.recorded_elect = None
 
@@ -781,7 +986,7 @@ class Dynamics:
 
         # Check mayor vote
         for player in self.get_alive_players():
-            if player.is_mayor():
+            if player.is_mayor(self):
                 mayor_ballot = ballots[player.pk]
 
         # Fill the tally sheet
@@ -835,6 +1040,7 @@ class Dynamics:
 
         return winner_player, cause
 
+    @profiled
     def _check_deaths(self):
         # We randomize deaths in order to mix Fantasmi and Ipnotisti
         self.random.shuffle(self.upcoming_deaths)
@@ -871,6 +1077,7 @@ class Dynamics:
 
         return teams
 
+    @profiled
     def _check_team_exile(self):
         # Detect dying teams
         for team in self.dying_teams:
@@ -3,6 +3,7 @@
 from django.db import models
 from .models import Event, Player, StringsSetField, RoleField, MultipleRoleField, BooleanArrayField
 from .roles.base import Role
+from .roles.registry import get_ruleset_roles
 from .constants import *
 from .utils import dir_dict, rev_dict
 from importlib import import_module
@@ -85,6 +86,65 @@ class CommandEvent(Event):
             turn = dynamics.current_turn
         return turn.phase in CommandEvent.REAL_RELEVANT_PHASES[self.type]
 
+    def validate(self, dynamics):
+        """Check whether the player can give this command in the
+        current turn of dynamics, filling in the defaults of the
+        fields left empty (a power used without target is not used
+        at all, so its other fields are cleared)."""
+        if not self.check_phase(dynamics=dynamics):
+            return False
+        turn = dynamics.current_turn
+        player = self.player.canonicalize(dynamics)
+        target = self.target.canonicalize(dynamics) if self.target is not None else None
+        target2 = self.target2.canonicalize(dynamics) if self.target2 is not None else None
+
+        if self.type == USEPOWER:
+            if not player.can_use_power(dynamics, turn):
+                return False
+            if target is None:
+                self.target2 = self.role_class = self.multiple_role_class = None
+                return True
+            power = player.power
+            options = dynamics.get_target_options(power)
+            if not options.is_valid_target(target):
+                return False
+            if options.targets2 is not None:
+                if not options.is_valid_target2(target2):
+                    return False
+                if not power.allow_target2_same_as_target and target2 == target:
+                    return False
+            elif target2 is not None:
+                return False
+            if options.role_classes is not None:
+                if self.role_class is None:
+                    self.role_class = options.role_class_default
+                if self.role_class not in options.role_classes:
+                    return False
+            elif self.role_class is not None:
+                return False
+            if options.multiple_role_classes is not None:
+                if self.multiple_role_class is None or not self.multiple_role_class.issubset(options.multiple_role_classes):
+                    return False
+            elif self.multiple_role_class is not None:
+                return False
+            return True
+
+        if target2 is not None or self.role_class is not None or self.multiple_role_class is not None:
+            return False
+        if target is not None and not (target.alive and target.active):
+            return False
+
+        if self.type == VOTE:
+            return player.can_vote(dynamics, turn)
+
+        elif self.type == ELECT:
+            return player.can_vote(dynamics, turn) and dynamics.rules.mayor
+
+        elif self.type == APPOINT:
+            return player.is_mayor(dynamics) and dynamics.rules.mayor and (target is None or target.pk != player.pk)
+
+        return False
+
     def apply(self, dynamics):
         assert self.check_phase(dynamics=dynamics)
 
@@ -174,10 +234,10 @@ class SetRulesEvent(Event):
         self.ruleset = data['ruleset']
 
     def apply(self, dynamics):
-        module = import_module('game.roles.' + self.ruleset)
-        dynamics.rules = module.Rules()
-        dynamics.valid_roles = [getattr(module, k) for k in dir(module) if isclass(getattr(module, k)) and issubclass(getattr(module, k), Role) and getattr(module, k).__module__ == 'game.roles.' + self.ruleset]
-        dynamics.valid_roles.sort(key=lambda x: (TEAMS.index(x.team), x.name))
+        ruleset_roles = get_ruleset_roles(self.ruleset)
+        dynamics.rules = ruleset_roles.rules_class()
+        dynamics.ruleset_roles = ruleset_roles
+        dynamics.valid_roles = list(ruleset_roles.roles)
         dynamics.ruleset = self.ruleset
 
 class SpectralSequenceEvent(Event):
@@ -1625,3 +1685,10 @@ class VictoryEvent(Event):
             return u'<b>La partita si è conclusa con la vittoria di tutte le Fazioni.</b>'
         else:
             raise Exception ('Number of winner is not reasonable')
+
+
+# Registry of the events generated by the dynamics, which are only
+# written to the database in SINGLE_MODE; every Event subclass is
+# defined above, so it can be built once and for all
+AUTOMATIC_EVENT_CLASSES = tuple(subclass for subclass in Event.__subclasses__() if subclass.AUTOMATIC)
+AUTOMATIC_EVENT_NAMES = frozenset(subclass.__name__ for subclass in AUTOMATIC_EVENT_CLASSES)
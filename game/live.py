@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import time
+
+from asgiref.sync import sync_to_async
+
+from .snapshot import is_turn_visible
+
+# Longest time a client is kept waiting for news
+LONG_POLL_TIMEOUT = 25.0
+
+# How often waiting clients look at the published snapshot; this only
+# happens in memory
+WATCH_INTERVAL = 0.5
+
+# How often the dynamics of a game with waiting clients is brought up
+# to date with the database, so that events stored by other processes
+# are noticed too; this is done once per game, not once per client
+REFRESH_INTERVAL = 10.0
+
+_last_refresh = {}
+
+
+def visible_messages(snapshot, pov, cursor):
+    """Return the messages visible from pov produced by the events of
+    snapshot after the first cursor ones, as (turn, message) pairs."""
+    messages = []
+    for event in snapshot.events[cursor:]:
+        if not is_turn_visible(event.turn, pov):
+            continue
+        message = event.to_player_string(pov)
+        if message is not None:
+            messages.append((event.turn, message))
+    return messages
+
+async def wait_for_messages(dynamics, pov, cursor, timeout=LONG_POLL_TIMEOUT):
+    """Wait until some event after cursor is visible from pov, or until
+    timeout expires. Return the snapshot that was last looked at, the
+    cursor to be used for the next call and the new messages
+    (possibly none)."""
+    deadline = time.monotonic() + min(timeout, LONG_POLL_TIMEOUT)
+    snapshot = None
+    while True:
+        if dynamics.snapshot is not snapshot:
+            snapshot = dynamics.snapshot
+            if len(snapshot.events) > cursor:
+                # Messages might need to look at the database, which
+                # cannot be done from the event loop
+                messages = await sync_to_async(visible_messages)(snapshot, pov, cursor)
+                cursor = len(snapshot.events)
+                if messages:
+                    return snapshot, cursor, messages
+
+        now = time.monotonic()
+        if now >= deadline:
+            return snapshot, cursor, []
+
+        game_pk = dynamics.game.pk
+        if _last_refresh.get(game_pk, 0.0) + REFRESH_INTERVAL <= now:
+            _last_refresh[game_pk] = now
+            await sync_to_async(dynamics.update)(lazy=True)
+        else:
+            await asyncio.sleep(min(WATCH_INTERVAL, deadline - now))
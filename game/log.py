@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import copy
+import logging
+import os
+from logging.handlers import QueueListener
+from queue import Queue
+
+
+class BackgroundFileHandler(logging.Handler):
+    """A FileHandler which leaves formatting and writing to a
+    background thread, so that whoever logs never waits for the
+    disk. It is configured exactly like a FileHandler.
+
+    It is not a QueueHandler: dictConfig() would then expect it to be
+    configured with the queue handler keys."""
+
+    def __init__(self, filename, mode='a', encoding=None, delay=False):
+        super().__init__()
+        self.queue = Queue(-1)
+        self.file_handler = logging.FileHandler(filename, mode=mode, encoding=encoding, delay=delay)
+        self.start_listener()
+        atexit.register(self.stop_listener)
+        # The thread does not survive a fork (as done by parallel
+        # tests), so children need their own
+        os.register_at_fork(after_in_child=self.restart_listener)
+
+    def start_listener(self):
+        self.listener = QueueListener(self.queue, self.file_handler)
+        self.listener.start()
+
+    def stop_listener(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def restart_listener(self):
+        if self.listener is None:
+            return
+        # The queue may have been locked by the parent's thread
+        self.queue = Queue(-1)
+        self.start_listener()
+
+    def setFormatter(self, fmt):
+        super().setFormatter(fmt)
+        self.file_handler.setFormatter(fmt)
+
+    def prepare(self, record):
+        # Arguments are merged right away, since the objects they refer
+        # to may change before the record is written; everything else
+        # is left to the background thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self.stop_listener()
+        self.file_handler.close()
+        super().close()
@@ -1,10 +1,109 @@
+import logging
+
+from django.conf import settings
 from django.contrib.auth.models import Permission, User
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
 from django.utils.deprecation import MiddlewareMixin
+from django.utils.functional import cached_property
 from django.shortcuts import get_object_or_404
 from game.models import *
 from game.utils import get_now
 from threading import Lock
 
+logger = logging.getLogger(__name__)
+
+# Per-request view of the game the page refers to.
+class GameContext:
+    """Collect everything a page needs to know about its game. Each
+    lookup is performed at most once per request and then memoized,
+    so views, decorators and context processors can ask for it as
+    many times as they like."""
+
+    def __init__(self, request, game=None):
+        self.request = request
+        self.game = game
+
+    @cached_property
+    def dynamics(self):
+        if self.game is None:
+            return None
+        return self.game.get_dynamics()
+
+    @cached_property
+    def snapshot(self):
+        if self.dynamics is None:
+            return None
+        return self.dynamics.snapshot
+
+    @cached_property
+    def current_turn(self):
+        if self.game is None:
+            return None
+        return self.game.current_turn
+
+    @cached_property
+    def started(self):
+        return self.snapshot is not None and self.snapshot.started
+
+    @cached_property
+    def is_over(self):
+        return self.snapshot is not None and self.snapshot.over
+
+    @cached_property
+    def master(self):
+        user = self.request.user
+        if self.game is None or not user.is_authenticated:
+            return None
+        try:
+            return GameMaster.objects.get(user=user, game=self.game)
+        except GameMaster.DoesNotExist:
+            return None
+
+    @cached_property
+    def is_master(self):
+        if self.master is None:
+            return False
+        # Check if the user want to act as game master
+        return self.request.session.get('as_gm', None) or False
+
+    def _find_player(self, **kwargs):
+        # Canonical players are already in the dynamics, so we look
+        # for them there before asking the database
+        if self.dynamics is not None:
+            for player in self.dynamics.players:
+                if all(getattr(player, k) == v for k, v in kwargs.items()):
+                    return player
+            return None
+        try:
+            return Player.objects.get(game=self.game, **kwargs)
+        except Player.DoesNotExist:
+            return None
+
+    @cached_property
+    def player(self):
+        user = self.request.user
+        if self.game is None or not user.is_authenticated:
+            return None
+
+        player = self._find_player(user_id=user.pk)
+        if self.is_master:
+            # The User is a Game Master, so she can become any Player
+            player_id = self.request.session.get('player_id', None)
+            if player_id is not None:
+                # A Player was already saved
+                player = self._find_player(pk=player_id) or player
+        return player
+
+    @cached_property
+    def latest_announcement(self):
+        return Announcement.objects \
+            .filter(game=self.game) \
+            .filter(visible=True) \
+            .order_by('-timestamp') \
+            .first()
+
+
 # Middleware for finding Game, Dynamics and current turn.
 class GameMiddleware(MiddlewareMixin):
     def process_view(self, request, view_func, view_args, view_kwargs):
@@ -12,64 +111,19 @@ class GameMiddleware(MiddlewareMixin):
         try:
             game_name = view_kwargs['game_name']
         except KeyError:
-            request.game = None
-            request.player = None
-            request.current_turn = None
-            request.dynamics = None
-            request.is_master = False
-            request.master = None
-            return None
+            context = GameContext(request)
+        else:
+            context = GameContext(request, get_object_or_404(Game, name=game_name))
 
-        game = get_object_or_404(Game,name=game_name)
-        dynamics = None
-        current_turn = None
-        
-        if game is not None:
-            dynamics = game.get_dynamics()
-            current_turn = game.current_turn
-
-        request.game = game
-        request.dynamics = dynamics
-        request.current_turn = current_turn
-        
-        user = request.user
-        if user.is_authenticated:
-            # Authenticated
-            try:
-                master = GameMaster.objects.get(user=user,game=game)
-                request.master = master
-            except GameMaster.DoesNotExist:
-                request.master = None
-
-            try:
-                player = Player.objects.get(user=user,game=game).canonicalize()
-            except Player.DoesNotExist:
-                player = None
-
-            if request.master is not None:
-                # Check if the user want to act as game master
-                request.is_master = request.session.get('as_gm', None) or False
-            else:
-                request.is_master = False
-
-            if request.is_master:
-                # The User is a Game Master, so she can become any Player
-                player_id = request.session.get('player_id', None)
-                if player_id is not None:
-                    # A Player was already saved
-                    try:
-                        player = Player.objects.get(pk=player_id, game=request.game).canonicalize()
-                    except Player.DoesNotExist:
-                        pass
+        request.game_context = context
+        request.game = context.game
+        request.dynamics = context.dynamics
+        request.snapshot = context.snapshot
+        request.current_turn = context.current_turn
+        request.master = context.master
+        request.is_master = context.is_master
+        request.player = context.player
 
-        else:
-            # Not authenticated
-            player = None
-            request.is_master = False
-            request.master = None
-        
-        request.player = player
-        
         return None
 
 # Middleware for extending Sessions of Game Masters
@@ -91,3 +145,22 @@ class PageRequestMiddleware(MiddlewareMixin):
             PageRequest.objects.create(user=user, timestamp=get_now(), path=request.path, ip_address=ip_address, hostname=hostname)
 
 
+# Middleware for counting queries performed by each request (DEBUG only).
+class QueryCountMiddleware(MiddlewareMixin):
+    def __init__(self, get_response=None):
+        if not settings.DEBUG:
+            raise MiddlewareNotUsed()
+        super().__init__(get_response)
+
+    def __call__(self, request):
+        queries = []
+        def count_query(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_query):
+            response = super().__call__(request)
+
+        response['X-Query-Count'] = str(len(queries))
+        logger.debug("%d queries for %s", len(queries), request.path)
+        return response
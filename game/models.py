@@ -4,7 +4,7 @@ from threading import RLock
 import sys
 from inspect import isclass
 
-from django.db import models, IntegrityError, transaction
+from django.db import models, IntegrityError, NotSupportedError, transaction, router, connections
 from django import forms
 from django.utils.text import capfirst
 from django.contrib.auth.models import User
@@ -15,6 +15,7 @@ from .constants import *
 
 from .utils import advance_to_time, get_now
 from .roles.base import Role
+from .player_state import with_player_flags
 
 class BooleanArrayField(models.IntegerField):
     def from_db_value(self, value, expression, connection):
@@ -139,25 +140,170 @@ class KnowsChild(models.Model):
         super(KnowsChild, self).clean_fields(*args, **kwargs)
 
 
-def dump_game(game, fout):
-    assert game is not None
+def _dump_list(items, compact):
+    # Lay out a list of the top level object exactly as json.dump(...,
+    # indent=4) would, one item at a time
     import json
-    data = {'players': [],
-            'turns': []}
-    for player in Player.objects.filter(game=game).order_by('pk'):
-        data['players'].append(player.user.username)
-
-    for turn in Turn.objects.filter(game=game).order_by('date', 'phase'):
-        turn_data = {'begin': turn.begin.isoformat(), 'end': turn.end.isoformat() if turn.end is not None else None, 'events': [], 'comments': []}
-        for event in Event.objects.filter(turn=turn).order_by('timestamp', 'pk'):
-            event = event.as_child()
-            if not event.AUTOMATIC:
-                turn_data['events'].append(event.to_dict())
-        for comment in Comment.objects.filter(turn=turn).order_by('timestamp'):
-            turn_data['comments'].append(comment.to_dict())
-        data['turns'].append(turn_data)
-
-    json.dump(data, fout, indent=4)
+    if compact:
+        yield '['
+        for i, item in enumerate(items):
+            yield (',' if i > 0 else '') + json.dumps(item, separators=(',', ':'))
+        yield ']'
+        return
+    empty = True
+    for item in items:
+        yield ('[\n' if empty else ',\n') + '        ' + json.dumps(item, indent=4).replace('\n', '\n        ')
+        empty = False
+    yield '[]' if empty else '\n    ]'
+
+def _read_game_dump(game):
+    # Read game with one query per table, whatever its length, and
+    # return its players (sorted by pk) and a generator of the data of
+    # its turns
+    assert game is not None
+    # Event subclasses are only known once they are imported
+    from . import events
+
+    players = dict((player.pk, player) for player in Player.objects.filter(game=game).select_related('user', 'user__profile'))
+    turns = list(Turn.objects.filter(game=game).order_by('date', 'phase'))
+
+    # Only the events given by the users are dumped, the others are
+    # recomputed when the game is loaded back
+    turn_events = {}
+    for subclass in Event.__subclasses__():
+        if subclass.AUTOMATIC:
+            continue
+        player_fields = [field for field in subclass._meta.concrete_fields
+                         if field.is_relation and field.related_model is Player]
+        for event in subclass.objects.filter(turn__game=game).order_by():
+            for field in player_fields:
+                player_pk = getattr(event, field.attname)
+                if player_pk is not None:
+                    field.set_cached_value(event, players[player_pk])
+            turn_events.setdefault(event.turn_id, []).append(event)
+
+    turn_comments = {}
+    for comment in Comment.objects.filter(turn__game=game).select_related('user').order_by('timestamp', 'pk'):
+        turn_comments.setdefault(comment.turn_id, []).append(comment)
+
+    def turns_data():
+        for turn in turns:
+            events = sorted(turn_events.get(turn.pk, []), key=lambda event: (event.timestamp, event.pk))
+            yield {'begin': turn.begin.isoformat(),
+                   'end': turn.end.isoformat() if turn.end is not None else None,
+                   'events': [event.to_dict() for event in events],
+                   'comments': [comment.to_dict() for comment in turn_comments.get(turn.pk, [])]}
+
+    return [players[pk] for pk in sorted(players)], turns_data()
+
+def iter_dump_game(game, compact=False):
+    """Return a generator of the dump of game in chunks, so that it can
+    be streamed while it is produced. The whole game is read right
+    away, with a constant number of queries (one per table) whatever
+    its length; only the encoding is left to the generator, which can
+    then be consumed where queries are not allowed (like the event
+    loop of an ASGI server). The output is the same as
+    json.dump(data, fout, indent=4), or the most compact JSON encoding
+    of the same data if compact is set."""
+    players, turns_data = _read_game_dump(game)
+    usernames = [player.user.username for player in players]
+    return _iter_dump(usernames, turns_data, compact)
+
+def _iter_dump(usernames, turns_data, compact):
+    if compact:
+        yield '{"players":'
+        yield from _dump_list(usernames, compact)
+        yield ',"turns":'
+        yield from _dump_list(turns_data, compact)
+        yield '}'
+    else:
+        yield '{\n    "players": '
+        yield from _dump_list(usernames, compact)
+        yield ',\n    "turns": '
+        yield from _dump_list(turns_data, compact)
+        yield '\n}'
+
+def game_dump_data(game, player_details=False):
+    """Return the data written by dump_game() for game. With
+    player_details, players are described by their names and gender
+    too (as understood by MemoryEventSource), not just by username."""
+    players, turns_data = _read_game_dump(game)
+    if player_details:
+        players_data = [{'username': player.user.username,
+                         'first_name': player.user.first_name,
+                         'last_name': player.user.last_name,
+                         'gender': player.gender} for player in players]
+    else:
+        players_data = [player.user.username for player in players]
+    return {'players': players_data, 'turns': list(turns_data)}
+
+def bulk_create_rows(model, objs, key_fields=None, **filters):
+    """Insert objs with bulk_create() and make sure that their primary
+    keys are set, even where the database does not return them (like
+    SQLite). There they are read back from the rows selected by
+    filters, matching each obj by the values of key_fields, which
+    must identify it among them.
+
+    Without key_fields, objs get the primary keys of the last rows of
+    the table. This only works on SQLite: since the rows are inserted
+    and read back in the same transaction, SQLite holds its write
+    lock in between, so no other connection can add rows after them.
+    Other databases have no such guarantee, so there key_fields are
+    required unless the database returns the primary keys."""
+    with transaction.atomic(using=router.db_for_write(model)):
+        model.objects.bulk_create(objs)
+        if objs and any(obj.pk is None for obj in objs):
+            if key_fields is not None:
+                rows = model.objects.filter(**filters).values_list(*key_fields, 'pk')
+                pks = dict((row[:-1], row[-1]) for row in rows)
+                for obj in objs:
+                    obj.pk = pks[tuple(getattr(obj, field) for field in key_fields)]
+            else:
+                vendor = connections[router.db_for_write(model)].vendor
+                if vendor != 'sqlite':
+                    raise NotSupportedError("Cannot recover the primary keys of %s rows on %s without key_fields" % (model.__name__, vendor))
+                pks = list(model.objects.order_by('-pk').values_list('pk', flat=True)[:len(objs)])
+                for obj, pk in zip(objs, reversed(pks)):
+                    obj.pk = pk
+    return objs
+
+def bulk_create_events(events):
+    """Insert events (instances of Event subclasses, whose turn is
+    already saved) with a few queries per subclass. Django's
+    bulk_create() does not support multi-table inheritance, so the
+    rows of Event and the ones of each subclass are inserted
+    separately. Event rows have no natural key, so on databases that
+    do not return the primary keys of bulk inserts this only works on
+    SQLite (see bulk_create_rows()). The subclass rows are written
+    with Model._base_manager._insert(), the private API used by
+    save(), which may change between Django versions."""
+    with transaction.atomic():
+        for event in events:
+            event.fill_subclass()
+        bases = bulk_create_rows(Event, [Event(subclass=event.subclass, timestamp=event.timestamp, turn=event.turn) for event in events])
+
+        by_subclass = {}
+        for event, base in zip(events, bases):
+            event.pk = event.id = base.pk
+            by_subclass.setdefault(event.__class__, []).append(event)
+
+        using = router.db_for_write(Event)
+        connection = connections[using]
+        for subclass, objs in by_subclass.items():
+            # The same insert that save() does for the subclass table,
+            # but with many rows at once
+            fields = subclass._meta.local_concrete_fields
+            batch_size = max(connection.ops.bulk_batch_size(fields, objs), 1)
+            for i in range(0, len(objs), batch_size):
+                subclass._base_manager._insert(objs[i:i+batch_size], fields=fields, using=using)
+            for obj in objs:
+                obj._state.adding = False
+                obj._state.db = using
+    return events
+
+def dump_game(game, fout, compact=False):
+    for chunk in iter_dump_game(game, compact=compact):
+        fout.write(chunk)
 
 
 _dynamics_map = {}
@@ -258,17 +404,34 @@ class Game(models.Model):
                     from .dynamics import Dynamics
                     del _dynamics_map[self.pk]
 
-    def recompute_automatic_events(self):
-        """This is not really race-free, so use with care..."""
-        global _dynamics_map
-        global _dynamics_map_lock
+    def recompute_automatic_events(self, regenerate=False):
+        """Delete the automatic events of this game from the database
+        (where they are only written in SINGLE_MODE) and kill its
+        dynamics, so that they are computed again. The events are
+        deleted with one statement per table, in a single
+        transaction. If regenerate is set, the dynamics is rebuilt in
+        the same transaction. Return the number of deleted events.
+
+        This is not really race-free, so use with care..."""
+        from .events import AUTOMATIC_EVENT_CLASSES, AUTOMATIC_EVENT_NAMES
+        using = router.db_for_write(Event)
         with _dynamics_map_lock:
-            if self.pk in _dynamics_map:
-                from .dynamics import Dynamics
-                del _dynamics_map[self.pk]
-            for event in Event.objects.filter(turn__game=self):
-                if event.as_child().AUTOMATIC:
-                    event.delete()
+            self.kill_dynamics()
+            try:
+                with transaction.atomic(using=using):
+                    # Automatic events are only referenced by other
+                    # automatic events, so no cascade has to be
+                    # followed: subclass rows go first, then the Event
+                    # ones
+                    for subclass in AUTOMATIC_EVENT_CLASSES:
+                        subclass._base_manager.filter(turn__game=self)._raw_delete(using)
+                    deleted = Event._base_manager.filter(turn__game=self, subclass__in=AUTOMATIC_EVENT_NAMES)._raw_delete(using)
+                    if regenerate:
+                        self.get_dynamics().update()
+            except:
+                self.kill_dynamics()
+                raise
+        return deleted
 
 
     def get_active_players(self):
@@ -335,49 +498,63 @@ class Game(models.Model):
 
     # Loads current_game from json
     def load_from_json(self, data):
-        Player.objects.filter(game=self).delete()
-        Turn.objects.filter(game=self).delete()
+        """Replace the history of the game with the one in data (as
+        written by dump_game()). Rows are inserted in bulk, and all in
+        one transaction: if anything fails, including the dynamics,
+        the game is left as it was."""
         self.kill_dynamics()
         try:
-            for username in data['players']:
-                user = User.objects.get(username=username)
-                player = Player.objects.create(user=user, game=self)
-                player.save()
-
-            # Here we canonicalize the players, so this has to happen after
-            # all users and players have been inserted in the database;
-            # therefore, this loop cannot be merged with the previous one
-            players_map = {None: None}
-            for player in self.get_players():
-                assert player.user.username not in players_map
-                players_map[player.user.username] = player
-
-            # Now we're ready to reply turns and events
-            first_turn = True
-            for turn_data in data['turns']:
-                if not first_turn:
-                    turn = turn.next_turn(must_exist=False)
-                else:
-                    turn = Turn.first_turn(self)
-                    first_turn = False
-
-                turn.begin = parse(turn_data['begin'])
-                turn.end = parse(turn_data['end']) if turn_data['end'] is not None else None
-                turn.save()
-                for event_data in turn_data['events']:
-                    event = Event.from_dict(event_data, players_map)
-                    event.turn = turn
-                    event.save()
-                for comment_data in turn_data['comments']:
-                    comment = Comment.from_dict(comment_data)
-                    comment.turn = turn
-                    comment.save()
-
-            self.get_dynamics().update()
+            with transaction.atomic():
+                Player.objects.filter(game=self).delete()
+                Turn.objects.filter(game=self).delete()
+
+                # All the users, of players and comments, in one query
+                usernames = set(data['players'])
+                for turn_data in data['turns']:
+                    usernames.update(comment_data['user'] for comment_data in turn_data['comments'])
+                users = User.objects.in_bulk(usernames, field_name='username')
+                missing = usernames - set(users)
+                if missing:
+                    raise User.DoesNotExist("Unknown users: %s" % ", ".join(sorted(missing)))
+
+                players = bulk_create_rows(Player, [Player(user=users[username], game=self) for username in data['players']],
+                                           key_fields=('user_id',), game=self)
+                players_map = {None: None}
+                for player in players:
+                    assert player.user.username not in players_map
+                    players_map[player.user.username] = player
+
+                # Now we're ready to reply turns and events
+                turns = []
+                date, phase = FIRST_DATE, FIRST_PHASE
+                for turn_data in data['turns']:
+                    if turns:
+                        phase = PHASE_CYCLE[phase]
+                        if phase == DATE_CHANGE_PHASE:
+                            date += 1
+                    turns.append(Turn(game=self, date=date, phase=phase,
+                                      begin=parse(turn_data['begin']),
+                                      end=parse(turn_data['end']) if turn_data['end'] is not None else None))
+                bulk_create_rows(Turn, turns, key_fields=('date', 'phase'), game=self)
+
+                events = []
+                comments = []
+                for turn, turn_data in zip(turns, data['turns']):
+                    for event_data in turn_data['events']:
+                        event = Event.from_dict(event_data, players_map)
+                        event.turn = turn
+                        events.append(event)
+                    for comment_data in turn_data['comments']:
+                        comment = Comment.from_dict(comment_data, users)
+                        comment.turn = turn
+                        comments.append(comment)
+                bulk_create_events(events)
+                Comment.objects.bulk_create(comments)
+
+                # The dynamics is only built once the history is complete
+                self.get_dynamics().update()
         except:
             self.kill_dynamics()
-            Turn.objects.filter(game=self).delete()
-            self.initialize(get_now())
             raise
 
 # Delete the dynamics object when the game is deleted
@@ -555,6 +732,9 @@ class Profile(models.Model):
     oa = property(get_oa)
 
 
+# The flags of canonical players (alive, active...) are stored by
+# their dynamics in a PlayerStateTable
+@with_player_flags
 class Player(models.Model):
     AURA_COLORS = (
         (WHITE, 'White'),
@@ -644,15 +824,19 @@ class Player(models.Model):
     team_as_italian_string_property = property(team_as_italian_string)
 
 
-    def can_use_power(self):
-        if self.game.is_over:
+    def can_use_power(self, dynamics=None, current_turn=None):
+        if dynamics is None:
+            dynamics = self.game.get_dynamics()
+        if current_turn is None:
+            current_turn = self.game.current_turn
+        if dynamics.over:
             # The game has ended
             return False
-        if self.game.current_turn is None:
+        if current_turn is None:
             # The current turn has not been set -- this shouldn't happen if Game is running
             return False
 
-        canonical = self.canonicalize()
+        canonical = self.canonicalize(dynamics)
 
         if canonical.role is None:
             # The role has not been set -- this shouldn't happen if Game is running
@@ -662,12 +846,11 @@ class Player(models.Model):
             # The player has been exiled
             return False
 
-        turn = self.game.current_turn
-        if turn.phase != NIGHT:
+        if current_turn.phase != NIGHT:
             # Players can use their powers only during the night
             return False
 
-        return canonical.power.can_use_power()
+        return canonical.power.can_use_power(current_turn)
     can_use_power.boolean = True
 
     def get_power(self):
@@ -689,24 +872,20 @@ class Player(models.Model):
         return self.canonicalize().is_mystic
     is_mystic.boolean = True
 
-    def alive(self):
-        return self.canonicalize().alive
-    alive.boolean = True
-
-    def active(self):
-        return self.canonicalize().active
-    active.boolean = True
 
-
-    def can_vote(self):
-        if self.game.is_over:
+    def can_vote(self, dynamics=None, current_turn=None):
+        if dynamics is None:
+            dynamics = self.game.get_dynamics()
+        if current_turn is None:
+            current_turn = self.game.current_turn
+        if dynamics.over:
             # The game is over
             return False
-        if self.game.current_turn is None:
+        if current_turn is None:
             # The current turn has not been set -- this shouldn't happen if Game is running
             return False
 
-        canonical = self.canonicalize()
+        canonical = self.canonicalize(dynamics)
 
         if not canonical.active:
             # The player has been exiled
@@ -715,8 +894,7 @@ class Player(models.Model):
             # The player is dead
             return False
 
-        turn = self.game.current_turn
-        if turn.phase != DAY:
+        if current_turn.phase != DAY:
             # Players can vote only during the day
             return False
 
@@ -743,6 +921,49 @@ class Player(models.Model):
         return self.pk == appointed_mayor.pk
     is_appointed_mayor.boolean = True
 
+class PlayerStatus(models.Model):
+    # Status of a player at the end of a turn (or the latest one, for
+    # the current turn), written by the dynamics each time it changes
+    # so that it can be read without replaying the game
+
+    turn = models.ForeignKey(Turn, on_delete=models.CASCADE)
+    player = models.ForeignKey(Player, on_delete=models.CASCADE)
+    alive = models.BooleanField()
+    active = models.BooleanField()
+    role = RoleField(null=True)
+    team = models.CharField(max_length=1, choices=Player.TEAMS, null=True)
+    aura = models.CharField(max_length=1, choices=Player.AURA_COLORS, null=True)
+    mayor = models.BooleanField()
+    appointed_mayor = models.BooleanField()
+
+    # The fields describing the status, in the order used by
+    # get_status() and as_tuple()
+    STATUS_FIELDS = ('alive', 'active', 'role', 'team', 'aura', 'mayor', 'appointed_mayor')
+
+    class Meta:
+        ordering = ['turn__date', 'turn__phase', 'player']
+        unique_together = ['turn', 'player']
+
+    @staticmethod
+    def get_status(player, dynamics):
+        """Return the status of the canonical player in dynamics, as
+        a tuple of the values of STATUS_FIELDS."""
+        return (
+            player.alive,
+            player.active,
+            player.role.__class__ if player.role is not None else None,
+            player.team,
+            player.aura,
+            player is dynamics.mayor,
+            player is dynamics.appointed_mayor,
+        )
+
+    def as_tuple(self):
+        return tuple(getattr(self, field) for field in PlayerStatus.STATUS_FIELDS)
+
+    def __str__(self):
+        return "%s %s" % (self.turn_id, self.player_id)
+
 class GameMaster(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     game = models.ForeignKey(Game, on_delete=models.CASCADE)
@@ -793,7 +1014,8 @@ class Event(KnowsChild):
             return u"%s" % self.subclass
 
     def is_automatic(self):
-        return self.as_child().AUTOMATIC
+        from .events import AUTOMATIC_EVENT_NAMES
+        return self.subclass in AUTOMATIC_EVENT_NAMES
     is_automatic.boolean = True
 
     def apply(self, dynamics):
@@ -863,10 +1085,11 @@ class Comment(models.Model):
         }
 
     @staticmethod
-    def from_dict(data):
+    def from_dict(data, users=None):
+        # users, if given, maps usernames to already fetched users
         return Comment(
             timestamp=parse(data['timestamp']),
-            user=User.objects.get(username=data['user']),
+            user=users[data['user']] if users is not None else User.objects.get(username=data['user']),
             text=data['text'],
             visible=data['visible'],
             turn=None
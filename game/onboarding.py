@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.apps import apps
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from .constants import *
+from .models import Profile, Player
+
+# Password given to users listed without one
+DEFAULT_PASSWORD = 'ciaociao'
+
+# Processes used to hash passwords; with at most one, they are hashed
+# in the calling process
+HASHING_WORKERS = 4
+
+
+class OnboardingError(Exception):
+    pass
+
+
+def parse_users_tsv(lines):
+    """Read the users to be created from lines in the format
+    "Name Surname<TAB>email<TAB>username<TAB>gender[<TAB>password]",
+    skipping empty lines. Return a list of dicts with keys
+    first_name, last_name, email, username, gender and password."""
+    users = []
+    for number, line in enumerate(lines, start=1):
+        line = line.rstrip('\r\n')
+        if line.strip() == '':
+            continue
+        fields = line.split('\t')
+        if len(fields) not in [4, 5]:
+            raise OnboardingError("Line %d: expected 4 or 5 fields, found %d" % (number, len(fields)))
+        name, email, username, gender = [field.strip() for field in fields[:4]]
+        password = fields[4] if len(fields) == 5 else DEFAULT_PASSWORD
+        if ' ' not in name:
+            raise OnboardingError("Line %d: name %r has no surname" % (number, name))
+        if gender not in [MALE, FEMALE]:
+            raise OnboardingError("Line %d: gender must be %s or %s, found %r" % (number, MALE, FEMALE, gender))
+        first_name, last_name = name.split(' ', 1)
+        users.append({
+            'first_name': first_name,
+            'last_name': last_name,
+            'email': email,
+            'username': username,
+            'gender': gender,
+            'password': password,
+        })
+    return users
+
+def _init_worker():
+    if not apps.ready:
+        django.setup()
+
+def hash_passwords(passwords, workers=HASHING_WORKERS):
+    """Return the hashes of passwords (in the same order), as
+    make_password() computes them, spreading the work over a pool of
+    workers processes."""
+    passwords = list(passwords)
+    if workers <= 1 or len(passwords) <= 1:
+        return [make_password(password) for password in passwords]
+    workers = min(workers, len(passwords))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        return list(executor.map(make_password, passwords, chunksize=max(1, len(passwords) // (4 * workers))))
+
+def create_users(users, game=None, workers=HASHING_WORKERS):
+    """Create a User and its Profile for each of users (dicts as
+    returned by parse_users_tsv(); the password may be None for an
+    unusable one) and, if game is given, a Player in game. Passwords
+    are hashed beforehand, then everything is written in a single
+    transaction, with one query per table. Return the new users, in
+    the given order."""
+    usernames = [user['username'] for user in users]
+    duplicates = sorted(set(username for username in usernames if usernames.count(username) > 1))
+    if duplicates:
+        raise OnboardingError("Repeated usernames: %s" % ', '.join(duplicates))
+
+    passwords = [user['password'] for user in users if user['password'] is not None]
+    hashes = iter(hash_passwords(passwords, workers=workers))
+
+    new_users = []
+    for user in users:
+        new_user = User(username=user['username'], first_name=user['first_name'], last_name=user['last_name'], email=user['email'])
+        if user['password'] is not None:
+            new_user.password = next(hashes)
+        else:
+            new_user.set_unusable_password()
+        new_users.append(new_user)
+
+    with transaction.atomic():
+        existing = sorted(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+        if existing:
+            raise OnboardingError("Users already existing: %s" % ', '.join(existing))
+        User.objects.bulk_create(new_users)
+
+        # Not every database returns the primary keys of bulk inserts
+        pks = dict(User.objects.filter(username__in=usernames).values_list('username', 'pk'))
+        for new_user in new_users:
+            new_user.pk = pks[new_user.username]
+
+        Profile.objects.bulk_create([Profile(user=new_user, gender=user['gender']) for new_user, user in zip(new_users, users)])
+        if game is not None:
+            Player.objects.bulk_create([Player(user=new_user, game=game) for new_user in new_users])
+
+    if game is not None:
+        game.kill_dynamics()
+
+    return new_users
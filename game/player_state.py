@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+from itertools import compress
+
+# Boolean state of the players, kept by the dynamics in a
+# PlayerStateTable instead of in the attributes of each player
+PLAYER_FLAGS = (
+    'alive',
+    'active',
+    'disqualified',
+    'specter',
+    'protected_by_guard',
+    'protected_by_keeper',
+    'temp_dehypnotized',
+    'just_dead',
+    'just_ghostified',
+    'just_transformed',
+    'just_resurrected',
+    'has_permanent_amnesia',
+    'has_confusion',
+    'cooldown',
+)
+
+
+class PlayerStateTable:
+    """Boolean state of the players of a dynamics, stored by column:
+    each flag is a bytearray holding one byte (0 or 1) per player,
+    indexed by the ordinal of the player in dynamics.players.
+
+    Players attached to the table keep reading and writing their flags
+    as attributes (see PlayerFlag), while the dynamics can reset a flag
+    for everybody or select the players with some flags set without
+    looking at them one at a time."""
+
+    def __init__(self, size):
+        self.size = size
+        self.columns = dict((flag, bytearray(size)) for flag in PLAYER_FLAGS)
+
+    def copy(self):
+        table = PlayerStateTable.__new__(PlayerStateTable)
+        table.size = self.size
+        table.columns = dict((flag, bytearray(column)) for flag, column in self.columns.items())
+        return table
+
+    def attach(self, player, ordinal):
+        player.state_table = self
+        player.state_ordinal = ordinal
+
+    def reset(self, flag, value=False):
+        """Set flag to value for all the players."""
+        column = self.columns[flag]
+        column[:] = (b'\x01' if value else b'\x00') * self.size
+
+    def mask(self, **flags):
+        """Return a bytes object with a nonzero byte for the players
+        whose flags have the given values (for example, alive=True,
+        active=True). Columns are combined as big integers, so the
+        work does not grow with the number of players in Python."""
+        ones = int.from_bytes(b'\x01' * self.size, 'little')
+        result = ones
+        for flag, value in flags.items():
+            column = int.from_bytes(self.columns[flag], 'little')
+            result &= column if value else column ^ ones
+        return result.to_bytes(self.size, 'little')
+
+    def select(self, players, **flags):
+        """Return the players (given in ordinal order) whose flags
+        have the given values."""
+        return list(compress(players, self.mask(**flags)))
+
+    def count(self, **flags):
+        return self.mask(**flags).count(1)
+
+
+class PlayerFlag:
+    """Attribute of Player reading and writing a flag of the
+    PlayerStateTable the player is attached to. Players that are not
+    attached to a table (the ones that are not canonical) keep their
+    flags in their own attributes, if they were ever given; otherwise
+    the flags are read from the canonical player."""
+
+    def __init__(self, flag):
+        self.flag = flag
+
+    def __get__(self, player, owner=None):
+        if player is None:
+            return self
+        state = player.__dict__
+        if 'state_table' in state:
+            return state['state_table'].columns[self.flag][state['state_ordinal']] == 1
+        if self.flag in state:
+            return state[self.flag]
+        if state.get('canonical'):
+            raise AttributeError(self.flag)
+        canonical = player.canonicalize()
+        if canonical is player:
+            raise AttributeError(self.flag)
+        return getattr(canonical, self.flag)
+
+    def __set__(self, player, value):
+        state = player.__dict__
+        if 'state_table' in state:
+            state['state_table'].columns[self.flag][state['state_ordinal']] = 1 if value else 0
+        else:
+            state[self.flag] = value
+
+
+def with_player_flags(cls):
+    """Class decorator giving Player a PlayerFlag for each flag."""
+    for flag in PLAYER_FLAGS:
+        setattr(cls, flag, PlayerFlag(flag))
+    return cls
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+from django.db import connection
+
+# Handed out when profiling is disabled, so that hooks cost nothing
+NO_SECTION = nullcontext()
+
+
+class SectionStats:
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.queries = 0
+
+    def add(self, seconds, queries):
+        self.calls += 1
+        self.seconds += seconds
+        self.queries += queries
+
+    def get_milliseconds(self):
+        return self.seconds * 1000
+    milliseconds = property(get_milliseconds)
+
+
+class DynamicsProfiler:
+    """Collect wall time and number of queries of the main steps of a
+    Dynamics, both per turn and over the whole dynamics. Steps nested
+    in other steps are counted in the enclosing ones as well."""
+
+    def __init__(self):
+        self.turns = OrderedDict()
+        self.total = {}
+
+    @contextmanager
+    def section(self, turn, name):
+        queries = [0]
+        def count_query(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(count_query):
+                yield
+        finally:
+            elapsed = time.perf_counter() - start
+            for sections in [self.turns.setdefault(turn, {}), self.total]:
+                sections.setdefault(name, SectionStats()).add(elapsed, queries[0])
+
+    @staticmethod
+    def _sorted(sections):
+        return sorted(sections.items(), key=lambda x: x[1].seconds, reverse=True)
+
+    def get_turn_rows(self):
+        return [(turn, self._sorted(sections)) for turn, sections in self.turns.items()]
+    turn_rows = property(get_turn_rows)
+
+    def get_total_rows(self):
+        return self._sorted(self.total)
+    total_rows = property(get_total_rows)
+
+
+def profiled(method):
+    """Profile a method of Dynamics, if the dynamics has a profiler."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.profiler is None:
+            return method(self, *args, **kwargs)
+        with self.profiler.section(self.current_turn, method.__name__):
+            return method(self, *args, **kwargs)
+
+    return wrapper
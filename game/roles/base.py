@@ -3,6 +3,13 @@ from ..constants import *
 import sys
 from importlib import import_module
 
+# Roles by their string id (see Role.as_string()), filled as they are
+# looked up and by the ruleset registry
+_ROLES_BY_ID = {}
+
+def register_role(role_id, role):
+    _ROLES_BY_ID[role_id] = role
+
 # Special Rules
 class Rules():
     teams = [POPOLANI, LUPI, NEGROMANTI]
@@ -93,8 +100,13 @@ class Role(object):
 
     @staticmethod
     def get_from_string(role_id_str):
-        package, class_name = role_id_str.split('.')
-        return getattr(import_module('game.roles.' + package), class_name)
+        try:
+            return _ROLES_BY_ID[role_id_str]
+        except KeyError:
+            package, class_name = role_id_str.split('.')
+            role = getattr(import_module('game.roles.' + package), class_name)
+            register_role(role_id_str, role)
+            return role
 
     def get_disambiguated_name(self):
         if self.disambiguation_label is not None:
@@ -103,8 +115,10 @@ class Role(object):
             return self.name
     disambiguated_name = property(get_disambiguated_name)
 
-    def can_use_power(self):
-        if not self.can_act_first_night and self.player.game.current_turn.full_days_from_start() == 0:
+    def can_use_power(self, current_turn=None):
+        if current_turn is None:
+            current_turn = self.player.game.current_turn
+        if not self.can_act_first_night and current_turn.full_days_from_start() == 0:
             return False
 
         if self.player.cooldown:
@@ -115,7 +129,7 @@ class Role(object):
         elif self.frequency == EVERY_NIGHT:
             return True
         elif self.frequency == EVERY_OTHER_NIGHT:
-            return self.last_usage is None or self.days_from_last_usage() >= 2
+            return self.last_usage is None or self.days_from_last_usage(current_turn) >= 2
         elif self.frequency == ONCE_A_GAME:
             return self.last_usage is None
         else:
@@ -141,12 +155,7 @@ class Role(object):
 
     def get_targets_role_class(self, dynamics):
         '''Returns a set of possible role class targets.'''
-        return {
-            ALIVE: {x for x in dynamics.valid_roles if not x.dead_power},
-            DEAD: {x for x in dynamics.valid_roles if x.ghost},
-            EVERYBODY: {x for x in dynamics.valid_roles},
-            None: None
-        }[self.targets_role_class]
+        return dynamics.ruleset_roles.get_targets(self.targets_role_class)
 
     def get_target_role_class_default(self, dynamics):
         '''Returns a role which acts as None.'''
@@ -154,19 +163,15 @@ class Role(object):
 
     def get_targets_multiple_role_class(self, dynamics):
         '''Returns a set of possible multiple role class targets.'''
-        return {
-            ALIVE: {x for x in dynamics.valid_roles if not x.dead_power},
-            DEAD: {x for x in dynamics.valid_roles if x.ghost},
-            EVERYBODY: {x for x in dynamics.valid_roles},
-            None: None
-        }[self.targets_multiple_role_class]
+        return dynamics.ruleset_roles.get_targets(self.targets_multiple_role_class)
 
 
-    def days_from_last_usage(self):
+    def days_from_last_usage(self, current_turn=None):
         if self.last_usage is None:
             return None
-        else:
-            return self.player.game.current_turn.date - self.last_usage.date
+        if current_turn is None:
+            current_turn = self.player.game.current_turn
+        return current_turn.date - self.last_usage.date
 
     def unrecord_targets(self):
         self.recorded_target = None
@@ -178,34 +183,31 @@ class Role(object):
     def apply_usepower(self, dynamics, event):
         # First checks
         assert event.player.pk == self.player.pk
-        assert self.can_use_power(), "Il %s %s ha tentato di usare il suo potere quando non poteva farlo." % (event.player.power.name, event.player.full_name)
+        assert self.can_use_power(dynamics.current_turn), "Il %s %s ha tentato di usare il suo potere quando non poteva farlo." % (event.player.power.name, event.player.full_name)
+        options = dynamics.get_target_options(self)
 
         # Check target validity
-        targets = self.get_targets(dynamics)
-        if targets is None:
+        if options.targets is None:
             assert event.target is None
         else:
-            assert event.target is None or event.target in targets, (event.target, targets, event, event.player, event.player.power)
+            assert event.target is None or options.is_valid_target(event.target), (event.target, options.targets, event, event.player, event.player.power)
 
         # Check target2 validity
-        targets2 = self.get_targets2(dynamics)
-        if targets2 is None:
+        if options.targets2 is None:
             assert event.target2 is None, event.player.power
         else:
-            assert event.target2 is None or event.target2 in targets2
+            assert event.target2 is None or options.is_valid_target2(event.target2)
 
         # Check target_role_class and target_multiple_role_class validity
-        targets_role_class = self.get_targets_role_class(dynamics)
-        targets_multiple_role_class = self.get_targets_multiple_role_class(dynamics)
-        if targets_role_class is None:
+        if options.role_classes is None:
             assert event.role_class is None
         else:
-            assert event.role_class is None or event.role_class in targets_role_class, (event.role_class, targets_role_class)
+            assert event.role_class is None or event.role_class in options.role_classes, (event.role_class, options.role_classes)
 
-        if targets_multiple_role_class is None:
+        if options.multiple_role_classes is None:
             assert event.multiple_role_class is None
         else:
-            assert event.multiple_role_class is None or event.multiple_role_class.issubset(targets_multiple_role_class)
+            assert event.multiple_role_class is None or event.multiple_role_class.issubset(options.multiple_role_classes)
 
         # Record targets and command
         self.recorded_target = event.target
@@ -254,6 +256,44 @@ class Role(object):
         description of the problem."""
         return False
 
+class TargetOptions:
+    '''Possible targets of a power in a given state of the dynamics.
+
+    They are computed once (see Dynamics.get_target_options()) and then
+    shared by the command form, its validation and the application of
+    the command. Players are also indexed by pk, so that checking a
+    target does not require scanning the lists.'''
+
+    def __init__(self, power, dynamics):
+        self.targets = self._freeze_players(power.get_targets(dynamics))
+        self.targets2 = self._freeze_players(power.get_targets2(dynamics))
+        self.role_classes = self._freeze_roles(power.get_targets_role_class(dynamics))
+        self.role_class_default = power.get_target_role_class_default(dynamics)
+        self.multiple_role_classes = self._freeze_roles(power.get_targets_multiple_role_class(dynamics))
+        self.targets_pks = self._pks(self.targets)
+        self.targets2_pks = self._pks(self.targets2)
+
+    @staticmethod
+    def _freeze_players(players):
+        return tuple(players) if players is not None else None
+
+    @staticmethod
+    def _freeze_roles(roles):
+        return frozenset(roles) if roles is not None else None
+
+    @staticmethod
+    def _pks(players):
+        if players is None:
+            return None
+        # None is a legitimate choice for some powers
+        return frozenset(player.pk if player is not None else None for player in players)
+
+    def is_valid_target(self, player):
+        return (player.pk if player is not None else None) in self.targets_pks
+
+    def is_valid_target2(self, player):
+        return (player.pk if player is not None else None) in self.targets2_pks
+
 class NoPower(Role):
     name = "Nessuno"
     priority = USELESS
@@ -306,7 +346,10 @@ class Divinatore(Role):
 
     def needs_soothsayer_propositions(self, dynamics=None):
         from ..events import SoothsayerModelEvent
-        events = SoothsayerModelEvent.objects.filter(soothsayer=self.player)
+        if dynamics is not None:
+            events = dynamics.source.filter_events(SoothsayerModelEvent, soothsayer=self.player)
+        else:
+            events = SoothsayerModelEvent.objects.filter(soothsayer=self.player)
         if len([ev for ev in events if ev.target == ev.soothsayer]) > 0:
             return KNOWS_ABOUT_SELF
         if len(events) != 4:
@@ -749,8 +792,7 @@ class Negromante(Role):
     targets = DEAD
 
     def get_targets_role_class(self, dynamics):
-        powers = {x for x in dynamics.valid_roles if x.ghost}
-        available_powers = powers - dynamics.used_ghost_powers
+        available_powers = dynamics.ruleset_roles.ghost_roles - dynamics.used_ghost_powers
         return available_powers
 
     def pre_apply_dawn(self, dynamics):
@@ -0,0 +1,45 @@
+from ..constants import *
+from .base import Role, register_role
+
+from importlib import import_module
+from inspect import isclass
+
+RULESETS = ['v1', 'v2', 'v2_2']
+
+class RulesetRoles:
+    '''The roles of a ruleset, with the sets of them used to validate
+    commands, computed once when the module is imported.'''
+
+    def __init__(self, name):
+        module = import_module('game.roles.' + name)
+        self.name = name
+        self.rules_class = module.Rules
+
+        # Only the roles defined by the ruleset, not the ones it imports
+        roles = [value for value in vars(module).values() if isclass(value) and issubclass(value, Role) and value.__module__ == module.__name__]
+        roles.sort(key=lambda x: (TEAMS.index(x.team), x.name))
+        self.roles = tuple(roles)
+        self.all_roles = frozenset(roles)
+        self.alive_roles = frozenset(x for x in roles if not x.dead_power)
+        self.ghost_roles = frozenset(x for x in roles if x.ghost)
+        self.role_ids = dict((role, role.as_string()) for role in roles)
+        for role, role_id in self.role_ids.items():
+            register_role(role_id, role)
+
+        self.targets = {
+            ALIVE: self.alive_roles,
+            DEAD: self.ghost_roles,
+            EVERYBODY: self.all_roles,
+            None: None,
+        }
+
+    def get_targets(self, targets):
+        '''Return the roles that can be chosen by a power whose
+        targets_role_class (or targets_multiple_role_class) is
+        targets.'''
+        return self.targets[targets]
+
+RULESET_ROLES = dict((name, RulesetRoles(name)) for name in RULESETS)
+
+def get_ruleset_roles(name):
+    return RULESET_ROLES[name]
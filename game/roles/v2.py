@@ -54,7 +54,10 @@ class Divinatore(Divinatore):
 
     def needs_soothsayer_propositions(self, dynamics=None):
         from ..events import SoothsayerModelEvent
-        events = SoothsayerModelEvent.objects.filter(soothsayer=self.player)
+        if dynamics is not None:
+            events = dynamics.source.filter_events(SoothsayerModelEvent, soothsayer=self.player)
+        else:
+            events = SoothsayerModelEvent.objects.filter(soothsayer=self.player)
         if len([ev for ev in events if ev.target == ev.soothsayer]) > 0:
             return KNOWS_ABOUT_SELF
         if len(events) != 4:
@@ -121,7 +124,7 @@ class Spia(Role):
             isinstance(event, VoteAnnouncedEvent) and
             event.voter == self.recorded_target and
             event.type == VOTE and
-            event.turn == dynamics.current_turn.prev_turn().prev_turn()
+            event.turn == dynamics.turns[-3]
         ]
         assert len(votes) <= 1
         if votes:
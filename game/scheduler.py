@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import logging
+from threading import Thread, Event as ThreadEvent, Lock
+
+from django.db import close_old_connections
+
+from .models import Game
+from .utils import get_now
+
+logger = logging.getLogger(__name__)
+
+# Turn ends can be changed by the game masters from any process, so
+# the scheduler never sleeps longer than this without looking at the
+# database again.
+POLL_INTERVAL = 30.0
+
+# A turn whose end stays in the past (because advancing it failed,
+# for example) must not make the scheduler spin, so it always waits
+# at least this long between two checks.
+MIN_WAIT = 1.0
+
+
+class TurnScheduler:
+    """Advance the turns of all the games at their deadline, so that
+    the first request after the end of a turn does not have to pay
+    for the whole dawn or sunset computation.
+
+    Turns are advanced through the usual dynamics of the process the
+    scheduler runs into; the unique constraint on (game, date, phase)
+    guarantees that a turn is never created twice, even if many
+    schedulers (or web workers) reach the deadline at the same
+    time. After a turn is advanced, the preview of the new one is
+    computed as well."""
+
+    def __init__(self, poll_interval=POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.stopping = ThreadEvent()
+
+    def advance_game(self, game):
+        """Bring the dynamics of game up to date, advancing its turn if
+        the end has passed, and warm up the preview of the new turn.
+        Return the end of the current turn (or None)."""
+        dynamics = game.get_dynamics()
+        if dynamics is None:
+            logger.error("Cannot advance game %s, its dynamics failed", game.name)
+            return None
+        # Not lazy: the end of the turn might have just been changed
+        dynamics.update()
+        if dynamics.current_turn is None or dynamics.over:
+            return None
+        # The preview is dropped whenever a new turn is received
+        if dynamics.preview_dynamics is None:
+            logger.info("Warming up preview of game %s at turn %r", game.name, dynamics.current_turn)
+            dynamics.get_preview_dynamics()
+        return dynamics.current_turn.end
+
+    def run_once(self):
+        """Advance all the games whose deadline has passed and return
+        the number of seconds to wait before the next check (at least
+        MIN_WAIT)."""
+        close_old_connections()
+        timeout = self.poll_interval
+        for game in Game.objects.all():
+            try:
+                end = self.advance_game(game)
+            except Exception:
+                logger.exception("Error while advancing game %s", game.name)
+                continue
+            if end is not None:
+                timeout = min(timeout, (end - get_now()).total_seconds())
+        return max(MIN_WAIT, timeout)
+
+    def run(self):
+        logger.info("Turn scheduler started")
+        while not self.stopping.is_set():
+            try:
+                timeout = self.run_once()
+            except Exception:
+                logger.exception("Error in turn scheduler")
+                timeout = self.poll_interval
+            self.stopping.wait(timeout)
+        logger.info("Turn scheduler stopped")
+
+    def stop(self):
+        self.stopping.set()
+
+
+_scheduler = None
+_scheduler_lock = Lock()
+
+def start_turn_scheduler(poll_interval=POLL_INTERVAL):
+    """Run a TurnScheduler in a daemon thread of the current process
+    (at most one per process), so that the dynamics it keeps warm are
+    the same used to serve requests."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = TurnScheduler(poll_interval)
+            Thread(target=_scheduler.run, name='turn-scheduler', daemon=True).start()
+        return _scheduler
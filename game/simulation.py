@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import multiprocessing
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+from threading import Lock
+
+from dateutil.parser import parse
+
+import django
+
+from .constants import *
+from .dynamics import Dynamics
+from .events import CommandEvent, PowerOutcomeEvent
+from .models import game_dump_data
+from .my_random import WichmannHill
+from .utils import get_now
+
+# Most sets of alternative commands compared at once
+MAX_ALTERNATIVES = 4
+
+# Processes used to run simulations; with at most one, they run in
+# the calling process
+SIMULATION_WORKERS = 4
+
+# Seconds a page waits for the simulations it asked for
+SIMULATION_TIMEOUT = 30
+
+# Number of distinct states WichmannHill.seed() can give
+WICHMANN_HILL_STATES = 27814431486576
+
+# Seeds given to each job of a Monte Carlo estimate
+SEEDS_PER_JOB = 250
+
+
+## Simulation steps, working on a fork of a dynamics read from a
+## MemoryEventSource (so that nothing is ever written)
+
+def add_commands(dynamics, commands):
+    """Give dynamics the commands (dicts in the format of
+    CommandEvent.to_dict(), with 'type' defaulting to 'UsePower' and
+    without timestamp) after the ones it already received. Return
+    the commands that were rejected."""
+    source = dynamics.source
+    turn = dynamics.current_turn
+    timestamp = max(dynamics.last_timestamp_in_turn, turn.begin)
+    rejected = []
+    for command_data in commands:
+        data = {'type': 'UsePower', 'target': None, 'target2': None, 'role_class': None, 'multiple_role_class': None}
+        data.update(command_data)
+        command = CommandEvent()
+        command.load_from_dict(data, source.players_map)
+        timestamp += timedelta(microseconds=1)
+        command.timestamp = timestamp
+        command.turn = turn
+        if not command.validate(dynamics):
+            rejected.append(command_data)
+            continue
+        source.save_event(command)
+    dynamics.update()
+    return rejected
+
+def enter_next_turn(dynamics, end):
+    """End the current turn of dynamics at end (or just after its
+    last event) and enter the following one. Return what happened,
+    see describe_outcome()."""
+    turn = dynamics.current_turn
+    end = max(end, dynamics.last_timestamp_in_turn, turn.begin)
+    alive_before = set(player.pk for player in dynamics.players if player.alive)
+    first = len(dynamics.events)
+    next_turn = dynamics.source.append_turn(end)
+    dynamics.update()
+    events = [event for event in dynamics.events[first:] if event.turn is next_turn]
+    return describe_outcome(dynamics, events, alive_before)
+
+def describe_outcome(dynamics, events, alive_before):
+    """Summarize, with plain data that can be sent across processes,
+    the events generated while entering a turn: the messages for the
+    GMs, who died, who is the mayor, which powers succeeded and who
+    won (players are given by username)."""
+    messages = [event.to_player_string('admin') for event in events]
+    return {
+        'messages': [message for message in messages if message],
+        'dead': sorted(player.user.username for player in dynamics.players if player.pk in alive_before and not player.alive),
+        'mayor': dynamics.mayor.user.username if dynamics.mayor is not None else None,
+        'powers': dict((event.player.user.username, event.success) for event in events if isinstance(event, PowerOutcomeEvent)),
+        'winners': sorted(dynamics.winners) if dynamics.over and dynamics.winners is not None else None,
+    }
+
+def simulate_commands(dynamics, commands, end):
+    """Add commands to dynamics and enter the following turn. Return
+    the outcome, along with the rejected commands."""
+    rejected = add_commands(dynamics, commands)
+    outcome = enter_next_turn(dynamics, end)
+    outcome['rejected'] = rejected
+    return outcome
+
+
+## Running simulations, possibly in parallel
+
+# Pools of worker processes, by number of workers, shared by all the
+# simulations run by this process. Workers are started by a fork
+# server rather than forked from a (possibly threaded) web server,
+# and set up Django themselves
+_executors = {}
+_executors_lock = Lock()
+
+# The last game replayed by a worker process, along with the key of
+# its data, forked for each job
+_worker_dynamics = (None, None)
+
+def _get_executor(workers):
+    with _executors_lock:
+        if workers not in _executors:
+            _executors[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'), initializer=django.setup)
+        return _executors[workers]
+
+def _run_job(job):
+    global _worker_dynamics
+    key, data, function, args = job
+    if _worker_dynamics[0] != key:
+        _worker_dynamics = (key, Dynamics.from_dump(data))
+    return function(_worker_dynamics[1].fork(), *args)
+
+def simulate_seeds(dynamics, seeds, commands, end):
+    """Add commands to dynamics, then enter the following turn once
+    for each seed, with the random generator seeded by it. Return
+    how many times each outcome happened (see merge_frequencies())."""
+    assert dynamics.random is not None, "The game has no seed yet"
+    add_commands(dynamics, commands)
+    frequencies = empty_frequencies()
+    for seed in seeds:
+        fork = dynamics.fork()
+        fork.random.seed(seed)
+        count_outcome(frequencies, enter_next_turn(fork, end))
+    return frequencies
+
+def empty_frequencies():
+    return {'runs': 0, 'dead': Counter(), 'mayor': Counter(), 'powers': Counter(), 'powers_used': Counter(), 'winners': Counter()}
+
+def count_outcome(frequencies, outcome):
+    frequencies['runs'] += 1
+    frequencies['dead'].update(outcome['dead'])
+    frequencies['mayor'][outcome['mayor']] += 1
+    frequencies['powers_used'].update(outcome['powers'].keys())
+    frequencies['powers'].update(username for username, success in outcome['powers'].items() if success)
+    if outcome['winners'] is not None:
+        frequencies['winners'][' '.join(outcome['winners'])] += 1
+
+def merge_frequencies(results):
+    """Add up the outcome counts returned by simulate_seeds(). For
+    each player, 'dead' counts the runs where they died, 'mayor' the
+    ones where they ended up mayor (None if there was no mayor),
+    'powers_used' and 'powers' the ones where their power was used
+    and succeeded; 'winners' counts the runs ending the game, by
+    winning teams."""
+    frequencies = empty_frequencies()
+    for result in results:
+        frequencies['runs'] += result['runs']
+        for key in ['dead', 'mayor', 'powers', 'powers_used', 'winners']:
+            frequencies[key].update(result[key])
+    return frequencies
+
+def run_simulations(data, function, jobs, workers=SIMULATION_WORKERS, timeout=None):
+    """Call function(dynamics, *args) for each args in jobs, where
+    dynamics is a fresh fork of the game replayed in memory from data
+    (as returned by game_dump_data()), and return the results in the
+    same order. The game is replayed at most once per process, which
+    keeps it for the following simulations of the same data; function
+    must be defined at module level, and both its arguments and
+    results must be picklable. If the worker processes do not give
+    all the results within timeout seconds, TimeoutError is raised
+    and the jobs not yet started are cancelled."""
+    if workers <= 1 or len(jobs) <= 1:
+        dynamics = Dynamics.from_dump(data)
+        return [function(dynamics.fork(), *args) for args in jobs]
+    key = hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+    jobs = [(key, data, function, tuple(args)) for args in jobs]
+    executor = _get_executor(workers)
+    try:
+        return list(executor.map(_run_job, jobs, timeout=timeout, chunksize=max(1, len(jobs) // (4 * workers))))
+    except BrokenProcessPool:
+        # A worker died: the next simulations get a new pool
+        with _executors_lock:
+            if _executors.get(workers) is executor:
+                del _executors[workers]
+        raise
+
+def get_simulation_data(game):
+    """Return the data of game to be replayed by simulations, along
+    with the end of its current turn (or now, if it has none)."""
+    data = game_dump_data(game, player_details=True)
+    last_turn = data['turns'][-1]
+    end = parse(last_turn['end']) if last_turn['end'] is not None else get_now()
+    return data, end
+
+def simulate_alternatives(game, alternatives, workers=SIMULATION_WORKERS, timeout=None):
+    """Simulate the end of the current turn of game with each set of
+    alternative commands (see add_commands()) given after the actual
+    ones, without touching the database. Return one outcome for the
+    actual commands followed by one for each alternative (see
+    run_simulations() for timeout)."""
+    assert len(alternatives) <= MAX_ALTERNATIVES
+    data, end = get_simulation_data(game)
+    jobs = [([], end)] + [(commands, end) for commands in alternatives]
+    return run_simulations(data, simulate_commands, jobs, workers=workers, timeout=timeout)
+
+def estimate_outcomes(data, end, runs, commands=None, seed=None, workers=SIMULATION_WORKERS):
+    """Enter the turn following the current one of the game dumped in
+    data runs times, each time with a different state of the random
+    generator, after adding commands (see add_commands()). The states
+    are drawn from a WichmannHill generator seeded with seed, so the
+    estimate can be repeated. Return the outcome frequencies (see
+    merge_frequencies()) and the time it took, in seconds."""
+    if commands is None:
+        commands = []
+    generator = WichmannHill()
+    generator.seed(seed)
+    seeds = [generator.randrange(WICHMANN_HILL_STATES) for i in range(runs)]
+    jobs = [(seeds[i:i + SEEDS_PER_JOB], commands, end) for i in range(0, runs, SEEDS_PER_JOB)]
+    start = time.monotonic()
+    frequencies = merge_frequencies(run_simulations(data, simulate_seeds, jobs, workers=workers))
+    return frequencies, time.monotonic() - start
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import copy
+
+from .constants import *
+
+# Players only see the events of the turns in these phases, while
+# the GMs see every turn
+PLAYER_PHASES = (CREATION, DAWN, SUNSET)
+
+
+def is_turn_visible(turn, pov):
+    """Tell whether the events of turn are shown to pov (a player,
+    'public' or 'admin')."""
+    return pov == 'admin' or turn.phase in PLAYER_PHASES
+
+
+def _copy_power(power, player):
+    if power is None:
+        return power
+    power = copy.copy(power)
+    power.player = player
+    return power
+
+def _copy_player(player, state_table):
+    # Model instances copy their own state, so the copy can be read
+    # while the dynamics keeps modifying the original; flags are read
+    # from a copy of the state table
+    player = copy.copy(player)
+    state_table.attach(player, player.state_ordinal)
+    player.role = _copy_power(player.role, player)
+    player.dead_power = _copy_power(player.dead_power, player)
+    return player
+
+
+class DynamicsSnapshot:
+    """Read-only view of the state of a dynamics, as it was at the end
+    of an update. A snapshot is never modified after being built: the
+    dynamics publishes a new one each time its state changes, so
+    request threads can read the current one without taking any lock
+    and without ever seeing an event applied halfway.
+
+    Players are copies of the canonical players, so that their
+    visible attributes (role, status, votes) stay the ones they had
+    when the snapshot was taken."""
+
+    def __init__(self, dynamics, version):
+        self.version = version
+        self.started = dynamics.random is not None
+        self.over = dynamics.over
+        self.winners = frozenset(dynamics.winners) if dynamics.winners is not None else None
+        self.current_turn = dynamics.current_turn
+        self.turns = tuple(dynamics.turns)
+        self.events = tuple(dynamics.events)
+
+        # Identifies the history seen by the snapshot in any process
+        # (versions are only meaningful inside a process)
+        stored = [event.pk for event in self.events if event.pk is not None]
+        self.history = (len(self.turns), len(self.events), max(stored, default=0))
+
+        self.player_state = dynamics.player_state.copy()
+        self.players = tuple(_copy_player(player, self.player_state) for player in dynamics.players)
+        self.players_dict = dict((player.pk, player) for player in self.players)
+        self.mayor = self.get_canonical_player(dynamics.mayor)
+        self.appointed_mayor = self.get_canonical_player(dynamics.appointed_mayor)
+
+    def __repr__(self):
+        return '<DynamicsSnapshot %d %r>' % (self.version, self.current_turn)
+
+    def get_canonical_player(self, player):
+        if player is None:
+            return None
+        return self.players_dict[player.pk]
+
+    def get_active_players(self):
+        return self.player_state.select(self.players, active=True)
+    active_players = property(get_active_players)
+
+    def get_inactive_players(self):
+        return self.player_state.select(self.players, active=False)
+    inactive_players = property(get_inactive_players)
+
+    def get_alive_players(self):
+        return self.player_state.select(self.players, alive=True, active=True)
+    alive_players = property(get_alive_players)
+
+    def get_dead_players(self):
+        return self.player_state.select(self.players, alive=False, active=True)
+    dead_players = property(get_dead_players)
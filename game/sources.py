@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+import copy
+from contextlib import nullcontext
+
+from dateutil.parser import parse
+
+from django.contrib.auth.models import User
+from django.db import transaction, IntegrityError
+from django.db.models import Q
+
+from .models import Game, Player, PlayerStatus, Profile, Turn, Event
+from .constants import *
+
+
+class EventSource:
+    """Where a Dynamics reads the history of its game (players, turns
+    and events) and where it writes the events it is given. The
+    dynamics never touches the database on its own, so the same
+    engine can run on top of any implementation of this interface."""
+
+    def copy(self):
+        """Return a source suitable for another dynamics of the same
+        game (for example the preview)."""
+        return self
+
+    def get_players(self):
+        """Return the players of the game, sorted by pk."""
+        raise NotImplementedError()
+
+    def first_turn(self):
+        """Return the first turn of the game, or None if it does not
+        exist yet."""
+        raise NotImplementedError()
+
+    def next_turn(self, turn):
+        """Return the turn following turn, or None if it does not
+        exist yet."""
+        raise NotImplementedError()
+
+    def make_next_turn(self, turn):
+        """Build (without storing it) the turn following turn."""
+        phase = PHASE_CYCLE[turn.phase]
+        date = turn.date
+        if phase == DATE_CHANGE_PHASE:
+            date += 1
+        return Turn(game=turn.game, date=date, phase=phase)
+
+    def refresh_turn(self, turn):
+        """Update turn in place with its stored data (its end might
+        have been changed since it was read)."""
+        raise NotImplementedError()
+
+    def reload_turn(self, turn):
+        """Return a fresh copy of the stored turn."""
+        raise NotImplementedError()
+
+    def advance_turn(self, turn):
+        """Create the turn following turn, which has ended. Return
+        True if a new turn is now available."""
+        raise NotImplementedError()
+
+    def get_events(self, turn, timestamp, pk):
+        """Return the events of turn that come after the given
+        timestamp and pk, sorted by timestamp and pk."""
+        raise NotImplementedError()
+
+    def count_events_before(self, turn):
+        """Return the number of events of turn that precede its
+        beginning."""
+        raise NotImplementedError()
+
+    def filter_events(self, event_class, **kwargs):
+        """Return the stored events of class event_class whose
+        attributes match kwargs."""
+        raise NotImplementedError()
+
+    def save_event(self, event):
+        """Store event (its turn and timestamp are already set)."""
+        raise NotImplementedError()
+
+    def save_events(self, events):
+        """Store many events at once, in the order they are given."""
+        for event in events:
+            self.save_event(event)
+
+    def atomic(self):
+        """Return a context manager within which everything stored is
+        rolled back if an exception is raised."""
+        return nullcontext()
+
+    def save_player_statuses(self, turn, statuses):
+        """Store the statuses of the players during turn (a dict from
+        player pk to a tuple as returned by PlayerStatus.get_status()),
+        replacing the ones stored before. Sources that are not read
+        outside of their dynamics keep nothing."""
+        pass
+
+
+class DatabaseEventSource(EventSource):
+    """The game as it is stored in the database."""
+
+    def __init__(self, game):
+        self.game = game
+        # Stored player statuses, by (turn pk, player pk); read the
+        # first time they are needed
+        self.player_statuses = None
+
+    def get_players(self):
+        return list(self.game.player_set.select_related('user').order_by('pk'))
+
+    def first_turn(self):
+        try:
+            return Turn.first_turn(self.game, must_exist=True)
+        except Turn.DoesNotExist:
+            return None
+
+    def next_turn(self, turn):
+        try:
+            return turn.next_turn(must_exist=True)
+        except Turn.DoesNotExist:
+            return None
+
+    def refresh_turn(self, turn):
+        if turn.pk is not None:
+            turn.refresh_from_db()
+
+    def reload_turn(self, turn):
+        return Turn.objects.get(pk=turn.pk)
+
+    def advance_turn(self, turn):
+        self.game.advance_turn(current_turn=turn)
+        return True
+
+    def get_events(self, turn, timestamp, pk):
+        events = Event.objects.filter(turn=turn). \
+            filter(Q(timestamp__gt=timestamp) |
+                   (Q(timestamp__gte=timestamp) & Q(pk__gt=pk))). \
+                   order_by('timestamp', 'pk')
+        result = []
+        for event in events:
+            event = event.as_child()
+            # We already have the turn, no need to ask for it again
+            event.turn = turn
+            result.append(event)
+        return result
+
+    def count_events_before(self, turn):
+        return Event.objects.filter(turn=turn).filter(timestamp__lt=turn.begin).count()
+
+    def filter_events(self, event_class, **kwargs):
+        return list(event_class.objects.filter(**kwargs))
+
+    def save_event(self, event):
+        event.save()
+
+    def save_events(self, events):
+        # A single commit for the whole batch
+        with transaction.atomic():
+            for event in events:
+                event.save()
+
+    def atomic(self):
+        return transaction.atomic()
+
+    def save_player_statuses(self, turn, statuses):
+        if self.player_statuses is None:
+            self.player_statuses = dict(((status.turn_id, status.player_id), status.as_tuple()) for status in PlayerStatus.objects.filter(turn__game=self.game))
+
+        # Replaying a game only writes what differs from the stored
+        # statuses, which is usually nothing
+        changed = [(player_pk, status) for player_pk, status in statuses.items() if self.player_statuses.get((turn.pk, player_pk)) != status]
+        if len(changed) == 0:
+            return
+        stored = [player_pk for player_pk, status in changed if (turn.pk, player_pk) in self.player_statuses]
+        try:
+            with transaction.atomic():
+                if len(stored) > 0:
+                    PlayerStatus.objects.filter(turn=turn, player_id__in=stored).delete()
+                PlayerStatus.objects.bulk_create([PlayerStatus(turn=turn, player_id=player_pk, **dict(zip(PlayerStatus.STATUS_FIELDS, status))) for player_pk, status in changed])
+        except IntegrityError:
+            # The dynamics of another process has just written them
+            self.player_statuses = None
+            return
+        for player_pk, status in changed:
+            self.player_statuses[(turn.pk, player_pk)] = status
+
+
+class MemoryEventSource(EventSource):
+    """A game read from a dump (in the format written by dump_game())
+    and kept in memory: it never performs a query, and the events it
+    is given are kept in memory as well. The game does not go beyond
+    the turns in the dump, unless they are added with
+    append_turn()."""
+
+    def __init__(self, data, game=None):
+        self.data = data
+        if game is None:
+            game = Game(name=data.get('name', 'dump'))
+        self.game = game
+
+        self.players = []
+        players_map = {None: None}
+        for pk, player_data in enumerate(data['players'], start=1):
+            if isinstance(player_data, str):
+                player_data = {'username': player_data}
+            user = User(username=player_data['username'],
+                        first_name=player_data.get('first_name', ''),
+                        last_name=player_data.get('last_name', ''))
+            if 'gender' in player_data:
+                user.profile = Profile(user=user, gender=player_data['gender'])
+            player = Player(pk=pk, user=user, game=game)
+            assert user.username not in players_map
+            players_map[user.username] = player
+            self.players.append(player)
+        self.players_map = players_map
+
+        self.turns = []
+        self.events = {}
+        self.last_event_pk = 0
+        date = FIRST_DATE
+        phase = FIRST_PHASE
+        for pk, turn_data in enumerate(data['turns'], start=1):
+            turn = Turn(pk=pk, game=game, date=date, phase=phase)
+            turn.begin = parse(turn_data['begin'])
+            turn.end = parse(turn_data['end']) if turn_data['end'] is not None else None
+            self.turns.append(turn)
+            self.events[turn.pk] = []
+            for event_data in turn_data['events']:
+                event = Event.from_dict(event_data, players_map)
+                event.turn = turn
+                self.save_event(event)
+
+            phase = PHASE_CYCLE[phase]
+            if phase == DATE_CHANGE_PHASE:
+                date += 1
+
+    def copy(self):
+        # Players and turns are modified by the dynamics using them,
+        # so each dynamics needs its own
+        return MemoryEventSource(self.data, self.game)
+
+    def get_players(self):
+        return list(self.players)
+
+    def first_turn(self):
+        return self.turns[0] if self.turns else None
+
+    def next_turn(self, turn):
+        if turn.pk is None or turn.pk >= len(self.turns):
+            return None
+        return self.turns[turn.pk]
+
+    def refresh_turn(self, turn):
+        pass
+
+    def reload_turn(self, turn):
+        return copy.copy(self.turns[turn.pk - 1])
+
+    def advance_turn(self, turn):
+        return False
+
+    def append_turn(self, end):
+        """End the last turn at end and add the one following it,
+        which has no end, so that a dynamics reading from this source
+        enters it at the next update."""
+        last_turn = self.turns[-1]
+        last_turn.end = end
+        turn = self.make_next_turn(last_turn)
+        turn.pk = len(self.turns) + 1
+        turn.begin = end
+        self.turns.append(turn)
+        self.events[turn.pk] = []
+        return turn
+
+    def get_events(self, turn, timestamp, pk):
+        return [event for event in self.events.get(turn.pk, [])
+                if event.timestamp > timestamp or (event.timestamp >= timestamp and event.pk > pk)]
+
+    def count_events_before(self, turn):
+        return len([event for event in self.events.get(turn.pk, []) if event.timestamp < turn.begin])
+
+    def filter_events(self, event_class, **kwargs):
+        return [event for events in self.events.values() for event in events
+                if isinstance(event, event_class) and all(getattr(event, k) == v for k, v in kwargs.items())]
+
+    def save_event(self, event):
+        event.fill_subclass()
+        self.last_event_pk += 1
+        event.pk = self.last_event_pk
+        events = self.events.setdefault(event.turn.pk, [])
+        events.append(event)
+        events.sort(key=lambda event: (event.timestamp, event.pk))
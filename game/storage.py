@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Files worth compressing; images other than SVG and PDFs already are
+COMPRESSED_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.txt')
+
+# Compressed copies are only kept if they save at least this fraction
+MIN_COMPRESSION_GAIN = 0.05
+
+
+def minify_css(text):
+    """Remove comments and the whitespace that is not needed from a
+    style sheet."""
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.DOTALL)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+    text = text.replace(';}', '}')
+    return text.strip()
+
+def build_bundle(name, sources):
+    """Concatenate sources (a list of strings), minifying them if they
+    are style sheets. Scripts are only concatenated: the big ones are
+    already minified."""
+    if name.endswith('.css'):
+        return '\n'.join(minify_css(source) for source in sources)
+    else:
+        return '\n;\n'.join(sources)
+
+
+class BundledManifestStorage(ManifestStaticFilesStorage):
+    """Static files storage that, while collectstatic runs, builds
+    the bundles listed in settings.STATIC_BUNDLES, gives every file a
+    name containing the hash of its content (so it can be cached
+    forever) and writes gzip (and, if the brotli package is
+    installed, brotli) compressed copies of text files next to them.
+
+    Files that were not collected (for example while developing) are
+    linked by their plain name."""
+
+    # Some templates link files that do not exist
+    manifest_strict = False
+
+    def stored_name(self, name):
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            return name
+
+    def get_bundles(self):
+        return getattr(settings, 'STATIC_BUNDLES', {})
+
+    def post_process(self, paths, dry_run=False, **options):
+        if not dry_run:
+            paths = dict(paths)
+            for name, sources in self.get_bundles().items():
+                contents = []
+                for source in sources:
+                    with self.open(source) as fin:
+                        contents.append(fin.read().decode('utf-8'))
+                if self.exists(name):
+                    self.delete(name)
+                self._save(name, ContentFile(build_bundle(name, contents).encode('utf-8')))
+                paths[name] = (self, name)
+
+        yield from super().post_process(paths, dry_run, **options)
+
+        if not dry_run:
+            for name in set(self.hashed_files.values()):
+                if name.endswith(COMPRESSED_EXTENSIONS):
+                    self.compress(name)
+
+    def compress(self, name):
+        with self.open(name) as fin:
+            content = fin.read()
+        compressed = [('.gz', gzip.compress(content, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            compressed.append(('.br', brotli.compress(content)))
+        for extension, data in compressed:
+            if len(data) <= len(content) * (1 - MIN_COMPRESSION_GAIN):
+                if self.exists(name + extension):
+                    self.delete(name + extension)
+                self._save(name + extension, ContentFile(data))
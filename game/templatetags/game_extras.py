@@ -1,4 +1,9 @@
 from django import template
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.templatetags.static import static
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
 
 register = template.Library()
 
@@ -19,3 +24,20 @@ def order_by_name(the_list, attr=None):
     else:
         key = lambda x: (x.user.last_name, x.user.first_name)
     return sorted(the_list, key=key)
+
+@register.simple_tag
+def static_bundle(name):
+    """Link the static bundle name (see STATIC_BUNDLES): the bundle
+    itself once collectstatic has built it, its sources otherwise (and
+    while debugging, since the bundle is not among the files served
+    by the development server)."""
+    hashed_files = getattr(staticfiles_storage, 'hashed_files', {})
+    if not settings.DEBUG and name in hashed_files:
+        sources = [name]
+    else:
+        sources = settings.STATIC_BUNDLES[name]
+    if name.endswith('.css'):
+        tag = '<link rel="stylesheet" href="%s" />'
+    else:
+        tag = '<script src="%s"></script>'
+    return mark_safe('\n'.join(tag % escape(static(source)) for source in sources))
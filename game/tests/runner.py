@@ -0,0 +1,43 @@
+"""Fast test mode. Run the suite with
+
+    python manage.py test game --testrunner=game.tests.runner.FastTestRunner
+
+Test databases are kept in memory, passwords are hashed with a cheap
+hasher, each test game is cloned from a template instead of replaying
+create_game() from scratch and tests are split among as many
+processes as there are CPUs (pass --parallel to override).
+"""
+
+from django.db import connections
+from django.test.runner import DiscoverRunner, default_test_processes
+from django.test.utils import override_settings
+
+from . import test_utils
+
+class FastTestRunner(DiscoverRunner):
+
+    @classmethod
+    def add_arguments(cls, parser):
+        super().add_arguments(parser)
+        parser.set_defaults(parallel=default_test_processes())
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._fast_hashers = override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+        self._fast_hashers.enable()
+        # Parallel workers are forked after this point, so each of
+        # them fills its own templates
+        test_utils.game_templates = {}
+
+    def teardown_test_environment(self, **kwargs):
+        test_utils.game_templates = None
+        self._fast_hashers.disable()
+        super().teardown_test_environment(**kwargs)
+
+    def setup_databases(self, **kwargs):
+        # Without a test name SQLite keeps the database in memory, and
+        # forking a worker gives it a private copy
+        for connection in connections.all():
+            if connection.vendor == 'sqlite':
+                connection.settings_dict['TEST']['NAME'] = None
+        return super().setup_databases(**kwargs)
@@ -1,12 +1,22 @@
 from functools import wraps
+from django.db import transaction
+
 from game.models import *
 from game.events import *
 from game.constants import *
 from game.utils import get_now, advance_to_time
 import re
 
+import os
 from inspect import isclass
 
+# Templates of the games built by create_game(), indexed by its
+# arguments. They are only kept when running in fast mode (see
+# runner.FastTestRunner); None disables them.
+game_templates = None
+
+TEST_DUMPS_DIR = 'test_dumps'
+
 def delete_auto_users():
     for user in User.objects.all():
         if user.username.startswith('pk'):
@@ -24,6 +34,10 @@ def create_users(n):
     return users
 
 def create_game(seed, ruleset, roles):
+    key = (seed, ruleset, tuple(roles))
+    if game_templates is not None and key in game_templates:
+        return clone_game_template(game_templates[key])
+
     game = Game(name='test')
     game.save()
 
@@ -58,52 +72,130 @@ def create_game(seed, ruleset, roles):
         event.timestamp = first_turn.begin
         game.get_dynamics().inject_event(event)
 
-    return game
+    if game_templates is not None:
+        game_templates[key] = make_game_template(game)
 
-def create_game_from_dump(data, start_moment=None):
-    if start_moment is None:
-        start_moment = get_now()
+    return game
 
-    game = Game()
+def make_game_template(game):
+    """Record what create_game() has just built, so that
+    clone_game_template() can build it again with a handful of
+    queries and a single dynamics update."""
+    def user_data(user):
+        return {'username': user.username,
+                'first_name': user.first_name,
+                'last_name': user.last_name,
+                'email': user.email,
+                'password': user.password,
+                'gender': user.profile.gender if hasattr(user, 'profile') else None}
+
+    events = []
+    for event in Event.objects.filter(turn__game=game).order_by('timestamp', 'pk'):
+        event = event.as_child()
+        if not event.AUTOMATIC:
+            events.append(event.to_dict())
+
+    return {'users': [user_data(player.user) for player in Player.objects.filter(game=game).order_by('pk')],
+            'masters': [user_data(master.user) for master in GameMaster.objects.filter(game=game).order_by('pk')],
+            'events': events}
+
+def clone_game_template(template):
+    game = Game(name='test')
     game.save()
-    game.initialize(start_moment)
-
-    for player_data in data['players']:
-        user = User.objects.create(username=player_data['username'],
-                                   first_name=player_data.get('first_name', ''),
-                                   last_name=player_data.get('last_name', ''),
-                                   password=player_data.get('password', ''),
-                                   email=player_data.get('email', ''))
-        profile = Profile.objects.create(user=user, gender=player_data.get('gender', ''))
-        profile.save()
-        user.save()
-        player = Player.objects.create(user=user, game=game)
-        player.save()
 
-    # Here we canonicalize the players, so this has to happen after
-    # all users and players have been inserted in the database;
-    # therefore, this loop cannot be merged with the previous one
+    # Passwords are already hashed in the template, which is what
+    # makes cloning much cheaper than creating the users
+    users = [User(username=data['username'], first_name=data['first_name'], last_name=data['last_name'],
+                  email=data['email'], password=data['password'])
+             for data in template['users'] + template['masters']]
+    User.objects.bulk_create(users)
+    users = User.objects.in_bulk([user.username for user in users], field_name='username')
+    Profile.objects.bulk_create([Profile(user=users[data['username']], gender=data['gender'])
+                                 for data in template['users'] if data['gender'] is not None])
+    Player.objects.bulk_create([Player(user=users[data['username']], game=game) for data in template['users']])
+
+    game.initialize(get_now())
+    GameMaster.objects.bulk_create([GameMaster(user=users[data['username']], game=game) for data in template['masters']])
+
+    # Events are written straight into the database and then received
+    # all together by the dynamics, as if it was restarted
+    first_turn = game.current_turn
     players_map = {None: None}
     for player in game.get_players():
-        assert player.user.username not in players_map
         players_map[player.user.username] = player
+    for data in template['events']:
+        event = Event.from_dict(data, players_map)
+        event.turn = first_turn
+        event.timestamp = first_turn.begin
+        event.save()
+    game.get_dynamics().update()
 
-    # Now we're ready to reply turns and events
-    first_turn = True
-    for turn_data in data['turns']:
-        if not first_turn:
-            test_advance_turn(game)
-        else:
-            first_turn = False
-        current_turn = game.current_turn
-        for event_data in turn_data['events']:
-            event = Event.from_dict(event_data, players_map)
-            if current_turn.phase in FULL_PHASES:
-                event.timestamp = get_now()
-            else:
-                event.timestamp = current_turn.begin
-            #print >> sys.stderr, "Injecting event of type %s" % (event.subclass)
-            game.get_dynamics().inject_event(event)
+    return game
+
+def test_dump_path(test, name):
+    """Path where test can save the dump called name. The name of the
+    test module is part of the path, so that test suites running in
+    parallel processes never write to the same file."""
+    module = test.__class__.__module__.split('.')[-1]
+    return os.path.join(TEST_DUMPS_DIR, '%s.%s.json' % (module, name))
+
+def save_test_dump(test, game):
+    path = test_dump_path(test, test._name)
+    # Write to a private file first, so that a concurrent reader never
+    # sees a half written dump
+    tmp_path = '%s.%d' % (path, os.getpid())
+    with open(tmp_path, 'w') as fout:
+        dump_game(game, fout)
+    os.replace(tmp_path, path)
+
+def create_game_from_dump(data, start_moment=None):
+    if start_moment is None:
+        start_moment = get_now()
+
+    # Either the whole game is created or nothing is
+    game = Game()
+    try:
+        with transaction.atomic():
+            game.save()
+            game.initialize(start_moment)
+
+            users = bulk_create_rows(User, [User(username=player_data['username'],
+                                                 first_name=player_data.get('first_name', ''),
+                                                 last_name=player_data.get('last_name', ''),
+                                                 password=player_data.get('password', ''),
+                                                 email=player_data.get('email', ''))
+                                            for player_data in data['players']],
+                                  key_fields=('username',), username__in=[player_data['username'] for player_data in data['players']])
+            Profile.objects.bulk_create([Profile(user=user, gender=player_data.get('gender', ''))
+                                         for user, player_data in zip(users, data['players'])])
+            Player.objects.bulk_create([Player(user=user, game=game) for user in users])
+            game.kill_dynamics()
+
+            # Here we canonicalize the players, so this has to happen after
+            # all users and players have been inserted in the database
+            players_map = {None: None}
+            for player in game.get_players():
+                assert player.user.username not in players_map
+                players_map[player.user.username] = player
+
+            # Now we're ready to reply turns and events
+            first_turn = True
+            for turn_data in data['turns']:
+                if not first_turn:
+                    test_advance_turn(game)
+                else:
+                    first_turn = False
+                current_turn = game.current_turn
+                for event_data in turn_data['events']:
+                    event = Event.from_dict(event_data, players_map)
+                    if current_turn.phase in FULL_PHASES:
+                        event.timestamp = get_now()
+                    else:
+                        event.timestamp = current_turn.begin
+                    game.get_dynamics().inject_event(event)
+    except:
+        game.kill_dynamics()
+        raise
 
     return game
 
@@ -148,8 +240,7 @@ class GameTest():
     def tearDown(self):
         # Save a dump of the test game
         # if 'game' in self.__dict__:
-            #with open(os.path.join('test_dumps', '%s.json' % (self._name)), 'w') as fout:
-                #pass #dump_game(self.game, fout)
+            #save_test_dump(self, self.game)
 
         # Destroy the leftover dynamics without showing the slightest
         # sign of mercy
@@ -1,25 +1,36 @@
 import sys
 import datetime
 import json
+import gzip
 import os
 import collections
+import asyncio
+import concurrent.futures
 import pytz
 from functools import wraps
 
 from django.utils import timezone
 
-from django.test import TestCase
+from django.test import TestCase, Client
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 
 from game.models import *
 from game.roles.v1 import *
 from game.events import *
 from game.constants import *
 from game.utils import get_now, advance_to_time
+from game.dynamics import Dynamics, ANCIENT_DATETIME
+from game.scheduler import TurnScheduler, MIN_WAIT
+from game.views import gzip_chunks
 
 from datetime import timedelta, datetime, time
 
-from .test_utils import create_game, delete_auto_users, create_users, create_game_from_dump, test_advance_turn, record_name
+from .test_utils import TEST_DUMPS_DIR, create_game, delete_auto_users, create_users, create_game_from_dump, test_advance_turn, record_name, save_test_dump
 from unittest import skip
+from unittest.mock import patch
+from threading import Thread, Event as ThreadEvent
+from io import StringIO
 
 def create_test_game(seed, roles):
 	return create_game(seed, 'v1', roles)
@@ -32,8 +43,7 @@ class GameTests(TestCase):
     def tearDown(self):
         # Save a dump of the test game
         if 'game' in self.__dict__:
-            with open(os.path.join('test_dumps', '%s.json' % (self._name)), 'w') as fout:
-                dump_game(self.game, fout)
+            save_test_dump(self, self.game)
 
         # Destroy the leftover dynamics without showing the slightest
         # sign of mercy
@@ -144,6 +154,41 @@ class GameTests(TestCase):
         test_advance_turn(self.game)
         self.assertEqual(self.game.current_turn.phase, DAWN)
 
+    @record_name
+    def test_turn_scheduler(self):
+        roles = [ Contadino, Contadino, Contadino, Contadino, Lupo, Lupo, Negromante, Fattucchiera, Ipnotista, Ipnotista ]
+        self.game = create_test_game(2204, roles)
+        dynamics = self.game.get_dynamics()
+        scheduler = TurnScheduler(poll_interval=5.0)
+
+        # Nothing to do while the turn has no end
+        turn = self.game.current_turn
+        turn.end = None
+        turn.save()
+        self.assertEqual(scheduler.run_once(), 5.0)
+        self.assertEqual(dynamics.current_turn.phase, CREATION)
+
+        # The turn is advanced as soon as it ends, and the preview is
+        # already there for the first request
+        turn.end = get_now()
+        turn.save()
+        scheduler.run_once()
+        self.assertEqual(dynamics.current_turn.phase, NIGHT)
+        self.assertIsNotNone(dynamics.preview_dynamics)
+        self.assertEqual(dynamics.preview_dynamics.current_turn.phase, DAWN)
+
+        # A second run does not advance the same turn again
+        turn = self.game.current_turn
+        turn.end = None
+        turn.save()
+        scheduler.run_once()
+        self.assertEqual(Turn.objects.filter(game=self.game).count(), 2)
+        self.assertEqual(dynamics.current_turn.phase, NIGHT)
+
+        # An end that stays in the past does not make it spin
+        with patch.object(scheduler, 'advance_game', return_value=get_now() - timedelta(minutes=1)):
+            self.assertEqual(scheduler.run_once(), MIN_WAIT)
+
     def load_game_helper(self, filename):
         with open(os.path.join('dumps', filename)) as fin:
             data = json.load(fin)
@@ -924,7 +969,628 @@ class GameTests(TestCase):
         self.assertTrue(sequestratore.can_use_power())
         with self.assertRaises(AssertionError):
             dynamics.inject_event(CommandEvent(type=USEPOWER, player=espansivo, target=lupo, timestamp=get_now()))
-    
+
+    @record_name
+    def test_target_options_cache(self):
+        roles = [ Cacciatore, Negromante, Negromante, Lupo, Lupo, Contadino, Contadino, Guardia ]
+        self.game = create_test_game(1, roles)
+        dynamics = self.game.get_dynamics()
+        players = self.game.get_players()
+
+        [guardia] = [x for x in players if isinstance(x.role, Guardia)]
+        [lupo, lupo2] = [x for x in players if isinstance(x.role, Lupo)]
+        [cacciatore] = [x for x in players if isinstance(x.role, Cacciatore)]
+
+        # Advance to night: options are computed once and reused
+        test_advance_turn(self.game)
+        options = dynamics.get_target_options(guardia.power)
+        self.assertIs(options, dynamics.get_target_options(guardia.power))
+        self.assertTrue(options.is_valid_target(cacciatore))
+        self.assertFalse(options.is_valid_target(guardia))
+        self.assertEqual(len(options.targets), len(players) - 1)
+
+        # A new event invalidates them
+        dynamics.inject_event(CommandEvent(type=USEPOWER, player=guardia, target=lupo, timestamp=get_now()))
+        self.assertIsNot(options, dynamics.get_target_options(guardia.power))
+
+        # Advance to next night and kill Cacciatore
+        test_advance_turn(self.game)
+        test_advance_turn(self.game)
+        test_advance_turn(self.game)
+        test_advance_turn(self.game)
+        dynamics.inject_event(CommandEvent(type=USEPOWER, player=lupo, target=cacciatore, timestamp=get_now()))
+        dynamics.inject_event(CommandEvent(type=USEPOWER, player=lupo2, target=cacciatore, timestamp=get_now()))
+        test_advance_turn(self.game)
+        self.assertFalse(cacciatore.alive)
+
+        # Dead players are not valid targets anymore
+        test_advance_turn(self.game)
+        test_advance_turn(self.game)
+        test_advance_turn(self.game)
+        options = dynamics.get_target_options(guardia.power)
+        self.assertFalse(options.is_valid_target(cacciatore))
+        with self.assertRaises(AssertionError):
+            dynamics.inject_event(CommandEvent(type=USEPOWER, player=guardia, target=cacciatore, timestamp=get_now()))
+
+    @record_name
+    def test_player_state_table(self):
+        roles = [ Cacciatore, Negromante, Negromante, Lupo, Lupo, Contadino, Contadino ]
+        self.game = create_test_game(1, roles)
+        dynamics = self.game.get_dynamics()
+        players = self.game.get_players()
+        [cacciatore] = [x for x in players if isinstance(x.role, Cacciatore)]
+        [lupo, lupo2] = [x for x in players if isinstance(x.role, Lupo)]
+
+        for i in range(5):
+            test_advance_turn(self.game)
+        dynamics.inject_event(CommandEvent(type=USEPOWER, player=lupo, target=cacciatore, timestamp=get_now()))
+        dynamics.inject_event(CommandEvent(type=USEPOWER, player=lupo2, target=cacciatore, timestamp=get_now()))
+        test_advance_turn(self.game)
+
+        # Flags are stored by the dynamics, not by the players
+        table = dynamics.player_state
+        self.assertNotIn('alive', cacciatore.__dict__)
+        self.assertEqual(table.columns['alive'][cacciatore.state_ordinal], 0)
+        self.assertEqual(table.select(players, alive=True, active=True), [x for x in players if x.alive and x.active])
+        self.assertEqual(table.select(players, alive=False), [cacciatore])
+        self.assertEqual(table.count(alive=True), len(roles) - 1)
+        self.assertEqual(dynamics.get_dead_players(), [cacciatore])
+
+        # Forks and snapshots have their own table
+        fork = dynamics.fork()
+        fork.get_canonical_player(lupo).alive = False
+        self.assertTrue(lupo.alive)
+        self.assertTrue(dynamics.snapshot.get_canonical_player(lupo).alive)
+        self.assertIsNot(fork.player_state, table)
+
+        # Players that are not canonical read the flags of the
+        # canonical one, until they are given their own
+        player = Player.objects.get(pk=lupo.pk)
+        self.assertTrue(player.alive)
+        self.assertFalse(Player.objects.get(pk=cacciatore.pk).alive)
+        player.alive = False
+        self.assertFalse(player.alive)
+        self.assertTrue(lupo.alive)
+
+    @record_name
+    def test_published_snapshot(self):
+        roles = [ Cacciatore, Negromante, Negromante, Lupo, Lupo, Contadino, Contadino ]
+        self.game = create_test_game(1, roles)
+        dynamics = self.game.get_dynamics()
+        players = self.game.get_players()
+        [cacciatore] = [x for x in players if isinstance(x.role, Cacciatore)]
+        [lupo, lupo2] = [x for x in players if isinstance(x.role, Lupo)]
+
+        test_advance_turn(self.game)
+        test_advance_turn(self.game)
+        test_advance_turn(self.game)
+        test_advance_turn(self.game)
+        test_advance_turn(self.game)
+        snapshot = dynamics.snapshot
+        self.assertEqual(snapshot.current_turn.phase, NIGHT)
+        self.assertEqual(len(snapshot.alive_players), len(roles))
+
+        # A published snapshot is not touched by later updates
+        dynamics.inject_event(CommandEvent(type=USEPOWER, player=lupo, target=cacciatore, timestamp=get_now()))
+        dynamics.inject_event(CommandEvent(type=USEPOWER, player=lupo2, target=cacciatore, timestamp=get_now()))
+        test_advance_turn(self.game)
+        self.assertFalse(cacciatore.alive)
+        self.assertTrue(snapshot.get_canonical_player(cacciatore).alive)
+        self.assertEqual(snapshot.current_turn.phase, NIGHT)
+        self.assertGreater(dynamics.snapshot.version, snapshot.version)
+        self.assertFalse(dynamics.snapshot.get_canonical_player(cacciatore).alive)
+        self.assertEqual(dynamics.snapshot.current_turn.phase, DAWN)
+        self.assertEqual(len(dynamics.snapshot.events), len(dynamics.events))
+
+        # Lazy updates do not wait for another thread that is updating
+        locked = ThreadEvent()
+        release = ThreadEvent()
+        def hold_lock():
+            with dynamics.update_lock:
+                locked.set()
+                release.wait()
+        thread = Thread(target=hold_lock)
+        thread.start()
+        locked.wait()
+        dynamics.last_update = ANCIENT_DATETIME
+        dynamics.update(lazy=True)
+        release.set()
+        thread.join()
+
+    @record_name
+    def test_group_commit_commands(self):
+        roles = [ Cacciatore, Negromante, Negromante, Lupo, Lupo, Contadino, Contadino ]
+        self.game = create_test_game(1, roles)
+        dynamics = self.game.get_dynamics()
+        test_advance_turn(self.game)
+        test_advance_turn(self.game)
+        test_advance_turn(self.game)
+        self.assertEqual(dynamics.current_turn.phase, DAY)
+        [first, second, third] = dynamics.get_alive_players()[:3]
+
+        def submit_concurrently(command, others):
+            # The other commands come from threads waiting for a flush
+            # in progress; then this thread, which owns the test
+            # database, flushes them together with its own command
+            results = [None] * len(others)
+            def submit(i):
+                results[i] = dynamics.submit_command(others[i])
+            with dynamics.commands_cond:
+                dynamics.flushing = True
+            threads = [Thread(target=submit, args=(i,)) for i in range(len(others))]
+            for thread in threads:
+                thread.start()
+            while True:
+                with dynamics.commands_cond:
+                    if len(dynamics.pending_commands) == len(others):
+                        dynamics.flushing = False
+                        break
+                ThreadEvent().wait(0.01)
+            try:
+                return dynamics.submit_command(command), results
+            finally:
+                for thread in threads:
+                    thread.join()
+
+        # If the update fails, the batch is rolled back and no command
+        # is acknowledged
+        with patch.object(dynamics, 'update', side_effect=RuntimeError('Update failed')):
+            with self.assertRaises(RuntimeError):
+                submit_concurrently(CommandEvent(type=VOTE, player=first, target=third, timestamp=get_now()),
+                                    [CommandEvent(type=VOTE, player=second, target=third, timestamp=get_now()),
+                                     CommandEvent(type=VOTE, player=third, target=second, timestamp=get_now())])
+        self.assertEqual(dynamics.pending_commands, [])
+        self.assertEqual(CommandEvent.objects.filter(turn=dynamics.current_turn).count(), 0)
+
+        # Commands waiting for the flush are stored together with the
+        # one that triggers it
+        accepted, results = submit_concurrently(CommandEvent(type=VOTE, player=first, target=second, timestamp=get_now()),
+                                                [CommandEvent(type=VOTE, player=second, target=first, timestamp=get_now()),
+                                                 CommandEvent(type=VOTE, player=third, target=first, timestamp=get_now())])
+        self.assertTrue(accepted)
+        self.assertEqual(results, [True, True])
+        self.assertEqual(dynamics.pending_commands, [])
+        self.assertEqual([first.recorded_vote, second.recorded_vote, third.recorded_vote], [second, first, first])
+        self.assertEqual(CommandEvent.objects.filter(turn=dynamics.current_turn).count(), 3)
+
+        # Commands arriving too late for their phase are rejected
+        test_advance_turn(self.game)
+        self.assertFalse(dynamics.submit_command(CommandEvent(type=VOTE, player=first, target=third, timestamp=get_now())))
+        self.assertEqual(CommandEvent.objects.filter(type=VOTE, target=third).count(), 0)
+
+    @record_name
+    def test_replay_dump_in_memory(self):
+        roles = [ Cacciatore, Negromante, Negromante, Lupo, Lupo, Contadino, Contadino ]
+        self.game = create_test_game(1, roles)
+        dynamics = self.game.get_dynamics()
+        players = self.game.get_players()
+
+        [cacciatore] = [x for x in players if isinstance(x.role, Cacciatore)]
+        [lupo, lupo2] = [x for x in players if isinstance(x.role, Lupo)]
+        [contadino, _] = [x for x in players if isinstance(x.role, Contadino)]
+
+        # Kill Cacciatore during the second night and burn a Contadino
+        test_advance_turn(self.game)
+        test_advance_turn(self.game)
+        test_advance_turn(self.game)
+        test_advance_turn(self.game)
+        test_advance_turn(self.game)
+        dynamics.inject_event(CommandEvent(type=USEPOWER, player=lupo, target=cacciatore, timestamp=get_now()))
+        dynamics.inject_event(CommandEvent(type=USEPOWER, player=lupo2, target=cacciatore, timestamp=get_now()))
+        test_advance_turn(self.game)
+        test_advance_turn(self.game)
+        for player in dynamics.get_alive_players():
+            dynamics.inject_event(CommandEvent(type=VOTE, player=player, target=contadino, timestamp=get_now()))
+        test_advance_turn(self.game)
+        self.assertFalse(cacciatore.alive)
+        self.assertFalse(contadino.alive)
+
+        fout = StringIO()
+        dump_game(self.game, fout)
+        data = json.loads(fout.getvalue())
+
+        # The replay does not need the database at all
+        with self.assertNumQueries(0):
+            replay = Dynamics.from_dump(data)
+
+        self.assertEqual(len(replay.turns), len(dynamics.turns))
+        self.assertEqual(replay.current_turn.phase, dynamics.current_turn.phase)
+        self.assertEqual([event.subclass for event in replay.events], [event.subclass for event in dynamics.events])
+        self.assertEqual(replay.mayor.user.username, dynamics.mayor.user.username)
+        for player, replayed in zip(dynamics.players, replay.players):
+            self.assertEqual(player.user.username, replayed.user.username)
+            self.assertEqual(player.role.__class__, replayed.role.__class__)
+            self.assertEqual((player.alive, player.active, player.team, player.aura),
+                             (replayed.alive, replayed.active, replayed.team, replayed.aura))
+
+    @record_name
+    def test_streamed_dump(self):
+        roles = [ Cacciatore, Negromante, Negromante, Lupo, Lupo, Contadino, Contadino ]
+        self.game = create_test_game(1, roles)
+        dynamics = self.game.get_dynamics()
+        players = self.game.get_players()
+        [lupo, lupo2] = [x for x in players if isinstance(x.role, Lupo)]
+        [cacciatore] = [x for x in players if isinstance(x.role, Cacciatore)]
+
+        def reference_dump():
+            # One object at a time, as dumps used to be written
+            data = {'players': [player.user.username for player in Player.objects.filter(game=self.game).order_by('pk')],
+                    'turns': []}
+            for turn in Turn.objects.filter(game=self.game).order_by('date', 'phase'):
+                events = [event.as_child() for event in Event.objects.filter(turn=turn).order_by('timestamp', 'pk')]
+                data['turns'].append({'begin': turn.begin.isoformat(),
+                                      'end': turn.end.isoformat() if turn.end is not None else None,
+                                      'events': [event.to_dict() for event in events if not event.AUTOMATIC],
+                                      'comments': [comment.to_dict() for comment in Comment.objects.filter(turn=turn).order_by('timestamp')]})
+            return data
+
+        # One query per table, whatever the length of the game
+        queries = 3 + len([subclass for subclass in Event.__subclasses__() if not subclass.AUTOMATIC])
+
+        def check_dump():
+            fout = StringIO()
+            with self.assertNumQueries(queries):
+                dump_game(self.game, fout)
+            self.assertEqual(fout.getvalue(), json.dumps(reference_dump(), indent=4))
+
+            fout = StringIO()
+            dump_game(self.game, fout, compact=True)
+            self.assertEqual(json.loads(fout.getvalue()), reference_dump())
+            self.assertNotIn('\n', fout.getvalue())
+
+        check_dump()
+
+        # Kill Cacciatore during the second night
+        for i in range(5):
+            test_advance_turn(self.game)
+        dynamics.inject_event(CommandEvent(type=USEPOWER, player=lupo, target=cacciatore, timestamp=get_now()))
+        dynamics.inject_event(CommandEvent(type=USEPOWER, player=lupo2, target=cacciatore, timestamp=get_now()))
+        Comment.objects.create(turn=dynamics.current_turn, user=lupo.user, text=u"Buonanotte")
+        test_advance_turn(self.game)
+        self.assertFalse(cacciatore.alive)
+        check_dump()
+
+        # The compressed stream decodes to the compact dump
+        compact = StringIO()
+        dump_game(self.game, compact, compact=True)
+        stream = b''.join(gzip_chunks(iter_dump_game(self.game, compact=True)))
+        self.assertEqual(gzip.decompress(stream).decode('utf-8'), compact.getvalue())
+
+        # The game is read before streaming starts: ASGI servers
+        # consume the stream in the event loop, where queries fail
+        chunks = iter_dump_game(self.game)
+        async def consume():
+            # Any query here would raise SynchronousOnlyOperation
+            return ''.join(chunks)
+        self.assertEqual(json.loads(asyncio.run(consume())), reference_dump())
+
+    @record_name
+    def test_bulk_load_from_json(self):
+        roles = [ Cacciatore, Negromante, Negromante, Lupo, Lupo, Contadino, Contadino ]
+        self.game = create_test_game(1, roles)
+        dynamics = self.game.get_dynamics()
+        players = self.game.get_players()
+        [lupo, lupo2] = [x for x in players if isinstance(x.role, Lupo)]
+        [cacciatore] = [x for x in players if isinstance(x.role, Cacciatore)]
+
+        # Kill Cacciatore during the second night
+        for i in range(5):
+            test_advance_turn(self.game)
+        dynamics.inject_event(CommandEvent(type=USEPOWER, player=lupo, target=cacciatore, timestamp=get_now()))
+        dynamics.inject_event(CommandEvent(type=USEPOWER, player=lupo2, target=cacciatore, timestamp=get_now()))
+        Comment.objects.create(turn=dynamics.current_turn, user=lupo.user, text=u"Buonanotte")
+        test_advance_turn(self.game)
+
+        fout = StringIO()
+        dump_game(self.game, fout)
+        data = json.loads(fout.getvalue())
+
+        # Loading the dump back gives the same game
+        self.game.load_from_json(data)
+        fout = StringIO()
+        dump_game(self.game, fout)
+        self.assertEqual(json.loads(fout.getvalue()), data)
+        dynamics = self.game.get_dynamics()
+        self.assertEqual(len(dynamics.turns), len(data['turns']))
+        [cacciatore] = [x for x in dynamics.players if isinstance(x.role, Cacciatore)]
+        self.assertFalse(cacciatore.alive)
+        self.assertEqual(sorted((turn.date, turn.phase) for turn in Turn.objects.filter(game=self.game)),
+                         [(turn.date, turn.phase) for turn in dynamics.turns])
+
+        # Rows without a natural key can only be read back on SQLite
+        with patch.object(connection, 'vendor', 'postgresql'), \
+                patch.object(connection.features, 'can_return_rows_from_bulk_insert', False):
+            with self.assertRaises(NotSupportedError):
+                bulk_create_rows(Comment, [Comment(turn=dynamics.current_turn, user=lupo.user, text=u"Ciao")])
+            comment = Comment(turn=dynamics.current_turn, user=lupo.user, text=u"Ciao")
+            bulk_create_rows(Comment, [comment], key_fields=('text',), turn=dynamics.current_turn)
+            self.assertEqual(Comment.objects.get(text=u"Ciao").pk, comment.pk)
+        Comment.objects.filter(text=u"Ciao").delete()
+
+        # A failing load leaves the game as it was
+        broken = json.loads(json.dumps(data))
+        [turn_data] = [turn_data for turn_data in broken['turns'] if turn_data['comments']]
+        turn_data['comments'][0]['user'] = 'nobody'
+        with self.assertRaises(User.DoesNotExist):
+            self.game.load_from_json(broken)
+        broken = json.loads(json.dumps(data))
+        broken['turns'][-1]['events'].append({'subclass': 'NoSuchEvent', 'timestamp': get_now().isoformat()})
+        with self.assertRaises(ValueError):
+            self.game.load_from_json(broken)
+        fout = StringIO()
+        dump_game(self.game, fout)
+        self.assertEqual(json.loads(fout.getvalue()), data)
+        self.assertEqual(len(self.game.get_dynamics().turns), len(data['turns']))
+
+        # The same history replayed on a new game, with new users
+        usernames = data['players']
+        self.game.delete()
+        User.objects.filter(username__in=usernames).delete()
+        data['players'] = [{'username': username} for username in usernames]
+        self.game = create_game_from_dump(data)
+        self.assertEqual(sorted(player.user.username for player in self.game.get_players()), sorted(usernames))
+        [cacciatore] = [x for x in self.game.get_players() if isinstance(x.role, Cacciatore)]
+        self.assertFalse(cacciatore.alive)
+
+    @record_name
+    def test_recompute_automatic_events(self):
+        roles = [ Cacciatore, Negromante, Negromante, Lupo, Lupo, Contadino, Contadino ]
+        # Automatic events are only stored in single mode
+        with patch('game.dynamics.SINGLE_MODE', True):
+            self.game = create_test_game(1, roles)
+            dynamics = self.game.get_dynamics()
+            players = self.game.get_players()
+            [lupo, lupo2] = [x for x in players if isinstance(x.role, Lupo)]
+            [cacciatore] = [x for x in players if isinstance(x.role, Cacciatore)]
+            for i in range(5):
+                test_advance_turn(self.game)
+            dynamics.inject_event(CommandEvent(type=USEPOWER, player=lupo, target=cacciatore, timestamp=get_now()))
+            dynamics.inject_event(CommandEvent(type=USEPOWER, player=lupo2, target=cacciatore, timestamp=get_now()))
+            test_advance_turn(self.game)
+
+            automatic = Event.objects.filter(turn__game=self.game, subclass__in=AUTOMATIC_EVENT_NAMES)
+            stored = sorted(automatic.values_list('subclass', flat=True))
+            commands = CommandEvent.objects.filter(turn__game=self.game).count()
+            self.assertIn('PlayerDiesEvent', stored)
+            self.assertEqual(set(stored), set(event.subclass for event in dynamics.events if event.AUTOMATIC))
+            self.assertTrue(all(event.is_automatic() for event in automatic.all()))
+
+            # The purge only takes a few queries, whatever the number
+            # of events
+            with self.assertNumQueries(len(AUTOMATIC_EVENT_CLASSES) + 3):
+                self.assertEqual(self.game.recompute_automatic_events(), len(stored))
+            self.assertFalse(automatic.exists())
+            self.assertEqual(CommandEvent.objects.filter(turn__game=self.game).count(), commands)
+
+            # Rebuilding the dynamics writes them again
+            self.assertEqual(self.game.recompute_automatic_events(regenerate=True), 0)
+            self.assertIsNot(self.game.get_dynamics(), dynamics)
+            self.assertEqual(sorted(automatic.values_list('subclass', flat=True)), stored)
+            [cacciatore] = [x for x in self.game.get_players() if isinstance(x.role, Cacciatore)]
+            self.assertFalse(cacciatore.alive)
+
+    @record_name
+    def test_admin_changelists(self):
+        roles = [ Cacciatore, Negromante, Negromante, Lupo, Lupo, Contadino, Contadino ]
+        self.game = create_test_game(1, roles)
+        dynamics = self.game.get_dynamics()
+        players = self.game.get_players()
+        [lupo, lupo2] = [x for x in players if isinstance(x.role, Lupo)]
+        [cacciatore] = [x for x in players if isinstance(x.role, Cacciatore)]
+        for i in range(5):
+            test_advance_turn(self.game)
+
+        admin = User.objects.create_superuser(username='admin', password='admin')
+        client = Client()
+        client.force_login(admin)
+
+        def count_queries(path, data):
+            with CaptureQueriesContext(connection) as context:
+                response = client.get(path, data)
+            self.assertEqual(response.status_code, 200)
+            return len(context.captured_queries), response
+
+        # The number of queries does not depend on the number of rows
+        few, response = count_queries('/admin/game/player/', {'q': cacciatore.user.last_name})
+        self.assertContains(response, 'Cacciatore')
+        many, response = count_queries('/admin/game/player/', {'q': 'Paperinik'})
+        self.assertEqual(few, many)
+        for role in ['Cacciatore', 'Negromante', 'Lupo', 'Contadino']:
+            self.assertContains(response, role)
+
+        dynamics.inject_event(CommandEvent(type=USEPOWER, player=lupo, target=cacciatore, timestamp=get_now()))
+        few, response = count_queries('/admin/game/commandevent/', {})
+        self.assertContains(response, 'Cacciatore')
+        few_events, _ = count_queries('/admin/game/event/', {})
+        dynamics.inject_event(CommandEvent(type=USEPOWER, player=lupo2, target=cacciatore, timestamp=get_now()))
+        test_advance_turn(self.game)
+        many, response = count_queries('/admin/game/commandevent/', {})
+        self.assertEqual(few, many)
+        many_events, _ = count_queries('/admin/game/event/', {})
+        self.assertEqual(few_events, many_events)
+
+    @record_name
+    def test_whatif_simulation(self):
+        from game.simulation import simulate_alternatives, run_simulations, simulate_commands, get_simulation_data
+        roles = [ Cacciatore, Negromante, Negromante, Lupo, Lupo, Contadino, Contadino ]
+        self.game = create_test_game(1, roles)
+        dynamics = self.game.get_dynamics()
+        players = self.game.get_players()
+        [lupo, lupo2] = [x for x in players if isinstance(x.role, Lupo)]
+        [cacciatore] = [x for x in players if isinstance(x.role, Cacciatore)]
+        [contadino, _] = [x for x in players if isinstance(x.role, Contadino)]
+
+        # Second night: the wolves attack Cacciatore
+        for i in range(5):
+            test_advance_turn(self.game)
+        dynamics.inject_event(CommandEvent(type=USEPOWER, player=lupo, target=cacciatore, timestamp=get_now()))
+        dynamics.inject_event(CommandEvent(type=USEPOWER, player=lupo2, target=cacciatore, timestamp=get_now()))
+
+        attack_contadino = [{'player': lupo.user.username, 'target': contadino.user.username},
+                            {'player': lupo2.user.username, 'target': contadino.user.username}]
+        not_allowed = [{'player': contadino.user.username, 'target': lupo.user.username}]
+        turns = Turn.objects.count()
+        events = Event.objects.count()
+        with self.assertNumQueries(len([subclass for subclass in Event.__subclasses__() if not subclass.AUTOMATIC]) + 3):
+            outcomes = simulate_alternatives(self.game, [attack_contadino, not_allowed], workers=1)
+        self.assertEqual((Turn.objects.count(), Event.objects.count()), (turns, events))
+        self.assertTrue(cacciatore.alive)
+
+        [actual, alternative, rejected] = outcomes
+        self.assertEqual(actual['dead'], [cacciatore.user.username])
+        self.assertEqual(actual['rejected'], [])
+        self.assertTrue(actual['powers'][lupo.user.username])
+        self.assertEqual(alternative['dead'], [contadino.user.username])
+        self.assertEqual(rejected['rejected'], not_allowed)
+        self.assertEqual(rejected['dead'], actual['dead'])
+        self.assertEqual(rejected['messages'], actual['messages'])
+
+        # The same results are obtained in parallel
+        data, end = get_simulation_data(self.game)
+        jobs = [([], end), (attack_contadino, end), (not_allowed, end)]
+        self.assertEqual(run_simulations(data, simulate_commands, jobs, workers=2), outcomes)
+
+        # Later simulations run in the same pool
+        from game import simulation
+        executor = simulation._executors[2]
+        self.assertEqual(run_simulations(data, simulate_commands, jobs[1:], workers=2), outcomes[1:])
+        self.assertIs(simulation._executors[2], executor)
+        with self.assertRaises(concurrent.futures.TimeoutError):
+            run_simulations(data, simulate_commands, jobs, workers=2, timeout=0)
+
+        # The actual commands lead where the game goes
+        test_advance_turn(self.game)
+        self.assertFalse(cacciatore.alive)
+        self.assertTrue(contadino.alive)
+        self.assertEqual(actual['mayor'], dynamics.mayor.user.username if dynamics.mayor is not None else None)
+
+        # Simulations are forks that do not change the replayed game
+        replay = Dynamics.from_dump(get_simulation_data(self.game)[0])
+        fork = replay.fork()
+        simulate_commands(fork, [], get_now())
+        self.assertEqual(len(replay.turns) + 1, len(fork.turns))
+        self.assertIsNot(replay.players[0], fork.players[0])
+        self.assertEqual(len(replay.source.turns) + 1, len(fork.source.turns))
+
+    @record_name
+    def test_estimate_outcomes(self):
+        from game.simulation import get_simulation_data, estimate_outcomes
+        roles = [ Cacciatore, Negromante, Negromante, Lupo, Lupo, Contadino, Contadino ]
+        self.game = create_test_game(1, roles)
+        dynamics = self.game.get_dynamics()
+        players = self.game.get_players()
+        [cacciatore] = [x for x in players if isinstance(x.role, Cacciatore)]
+        [contadino, contadino2] = [x for x in players if isinstance(x.role, Contadino)]
+
+        while dynamics.current_turn.phase != DAY:
+            test_advance_turn(self.game)
+
+        # The stake vote is a tie between Cacciatore and a Contadino,
+        # which the mayor does not break
+        mayor = dynamics.mayor
+        voters = [player for player in dynamics.get_alive_players() if player is not mayor]
+        voted = [cacciatore, contadino] if mayor not in [cacciatore, contadino] else [cacciatore, contadino2]
+        commands = [{'type': 'Vote', 'player': mayor.user.username, 'target': None}] if mayor is not None else []
+        commands += [{'type': 'Vote', 'player': player.user.username, 'target': voted[i % 2].user.username} for i, player in enumerate(voters[:6])]
+
+        data, end = get_simulation_data(self.game)
+        with self.assertNumQueries(0):
+            frequencies, seconds = estimate_outcomes(data, end, 300, commands=commands, seed=1, workers=1)
+        self.assertEqual(frequencies['runs'], 300)
+        self.assertEqual(sum(frequencies['dead'].values()), 300)
+        self.assertEqual(set(frequencies['dead']), set(player.user.username for player in voted))
+        self.assertGreater(min(frequencies['dead'].values()), 100)
+
+        # Estimates can be repeated, also in parallel
+        frequencies2, seconds = estimate_outcomes(data, end, 300, commands=commands, seed=1, workers=2)
+        self.assertEqual(frequencies2, frequencies)
+        self.assertNotEqual(estimate_outcomes(data, end, 300, commands=commands, seed=2, workers=1)[0], frequencies)
+
+        # Without ties, there is nothing left to chance
+        commands = [{'type': 'Vote', 'player': player.user.username, 'target': cacciatore.user.username} for player in dynamics.get_alive_players()]
+        frequencies, seconds = estimate_outcomes(data, end, 20, commands=commands, workers=1)
+        self.assertEqual(frequencies['dead'], {cacciatore.user.username: 20})
+
+    def test_player_statuses(self):
+        roles = [ Cacciatore, Negromante, Negromante, Lupo, Lupo, Contadino, Contadino ]
+        self.game = create_test_game(1, roles)
+        dynamics = self.game.get_dynamics()
+        while dynamics.current_turn.phase != DAY or dynamics.current_turn.date < 2:
+            test_advance_turn(self.game)
+
+        # Each turn has a status for each player; the one of the
+        # current turn matches the dynamics
+        statuses = PlayerStatus.objects.filter(turn__game=self.game)
+        self.assertEqual(statuses.count(), len(dynamics.turns) * len(dynamics.players))
+        for status in statuses.filter(turn=dynamics.current_turn):
+            player = dynamics.players_dict[status.player_id]
+            self.assertEqual((status.alive, status.active, status.role, status.team, status.aura),
+                             (player.alive, player.active, player.role.__class__, player.team, player.aura))
+            self.assertEqual(status.mayor, player is dynamics.mayor)
+        self.assertEqual(statuses.filter(turn=dynamics.current_turn, mayor=True).count(), 1)
+        dead = set(statuses.filter(turn=dynamics.current_turn, alive=False).values_list('player__pk', flat=True))
+        self.assertEqual(dead, set(player.pk for player in dynamics.get_dead_players()))
+        # Roles are assigned during the creation turn, when nobody has died yet
+        self.assertEqual(statuses.filter(turn=dynamics.turns[0], alive=True).exclude(role=None).count(), len(roles))
+
+        # Replaying the game writes nothing, but fixes what differs
+        stored = sorted(statuses.values_list('turn', 'player', 'alive', 'role', 'mayor'))
+        last = statuses.filter(turn=dynamics.current_turn).first()
+        last.alive = not last.alive
+        last.save()
+        with CaptureQueriesContext(connection) as queries:
+            Dynamics(self.game).update()
+        writes = [query['sql'] for query in queries.captured_queries if 'playerstatus' in query['sql'] and not query['sql'].startswith('SELECT')]
+        self.assertEqual(len(writes), 2)
+        self.assertEqual(sorted(statuses.values_list('turn', 'player', 'alive', 'role', 'mayor')), stored)
+
+    def test_analyze_dumps(self):
+        import csv
+        import subprocess
+        result = subprocess.run([sys.executable, 'analyze_dumps.py', TEST_DUMPS_DIR, '-', '2'], capture_output=True, text=True, check=True)
+        rows = list(csv.DictReader(StringIO(result.stdout)))
+        finished = [row for row in rows if row['over'] == 'True']
+        self.assertGreater(len(finished), 0)
+
+        # Each finished game counts once for every team that played it
+        lines = result.stderr.split('\n')
+        start = lines.index('Win rates of finished games') + 2
+        table = [line.split('\t') for line in lines[start:lines.index('', start)]]
+        self.assertGreater(len(table), 0)
+        for ruleset, team, games, wins, rate in table:
+            self.assertLessEqual(int(wins), int(games))
+            self.assertLessEqual(int(games), len([row for row in finished if row['ruleset'] == ruleset]))
+
+    def test_bulk_onboarding(self):
+        from game.onboarding import parse_users_tsv, create_users, OnboardingError
+        game = Game(name='onboarding')
+        game.save()
+        lines = ['Paperon de\' Paperoni\tpaperone@sns.it\tpaperone\tM\n', '\n', 'Nonna Papera\tnonna@sns.it\tnonna\tF\tsegreta\n']
+        users = parse_users_tsv(lines)
+        self.assertEqual([user['last_name'] for user in users], ["de' Paperoni", 'Papera'])
+
+        # Savepoint, check, three inserts and the primary keys
+        with self.assertNumQueries(7):
+            created = create_users(users, game=game, workers=2)
+        self.assertEqual([user.username for user in created], ['paperone', 'nonna'])
+        paperone = User.objects.get(username='paperone')
+        self.assertTrue(paperone.check_password('ciaociao'))
+        self.assertNotEqual(paperone.password, 'ciaociao')
+        self.assertTrue(User.objects.get(username='nonna').check_password('segreta'))
+        self.assertEqual(paperone.profile.gender, MALE)
+        self.assertEqual(User.objects.get(username='nonna').profile.gender, FEMALE)
+        self.assertEqual(set(player.user.username for player in Player.objects.filter(game=game)), {'paperone', 'nonna'})
+
+        # Wrong lines and existing users leave everything untouched
+        with self.assertRaises(OnboardingError):
+            parse_users_tsv(['Paperino\tpaperino@sns.it\tpaperino\tM\n'])
+        with self.assertRaises(OnboardingError):
+            parse_users_tsv(['Paolino Paperino\tpaperino@sns.it\tpaperino\tX\n'])
+        with self.assertRaises(OnboardingError):
+            create_users(parse_users_tsv(['Paolino Paperino\tpaperino@sns.it\tpaperino\tM\n', 'Nonna Papera\tnonna@sns.it\tnonna\tF\n']), workers=1)
+        self.assertFalse(User.objects.filter(username='paperino').exists())
+        self.assertEqual(Profile.objects.count(), 2)
+
     @record_name
     def test_lupi(self):
         roles = [ Cacciatore, Negromante, Negromante, Lupo, Lupo, Contadino, Contadino ]
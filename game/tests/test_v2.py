@@ -1,14 +1,23 @@
 import sys
 import datetime
 import json
+import gzip
 import os
 import collections
+import asyncio
+import tempfile
+import logging
 import pytz
 from functools import wraps
 
 from django.utils import timezone
 
-from django.test import TestCase, Client
+from django.test import TestCase, Client, AsyncClient, override_settings
+from django.urls import resolve
+from django.template import Template, Context
+from django.core.management import call_command
+from django.contrib.staticfiles.storage import staticfiles_storage
+from asgiref.sync import async_to_sync
 
 from game.models import *
 import game.roles.v2 as v2
@@ -16,10 +25,11 @@ from game.roles.v2 import *
 from game.events import *
 from game.constants import *
 from game.utils import get_now, advance_to_time
+from game import live
 
 from datetime import timedelta, datetime, time
 
-from .test_utils import GameTest
+from .test_utils import GameTest, test_dump_path
 
 class TestWebInterface(GameTest, TestCase):
     roles = [Contadino, Veggente, Stalker, Lupo, Diavolo, Negromante]
@@ -39,6 +49,41 @@ class TestWebInterface(GameTest, TestCase):
         self.advance_turn()
         self.check_event(AuraKnowledgeEvent, {'player': self.veggente, 'target': self.lupo})
 
+    def test_command_waits_for_update(self):
+        from threading import Thread, Event as ThreadEvent
+        from unittest.mock import patch
+        from game.views import UsePowerView
+        self.advance_turn(NIGHT)
+        dynamics = self.game.get_dynamics()
+        c = Client()
+        c.force_login(self.veggente.user)
+
+        # While another thread is updating the dynamics, the command
+        # view waits before reading it
+        locked = ThreadEvent()
+        released = ThreadEvent()
+        def hold_lock():
+            with dynamics.update_lock:
+                locked.set()
+                # Long enough for the request to reach the view
+                ThreadEvent().wait(0.2)
+                released.set()
+        checks = []
+        can_execute_action = UsePowerView.can_execute_action
+        def check(view):
+            checks.append(released.is_set())
+            return can_execute_action(view)
+
+        thread = Thread(target=hold_lock)
+        thread.start()
+        locked.wait()
+        with patch.object(UsePowerView, 'can_execute_action', check):
+            response = c.post('/game/test/usepower/', {'target': self.lupo.pk})
+        thread.join()
+        self.assertEqual(checks, [True])
+        self.assertTemplateUsed(response, 'command_submitted.html')
+        self.assertEqual(self.veggente.canonicalize().role.recorded_target, self.lupo)
+
     def test_double_target(self):
         self.advance_turn(NIGHT)
 
@@ -113,6 +158,57 @@ class TestWebInterface(GameTest, TestCase):
         self.advance_turn()
         self.assertFalse(self.contadino.alive)
 
+    def test_whatif(self):
+        self.advance_turn(NIGHT)
+        self.usepower(self.lupo, self.contadino)
+
+        c = Client()
+        c.force_login(self.master.user)
+        c.get('/game/test/as_gm/')
+        response = c.get('/game/test/whatif/')
+        self.assertIn('alt0_%d' % self.lupo.pk, response.context['form'].fields)
+
+        response = c.post('/game/test/whatif/', {'alt0_%d' % self.lupo.pk: self.veggente.pk, 'alt1_%d' % self.lupo.pk: 'None'})
+        self.assertEqual(response.status_code, 200)
+        [actual, alternative, nobody] = response.context['columns']
+        self.assertEqual(actual['dead'], [self.contadino.full_name])
+        self.assertEqual(alternative['dead'], [self.veggente.full_name])
+        self.assertEqual(nobody['dead'], [])
+
+        # The page does not wait for the simulations forever
+        import concurrent.futures
+        from unittest.mock import patch
+        from game.simulation import SIMULATION_TIMEOUT
+        with patch('game.views.simulate_alternatives', side_effect=concurrent.futures.TimeoutError) as simulate:
+            response = c.post('/game/test/whatif/', {'alt0_%d' % self.lupo.pk: self.veggente.pk})
+        self.assertEqual(simulate.call_args.kwargs['timeout'], SIMULATION_TIMEOUT)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('columns', response.context)
+        self.assertTrue(response.context['form'].non_field_errors())
+
+        # Nothing was changed
+        self.assertEqual(self.dynamics.current_turn.phase, NIGHT)
+        self.advance_turn()
+        self.assertFalse(self.contadino.alive)
+        self.assertTrue(self.veggente.alive)
+
+        c.force_login(self.lupo.user)
+        response = c.get('/game/test/whatif/')
+        self.assertEqual(response.status_code, 302)
+
+    def test_ruleset_roles(self):
+        from game.roles.registry import get_ruleset_roles
+        roles = get_ruleset_roles('v2')
+        scanned = [getattr(v2, k) for k in dir(v2) if isclass(getattr(v2, k)) and issubclass(getattr(v2, k), Role) and getattr(v2, k).__module__ == 'game.roles.v2']
+        self.assertEqual(list(roles.roles), sorted(scanned, key=lambda x: (TEAMS.index(x.team), x.name)))
+        self.assertEqual(roles.ghost_roles, {x for x in scanned if x.ghost})
+        self.assertEqual(roles.alive_roles, {x for x in scanned if not x.dead_power})
+        for role in scanned:
+            self.assertIs(Role.get_from_string(role.as_string()), role)
+        self.assertIs(self.dynamics.ruleset_roles, roles)
+        self.assertEqual(self.dynamics.valid_roles, list(roles.roles))
+        self.assertEqual(self.negromante.power.get_targets_role_class(self.dynamics), roles.ghost_roles)
+
     def test_vote(self):
         self.advance_turn(DAY)
 
@@ -233,14 +329,21 @@ class TestWebInterface(GameTest, TestCase):
         response = c.get('/game/test/dump/')
         self.assertEqual(response.status_code, 200)
 
-        with open('test_dumps/test_load.json', 'wb') as f:
-            f.write(response.content)
+        with open(test_dump_path(self, 'test_load'), 'wb') as f:
+            f.write(b''.join(response.streaming_content))
+
+        # The compact dump holds the same data
+        response = c.get('/game/test/dump/', {'compact': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('.json.gz', response['Content-Disposition'])
+        with open(test_dump_path(self, 'test_load'), 'rb') as f:
+            self.assertEqual(json.loads(gzip.decompress(b''.join(response.streaming_content))), json.load(f))
 
         self.burn(self.contadino)
         response = c.post('/game/test/restart/', {'current_turn_pk': self.game.current_turn.pk})
         self.assertEqual(self.game.current_turn.phase, CREATION)
 
-        with open('test_dumps/test_load.json', 'rb') as f:
+        with open(test_dump_path(self, 'test_load'), 'rb') as f:
             response = c.post('/game/test/load/', {'json': f}, follow=True)
 
         self.assertEqual(response.status_code, 200)
@@ -254,6 +357,272 @@ class TestWebInterface(GameTest, TestCase):
         self.assertIsInstance(event.player.role, Negromante)
 
 
+@override_settings(PROFILE_DYNAMICS=True)
+class TestProfiling(GameTest, TestCase):
+    roles = [Contadino, Contadino, Veggente, Lupo, Negromante]
+    spectral_sequence = []
+
+    def test_profile(self):
+        self.advance_turn(NIGHT)
+        self.usepower(self.veggente, self.lupo)
+        self.advance_turn()
+
+        profiler = self.dynamics.profiler
+        self.assertIn('_compute_entering_dawn', profiler.total)
+        self.assertIn('pre_apply_dawn Veggente', profiler.total)
+        self.assertIn('apply_dawn Veggente', profiler.total)
+        self.assertIn('apply CommandEvent', profiler.total)
+        self.assertIn(self.dynamics.current_turn, profiler.turns)
+
+        master = self.master.user
+        c = Client()
+        c.force_login(master)
+        c.get('/game/test/as_gm/')
+        response = c.get('/game/test/profile/')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'pre_apply_dawn Veggente')
+
+        # Players cannot see it
+        c.force_login(self.veggente.user)
+        response = c.get('/game/test/profile/')
+        self.assertEqual(response.status_code, 302)
+
+class TestConditionalGet(GameTest, TestCase):
+    roles = [Contadino, Contadino, Veggente, Lupo, Negromante]
+    spectral_sequence = []
+
+    def test_not_modified(self):
+        self.advance_turn(DAY)
+        c = Client()
+        c.force_login(self.veggente.user)
+        # The first request also stores the weather in the session
+        c.get('/game/test/personalinfo/')
+
+        response = c.get('/game/test/personalinfo/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response['Cache-Control'])
+        etag = response['ETag']
+
+        response = c.get('/game/test/personalinfo/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        # Only the ETag covers everything the page shows
+        self.assertNotIn('Last-Modified', response)
+        response = c.get('/game/test/personalinfo/', HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT')
+        self.assertEqual(response.status_code, 200)
+
+        # Each viewer has its own validator
+        response = c.get('/game/test/status/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        # New events make the page change
+        self.vote(self.veggente, self.lupo)
+        response = c.get('/game/test/personalinfo/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_async_views(self):
+        self.advance_turn(DAY)
+        c = AsyncClient()
+        c.force_login(self.veggente.user)
+
+        async def read_pages(paths, **extra):
+            return await asyncio.gather(*[c.get(path, **extra) for path in paths])
+        def get(path, **extra):
+            return async_to_sync(read_pages)([path], **extra)[0]
+
+        # The first request also stores the weather in the session
+        get('/game/test/personalinfo/')
+
+        paths = ['/game/test/status/', '/game/test/personalinfo/', '/game/test/announcements/', '/index/']
+        for path in paths:
+            self.assertTrue(asyncio.iscoroutinefunction(resolve(path).func), path)
+        responses = async_to_sync(read_pages)(paths)
+        self.assertEqual([response.status_code for response in responses], [200] * len(paths))
+        self.assertContains(responses[1], self.veggente.full_name)
+
+        # Conditional requests are answered without rendering
+        etag = responses[1]['ETag']
+        response = get('/game/test/personalinfo/', **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        # Other methods are answered without being awaited
+        async def send(method, path):
+            return await getattr(c, method)(path)
+        for path in paths:
+            self.assertEqual(async_to_sync(send)('post', path).status_code, 405, path)
+            response = async_to_sync(send)('options', path)
+            self.assertEqual(response.status_code, 200, path)
+            self.assertIn('GET', response['Allow'])
+        self.assertEqual(Client().post('/index/').status_code, 405)
+
+        # Checks on the user still apply
+        c.force_login(self.master.user)
+        response = get('/game/test/personalinfo/')
+        self.assertEqual(response.status_code, 302)
+
+class TestDynamicsLog(TestCase):
+    def test_background_handler(self):
+        import logging.config
+        from game.log import BackgroundFileHandler
+        with tempfile.TemporaryDirectory() as root:
+            filename = os.path.join(root, 'dynamics.log')
+            # Configured like the 'dynamics' handler in settings, without
+            # touching the logging configuration of the tests
+            configurator = logging.config.DictConfigurator({'version': 1})
+            handler = configurator.configure_handler({'class': 'game.log.BackgroundFileHandler', 'filename': filename})
+            self.assertIsInstance(handler, BackgroundFileHandler)
+            handler.setFormatter(logging.Formatter('{levelname} {message}', style='{'))
+            values = [1]
+            handler.handle(logging.LogRecord('game.test_log', logging.INFO, __file__, 0, 'Values %s', (values,), None))
+            values.append(2)
+            handler.close()
+            with open(filename) as fin:
+                self.assertEqual(fin.read(), 'INFO Values [1]\n')
+
+    def test_recent_records(self):
+        from game.dynamics import DynamicsLoggerAdapter
+        class Rendered:
+            count = 0
+            def __str__(self):
+                Rendered.count += 1
+                return 'rendered'
+        adapter = DynamicsLoggerAdapter(logging.getLogger('game.test_log'), object())
+        adapter.debug('Message %s', Rendered())
+
+        # Debug messages are kept, but only rendered when dumped
+        self.assertEqual(Rendered.count, 0)
+        with self.assertLogs('game.test_log', 'ERROR') as logs:
+            adapter.dump_recent()
+        self.assertIn('DEBUG Message rendered', logs.output[0])
+        self.assertEqual(Rendered.count, 1)
+
+class TestStaticBundles(TestCase):
+    def render_bundle(self, name):
+        return Template('{%% load game_extras %%}{%% static_bundle "%s" %%}' % name).render(Context())
+
+    def test_collectstatic(self):
+        # Before collectstatic, the sources are linked one by one
+        html = self.render_bundle('bundle.css')
+        self.assertIn('/static/reset.css', html)
+        self.assertIn('/static/lupus.css', html)
+
+        with tempfile.TemporaryDirectory() as root, override_settings(STATIC_ROOT=root):
+            call_command('collectstatic', interactive=False, verbosity=0)
+            for bundle in ['bundle.css', 'bundle.js']:
+                name = staticfiles_storage.stored_name(bundle)
+                self.assertRegex(name, r'^bundle\.[0-9a-f]{12}\.(css|js)$')
+                self.assertEqual(self.render_bundle(bundle).count('/static/'), 1)
+                self.assertIn('/static/%s' % name, self.render_bundle(bundle))
+
+                with staticfiles_storage.open(name) as fin:
+                    content = fin.read()
+                with staticfiles_storage.open(name + '.gz') as fin:
+                    self.assertEqual(gzip.decompress(fin.read()), content)
+
+            # Style sheets are minified
+            with staticfiles_storage.open(staticfiles_storage.stored_name('bundle.css')) as fin:
+                content = fin.read().decode('utf-8')
+            self.assertNotIn('/*', content)
+            self.assertNotIn('\n\n', content)
+            self.assertIn('body{', content)
+
+            # Other files get a hashed name too
+            self.assertRegex(staticfiles_storage.stored_name('logo.svg'), r'^logo\.[0-9a-f]{12}\.svg$')
+
+class TestLiveUpdates(GameTest, TestCase):
+    roles = [Contadino, Contadino, Veggente, Lupo, Negromante]
+    spectral_sequence = []
+
+    def test_updates(self):
+        self.advance_turn(NIGHT)
+        self.usepower(self.veggente, self.lupo)
+        c = Client()
+        c.force_login(self.veggente.user)
+
+        response = c.get('/game/test/updates/', {'cursor': 0, 'timeout': 0})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        cursor = data['cursor']
+        self.assertEqual(cursor, len(self.dynamics.events))
+
+        # Nothing new: the client waits without any query and then
+        # gets no messages
+        live._last_refresh[self.game.pk] = float('inf')
+        with self.assertNumQueries(0):
+            _, new_cursor, messages = async_to_sync(live.wait_for_messages)(self.dynamics, self.veggente, cursor, 0.1)
+        del live._last_refresh[self.game.pk]
+        self.assertEqual((new_cursor, messages), (cursor, []))
+        response = c.get('/game/test/updates/', {'cursor': cursor, 'timeout': 0})
+        self.assertEqual(response.json()['messages'], [])
+
+        # The result of the power is only seen by its user
+        self.advance_turn()
+        data = c.get('/game/test/updates/', {'cursor': cursor, 'timeout': 0}).json()
+        self.assertEqual(data['turn'], self.dynamics.current_turn.turn_as_italian_string())
+        self.assertTrue(any('aura nera' in message['text'] for message in data['messages']))
+
+        c.force_login(self.negromante.user)
+        data = c.get('/game/test/updates/', {'cursor': cursor, 'timeout': 0}).json()
+        self.assertFalse(any('aura nera' in message['text'] for message in data['messages']))
+
+        # A cursor from another history asks for a reload
+        self.assertTrue(c.get('/game/test/updates/', {'cursor': 10000, 'timeout': 0}).json()['reload'])
+
+    def test_hidden_turns(self):
+        self.advance_turn(DAY)
+        c = Client()
+        c.force_login(self.veggente.user)
+        cursor = c.get('/game/test/updates/', {'cursor': 0, 'timeout': 0}).json()['cursor']
+
+        # As in the status page, players do not see the events of days
+        # and nights
+        self.dynamics.inject_event(FreeTextEvent(text='Testo del giorno', timestamp=get_now()))
+        data = c.get('/game/test/updates/', {'cursor': cursor, 'timeout': 0}).json()
+        self.assertEqual(data['messages'], [])
+
+        self.advance_turn(SUNSET)
+        self.dynamics.inject_event(FreeTextEvent(text='Testo del tramonto', timestamp=get_now()))
+        data = c.get('/game/test/updates/', {'cursor': cursor, 'timeout': 0}).json()
+        self.assertIn('Testo del tramonto', [message['text'] for message in data['messages']])
+        self.assertNotIn('Testo del giorno', [message['text'] for message in data['messages']])
+
+        # Events are listed during days and nights
+        self.advance_turn(NIGHT)
+        response = c.get('/game/test/status/')
+        self.assertContains(response, 'Testo del tramonto')
+        self.assertNotContains(response, 'Testo del giorno')
+
+class TestTurnFragments(GameTest, TestCase):
+    roles = [Contadino, Contadino, Veggente, Lupo, Negromante]
+    spectral_sequence = []
+
+    def test_closed_turns_are_cached(self):
+        self.usepower(self.veggente, self.lupo)
+        self.advance_turn(DAY)
+        dawn = self.game.current_turn.prev_turn()
+
+        c = Client()
+        c.force_login(self.veggente.user)
+        response = c.get('/game/test/personalinfo/')
+        first = dict(response.context['events'])[dawn]
+        self.assertEqual(len(first['standard']), 2)
+        self.assertIn('aura nera', first['html'])
+
+        # The second time the dawn is not even computed
+        response = c.get('/game/test/personalinfo/')
+        second = dict(response.context['events'])[dawn]
+        self.assertEqual(second['standard'], [])
+        self.assertEqual(second['html'], first['html'])
+        self.assertContains(response, 'aura nera')
+        self.assertNotContains(response, '&lt;div')
+
+        # Fragments depend on the point of view
+        c.force_login(self.lupo.user)
+        response = c.get('/game/test/personalinfo/')
+        self.assertNotContains(response, 'aura nera')
+
 class TestLetterRender(GameTest, TestCase):
     roles =  [getattr(v2, k) for k in dir(v2) if isclass(getattr(v2, k)) and issubclass(getattr(v2, k), Role) and getattr(v2, k).__module__ == 'game.roles.v2']
     roles = [x for x in roles if not x.dead_power]
@@ -19,7 +19,7 @@ from game.utils import get_now, advance_to_time
 
 from datetime import timedelta, datetime, time
 
-from .test_utils import GameTest
+from .test_utils import GameTest, test_dump_path
 
 class TestWebInterface(GameTest, TestCase):
     roles = [Contadino, Veggente, Stalker, Lupo, Diavolo, Negromante]
@@ -233,14 +233,14 @@ class TestWebInterface(GameTest, TestCase):
         response = c.get('/game/test/dump/')
         self.assertEqual(response.status_code, 200)
 
-        with open('test_dumps/test_load.json', 'wb') as f:
-            f.write(response.content)
+        with open(test_dump_path(self, 'test_load'), 'wb') as f:
+            f.write(b''.join(response.streaming_content))
 
         self.burn(self.contadino)
         response = c.post('/game/test/restart/', {'current_turn_pk': self.game.current_turn.pk})
         self.assertEqual(self.game.current_turn.phase, CREATION)
 
-        with open('test_dumps/test_load.json', 'rb') as f:
+        with open(test_dump_path(self, 'test_load'), 'rb') as f:
             response = c.post('/game/test/load/', {'json': f}, follow=True)
 
         self.assertEqual(response.status_code, 200)
@@ -17,6 +17,7 @@ urlpatterns = [
     path('vote/', VoteView.as_view(), name='vote'),
     path('elect/', ElectView.as_view(), name='elect'),
     path('personalinfo/', PersonalInfoView.as_view(), name='personalinfo'),
+    path('updates/', live_updates, name='updates'), # Nuovi messaggi, in long polling
     path('appoint/', AppointView.as_view(), name='appoint'),
     path('comment/', CommentView.as_view(), name='comment'),
 
@@ -48,8 +49,10 @@ urlpatterns = [
     path('delete/', not_implemented, name='delete'), # Cancella la partita
     
     path('adminstatus/', AdminStatusView.as_view(), name='adminstatus'),
+    path('profile/', DynamicsProfileView.as_view(), name='profile'), # Tempi e query della dinamica
     path('advanceturn/', AdvanceTurnView.as_view(), name='advanceturn'),
     path('forcevictory/', ForceVictoryView.as_view(), name='forcevictory'),
+    path('whatif/', WhatIfView.as_view(), name='whatif'), # Simula l'alba con comandi alternativi
     path('pointofview/', PointOfView.as_view(), name='pointofview'),
     path('dump/', DumpView.as_view(), name='dump'),
 ]
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import sys
 import datetime
 
 from .constants import *
@@ -37,3 +38,17 @@ def dir_dict(list_):
 
 def rev_dict(list_):
     return dict([(y, x) for (x, y) in list(list_) + [(None, None)]])
+
+def ratio(num, den):
+    # Formats num / den for the tables of the analysis scripts
+    return '%.3f' % (num / den) if den > 0 else '-'
+
+def print_table(title, header, rows, file=None):
+    # Prints rows as tab separated values, under title and header
+    if file is None:
+        file = sys.stdout
+    print(file=file)
+    print(title, file=file)
+    print('\t'.join(header), file=file)
+    for row in rows:
+        print('\t'.join(str(x) for x in row), file=file)
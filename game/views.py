@@ -2,12 +2,19 @@
 # coding=utf8
 
 import json
+import hashlib
+import asyncio
+import concurrent.futures
+import zlib
+
+from asgiref.sync import markcoroutinefunction, sync_to_async
 
 from django.shortcuts import get_object_or_404, render, redirect
-from django.http import HttpResponse, HttpResponseRedirect
+from django.template.loader import render_to_string
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
 from django.urls import reverse
 
-from django.db.models import Q
+from django.db.models import Q, Count, Max
 
 from django.views import generic
 from django.views.generic.base import View, TemplateView, RedirectView
@@ -18,19 +25,27 @@ from django.contrib.auth import login, logout, authenticate
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.views import redirect_to_login
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
 from django.utils.decorators import method_decorator
+from django.utils.http import quote_etag
 from django.utils.text import slugify
 from django.contrib.auth.decorators import user_passes_test
 from django.core import exceptions
 
 from django import forms
 
+from django.contrib import messages
 from django.contrib.auth.models import User
+from django.core.cache import caches
 from game.models import *
 from game.events import *
 from game.utils import get_now
 from game.decorators import *
 from game.weather import Weather
+from game.live import wait_for_messages, LONG_POLL_TIMEOUT
+from game.snapshot import is_turn_visible
+from game.simulation import simulate_alternatives, MAX_ALTERNATIVES, SIMULATION_TIMEOUT
+from game.onboarding import create_users
 from game.widgets import MultiSelect
 from datetime import datetime, timedelta
 
@@ -38,8 +53,30 @@ from datetime import datetime, timedelta
 def not_implemented(request):
     raise NotImplementedError("View not implemented")
 
+# Read-only pages are served asynchronously, so that under ASGI they
+# keep a thread only while they need the database, the session or
+# the templates (none of which can be used from the event loop), and
+# not while they wait for anything else
+class AsyncReadMixin:
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Tell Django to await the view
+        return markcoroutinefunction(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        # Only get() (and head()) are coroutines: options() and
+        # http_method_not_allowed() answer right away
+        response = super().dispatch(request, *args, **kwargs)
+        if asyncio.iscoroutine(response):
+            response = await response
+        return response
+
+    async def get(self, request, *args, **kwargs):
+        # The response is rendered in a thread by Django
+        return await sync_to_async(super().get)(request, *args, **kwargs)
+
 # Home Page
-class HomeView(TemplateView):
+class HomeView(AsyncReadMixin, TemplateView):
     template_name = "index.html"
 
     def get_context_data(self, **kwargs):
@@ -52,14 +89,16 @@ class HomeView(TemplateView):
         else:
             games = Game.objects.filter(public=True)
 
-        # Remove failed games
-        games = [g for g in games if g.get_dynamics() is not None]
+        # Remove failed games; the others are read from their
+        # published snapshots
+        games = [(g, g.get_dynamics()) for g in games]
+        games = [(g, d.snapshot) for g, d in games if d is not None]
 
         context = super().get_context_data(**kwargs)
         context.update({
-            'beginning_games': [g for g in games if not g.started],
-            'ongoing_games': [g for g in games if g.started and not g.is_over],
-            'ended_games': [g for g in games if g.is_over]
+            'beginning_games': [g for g, s in games if not s.started],
+            'ongoing_games': [g for g, s in games if s.started and not s.over],
+            'ended_games': [g for g, s in games if s.over]
         })
         return context
 
@@ -107,7 +146,7 @@ class PrototypesView(TemplateView):
 class ErrorView(TemplateView):
     template_name = 'error.html'
 
-class AnnouncementsListView(ListView):
+class AnnouncementsListView(AsyncReadMixin, ListView):
     model = Announcement
     template_name = 'announcements.html'
     context_object_name = 'announcements'
@@ -152,7 +191,7 @@ class EventDeleteView(DeleteView):
 ## STATUS VIEWS
 
 # Generic view for showing events
-class EventListView(TemplateView):
+class EventListView(AsyncReadMixin, TemplateView):
     classified = False
     display_time = False
     point_of_view = None
@@ -163,20 +202,84 @@ class EventListView(TemplateView):
         else:
             return self.point_of_view
 
-    # Retrieve weather
+    # Retrieve weather, as stored in the session by update_weather()
     def get_weather(self):
-        stored_weather = self.request.session.get('weather', None)
+        return Weather(self.request.session.get('weather', None))
+
+    async def update_weather(self):
+        # Ask for the weather without keeping the thread used by the
+        # database busy, before the page is rendered
+        stored_weather = await sync_to_async(self.request.session.get)('weather', None)
         weather = Weather(stored_weather)
-        uptodate = weather.get_data()
-        if not uptodate:
-            self.request.session['weather'] = weather.stored()
-        return weather
+        if not weather.is_uptodate():
+            await sync_to_async(weather.get_data, thread_sensitive=False)()
+            await sync_to_async(self.request.session.__setitem__)('weather', weather.stored())
+
+    def get_etag(self):
+        """Return an ETag for the page, computed without rendering it,
+        or None if the page has to be rendered anyway. There is no
+        Last-Modified: the page also changes when no timestamp does
+        (weather, comments, the point of view of the GM)."""
+        request = self.request
+        game = request.game
+        player = self.get_point_of_view()
+        dynamics = request.dynamics
+        if dynamics is None:
+            return None
+
+        # Pending messages and a stale weather both need a render
+        if len(messages.get_messages(request)) > 0:
+            return None
+        weather = Weather(request.session.get('weather', None))
+        if not weather.is_uptodate():
+            return None
+
+        if player == 'admin':
+            dynamics = dynamics.get_preview_dynamics()
+            comments = Comment.objects.filter(turn__game=game).filter(visible=True).aggregate(Count('pk'), Max('pk'))
+            comments = (comments['pk__count'], comments['pk__max'])
+        else:
+            comments = None
+        snapshot = dynamics.snapshot
+        turn = request.current_turn
+        announcement = request.game_context.latest_announcement
+
+        viewer = (player if isinstance(player, str) else player.pk, request.user.pk, request.is_master,
+                  request.player.pk if request.player is not None else None)
+        validator = (game.pk, game.title, game.description, game.postgame_info, snapshot.history,
+                     turn.pk if turn is not None else None, turn.end.isoformat() if turn is not None and turn.end is not None else None,
+                     announcement.pk if announcement is not None else None, comments, weather.description, viewer)
+        return hashlib.md5(repr(validator).encode('utf-8')).hexdigest()
+
+    async def get(self, request, *args, **kwargs):
+        # Refreshing the page does not render it again if nothing
+        # happened in the meantime
+        etag = await sync_to_async(self.get_etag)()
+        response = None
+        if etag is not None:
+            response = get_conditional_response(request, etag=quote_etag(etag))
+        if response is None:
+            await self.update_weather()
+            response = await super().get(request, *args, **kwargs)
+        return self.patch_response(request, response, etag)
+
+    def patch_response(self, request, response, etag):
+        if etag is not None:
+            response['ETag'] = quote_etag(etag)
+        # Proxies can keep pages of anonymous users, but everybody has
+        # to check that the page is still valid
+        if request.user.is_authenticated:
+            patch_cache_control(response, private=True, max_age=0, must_revalidate=True)
+        else:
+            patch_cache_control(response, public=True, max_age=0, must_revalidate=True)
+        patch_vary_headers(response, ['Cookie'])
+        return response
 
     # Retrieve events depending on the pov
-    def get_events(self):
+    def get_events(self, display_votes=False, display_mayor=False):
         game = self.request.game
         player = self.get_point_of_view()
-        dynamics = game.get_dynamics()
+        dynamics = self.request.dynamics
         assert dynamics is not None
         assert not dynamics.failed
 
@@ -186,21 +289,42 @@ class EventListView(TemplateView):
 
         assert player == 'admin' or not dynamics.preview
 
-        if player == 'admin':
-            turns = dynamics.turns
-        else:
-            turns = [turn for turn in dynamics.turns if turn.phase in [CREATION, DAWN, SUNSET]]
-
-        events = dynamics.events
+        # Read the published state, the dynamics might be updating
+        snapshot = dynamics.snapshot
+        turns = [turn for turn in snapshot.turns if is_turn_visible(turn, player)]
 
         if player == 'admin':
             comments = Comment.objects.filter(turn__game=game).filter(visible=True).order_by('timestamp')
         else:
             comments = []
 
+        # Closed turns do not change anymore, so they are rendered once
+        # and taken from the cache afterwards; the key changes if their
+        # events or comments do (for example, if some is deleted)
+        turn_events = dict([(turn, []) for turn in turns])
+        for event in snapshot.events:
+            if event.turn in turn_events:
+                turn_events[event.turn].append(event)
+        turn_comments = dict([(turn, []) for turn in turns])
+        for comment in comments:
+            turn_comments[comment.turn].append(comment)
+        pov = player if isinstance(player, str) else player.pk
+        current_turn = self.request.current_turn
+        keys = {}
+        for turn in turns:
+            if turn.pk is None or turn == current_turn:
+                continue
+            version = (game.pk, turn.pk, turn.begin.isoformat(), pov, display_votes, display_mayor,
+                       len(turn_events[turn]), max([event.pk or 0 for event in turn_events[turn]], default=0),
+                       len(turn_comments[turn]), max([comment.pk for comment in turn_comments[turn]], default=0))
+            keys[turn] = 'events:%s' % hashlib.md5(repr(version).encode('utf-8')).hexdigest()
+        turns_cache = caches['turns']
+        cached = turns_cache.get_many(list(keys.values()))
+
         # If requesting a preview, show messages as admin
 
-        result = dict([(turn, { 'standard': [], VOTE: {}, ELECT: {}, 'initial_propositions': [], 'soothsayer_propositions': [], 'telepathy': {}, 'comments': [] }) for turn in turns ])
+        result = dict([(turn, { 'standard': [], VOTE: {}, ELECT: {}, 'initial_propositions': [], 'soothsayer_propositions': [], 'telepathy': {}, 'comments': [], 'html': cached.get(keys.get(turn)) }) for turn in turns ])
+        events = [event for event in snapshot.events if event.turn in result and result[event.turn]['html'] is None]
         for event in events:
             message = event.to_player_string(player)
             if message is not None:
@@ -235,6 +359,19 @@ class EventListView(TemplateView):
         for comment in comments:
             result[comment.turn]['comments'].append(comment)
 
+        fragments = {}
+        for turn, key in keys.items():
+            if result[turn]['html'] is None:
+                result[turn]['html'] = render_to_string('turn_events.html', {
+                    'turn': turn,
+                    'values': result[turn],
+                    'display_votes': display_votes,
+                    'display_mayor': display_mayor,
+                    'CREATION': CREATION, 'DAWN': DAWN, 'SUNSET': SUNSET, 'VOTE': VOTE, 'ELECT': ELECT,
+                })
+                fragments[key] = result[turn]['html']
+        turns_cache.set_many(fragments, None)
+
         ordered_result = [ (turn, result[turn]) for turn in turns ]
 
         return ordered_result
@@ -249,7 +386,7 @@ class EventListView(TemplateView):
             display_mayor = False
 
         context.update({
-            'events': self.get_events(),
+            'events': self.get_events(display_votes, display_mayor),
             'weather': self.get_weather(),
             'classified': self.classified,
             'display_time': self.display_time,
@@ -272,6 +409,12 @@ class PersonalInfoView(EventListView):
     def get_point_of_view(self):
         return self.request.player
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        # Show the player as in the published state of the game
+        context['player'] = self.request.snapshot.get_canonical_player(self.request.player)
+        return context
+
 
 # View of all info (for GM only)
 @method_decorator(can_access_admin_view, name='dispatch')
@@ -281,6 +424,44 @@ class AdminStatusView(EventListView):
     classified = True
     display_time = True
 
+# Timings of the dynamics (for GM only)
+@method_decorator(master_required, name='dispatch')
+class DynamicsProfileView(TemplateView):
+    template_name = 'profile.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.update({
+            'classified': True,
+            'profiler': self.request.dynamics.profiler,
+        })
+        return context
+
+# Long polling for the messages produced after a cursor (the number
+# of events already seen by the client)
+async def live_updates(request, game_name):
+    dynamics = request.dynamics
+    snapshot = request.snapshot
+    if dynamics is None or snapshot is None:
+        return JsonResponse({'reload': True})
+    try:
+        cursor = int(request.GET.get('cursor', 0))
+        timeout = float(request.GET.get('timeout', LONG_POLL_TIMEOUT))
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    # The history has been rewritten, the client has to start again
+    if not 0 <= cursor <= len(snapshot.events):
+        return JsonResponse({'reload': True})
+
+    pov = request.player if request.player is not None else 'public'
+    snapshot, cursor, messages = await wait_for_messages(dynamics, pov, cursor, timeout)
+    return JsonResponse({
+        'cursor': cursor,
+        'turn': snapshot.current_turn.turn_as_italian_string(),
+        'messages': [{'turn': turn.turn_as_italian_string(), 'text': message} for turn, message in messages],
+    })
+
 ## COMMAND VIEWS
 
 # "Generic" form for submitting actions
@@ -372,10 +553,37 @@ class CommandView(GameFormView):
     def submitted(self):
         return render(self.request, 'command_submitted.html', {'title': self.title, 'classified': True})
 
-    def save_command(self, cleaned_data):
-        # Validates the form data and possibly saves the command, returning True in case of success and False otherwise
+    def not_allowed(self):
+        return render(self.request, 'command_not_allowed.html', {'message': 'La scelta effettuata non è valida.', 'classified': True})
+
+    def make_command(self, cleaned_data):
+        # Validates the form data, returning the command to be submitted or None if it is not valid
         raise Exception ('Command not specified.')
 
+    def validated_command(self, command):
+        # Completes command, returning it if the player can give it now and None otherwise
+        command.player = self.request.player
+        command.turn = self.request.current_turn
+        command.timestamp = get_now()
+        if not command.validate(self.request.dynamics):
+            return None
+        return command
+
+    def dispatch(self, request, *args, **kwargs):
+        # Lazy updates do not wait for an update in progress, so the
+        # dynamics is only read while holding its lock. The command is
+        # submitted once the lock is released, since the update done
+        # by submit_command() may run in another thread
+        self.command = None
+        with request.dynamics.update_lock:
+            response = super().dispatch(request, *args, **kwargs)
+        if self.command is not None:
+            if request.dynamics.submit_command(self.command):
+                return self.submitted()
+            else:
+                return self.not_allowed()
+        return response
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context.update({
@@ -393,10 +601,12 @@ class CommandView(GameFormView):
         return kwargs
 
     def form_valid(self, form):
-        if self.save_command(form.cleaned_data):
-            return self.submitted()
-        else:
-            return render(self.request, 'command_not_allowed.html', {'message': 'La scelta effettuata non è valida.', 'classified': True})
+        command = self.make_command(form.cleaned_data)
+        if command is None:
+            return self.not_allowed()
+        # Submitted by dispatch()
+        self.command = command
+        return None
 
 ## Night power
 
@@ -406,20 +616,19 @@ class UsePowerView(CommandView):
     url_name = 'game:usepower'
 
     def can_execute_action(self):
-        return self.request.player is not None and self.request.player.can_use_power()
+        return self.request.player is not None and self.request.player.can_use_power(self.request.dynamics, self.request.current_turn)
 
     def get_fields(self):
         player = self.request.player
-        game = player.game
         power = player.power
-        dynamics = game.get_dynamics()
+        options = self.request.dynamics.get_target_options(power)
 
-        targets = power.get_targets(dynamics)
-        targets2 = power.get_targets2(dynamics)
-        role_classes = power.get_targets_role_class(dynamics)
+        targets = options.targets
+        targets2 = options.targets2
+        role_classes = options.role_classes
         if role_classes is not None:
-            role_classes -= {power.get_target_role_class_default(dynamics)}
-        multiple_role_classes = power.get_targets_multiple_role_class(dynamics)
+            role_classes = role_classes - {options.role_class_default}
+        multiple_role_classes = options.multiple_role_classes
 
         initial = power.recorded_target
         initial2 = power.recorded_target2
@@ -442,74 +651,21 @@ class UsePowerView(CommandView):
 
         return fields
 
-    def save_command(self, cleaned_data):
-        player = self.request.player
-        power = player.power
-        dynamics = self.request.game.get_dynamics()
+    def make_command(self, cleaned_data):
+        target = cleaned_data.get('target') or None
+        target2 = cleaned_data.get('target2') or None
 
-        targets = power.get_targets(dynamics)
-        targets2 = power.get_targets2(dynamics)
-        role_classes = power.get_targets_role_class(dynamics)
-        role_class_default = power.get_target_role_class_default(dynamics)
-        multiple_role_classes = power.get_targets_multiple_role_class(dynamics)
+        role_class = cleaned_data.get('role_class') or None
+        if role_class is not None:
+            role_class = Role.get_from_string(role_class)
 
-        target = cleaned_data['target']
-        target2 = None
-        role_class = None
         multiple_role_class = None
+        if 'multiple_role_class' in cleaned_data:
+            multiple_role_class = {Role.get_from_string(x) for x in cleaned_data['multiple_role_class']}
 
-        if target == '':
-            target = None
-
-        if target is not None and not target in targets:
-            return False
-
-        if targets2 is not None:
-            target2 = cleaned_data['target2']
-            if target2 == '':
-                target2 = None
-            if not target2 in targets2 and target is not None:
-                # If target2 is not valid (or None), make the command not valid
-                # unless target is None (which means that the power will not be used)
-                return False
-            if not power.allow_target2_same_as_target and target2 == target:
-                return False
-
-        if role_classes is not None:
-            role_class = cleaned_data['role_class']
-            if role_class == '':
-                role_class = role_class_default
-            else:
-                role_class = Role.get_from_string(role_class)
-            if not role_class in role_classes and target is not None:
-                # If role_class is not valid (or None), make the command not valid
-                # unless target is None (which means that the power will not be used)
-                return False
-
-        if multiple_role_classes is not None:
-            multiple_role_class = cleaned_data['multiple_role_class']
-            if role_class == '':
-                multiple_role_class = None
-            else:
-                multiple_role_class = {Role.get_from_string(x) for x in multiple_role_class}
-
-            if not multiple_role_class.issubset(multiple_role_classes) and target is not None:
-                # If role_class is not valid (or None), make the command not valid
-                # unless target is None (which means that the power will not be used)
-                return False
-
-        # If target is None, then the other fields are set to None
-        if target is None:
-            target2 = None
-            role_class = None
-            multiple_role_class = None
-
-        command = CommandEvent(player=player, type=USEPOWER, target=target, target2=target2, role_class=role_class, multiple_role_class=multiple_role_class, turn=player.game.current_turn, timestamp=get_now())
-        if not command.check_phase(turn=self.request.current_turn):
-            return False
-        dynamics = self.request.player.game.get_dynamics()
-        dynamics.inject_event(command)
-        return True
+        # Empty fields get their defaults, or are cleared if target is
+        # None (which means that the power will not be used)
+        return self.validated_command(CommandEvent(type=USEPOWER, target=target, target2=target2, role_class=role_class, multiple_role_class=multiple_role_class))
 
 ## Stake vote
 
@@ -519,34 +675,18 @@ class VoteView(CommandView):
     url_name = 'game:vote'
 
     def can_execute_action(self):
-        return self.request.player is not None and self.request.player.can_vote()
+        return self.request.player is not None and self.request.player.can_vote(self.request.dynamics, self.request.current_turn)
 
     def get_fields(self):
         player = self.request.player
-        game = player.game
-        choices = game.get_alive_players()
+        choices = self.request.dynamics.get_alive_players()
         initial = player.recorded_vote
 
         fields = {'target': {'choices': choices, 'initial': initial, 'label': 'Vota per condannare a morte:'} }
         return fields
 
-    def save_command(self, cleaned_data):
-        player = self.request.player
-        game = player.game
-        target = cleaned_data['target']
-
-        if target == '':
-            target = None
-
-        if target is not None and target not in game.get_alive_players():
-            return False
-
-        command = CommandEvent(player=player, type=VOTE, target=target, turn=game.current_turn, timestamp=get_now())
-        if not command.check_phase(turn=self.request.current_turn):
-            return False
-        dynamics = self.request.player.game.get_dynamics()
-        dynamics.inject_event(command)
-        return True
+    def make_command(self, cleaned_data):
+        return self.validated_command(CommandEvent(type=VOTE, target=cleaned_data['target'] or None))
 
 ## Mayor vote
 
@@ -556,34 +696,18 @@ class ElectView(CommandView):
     url_name = 'game:elect'
 
     def can_execute_action(self):
-        return self.request.player is not None and self.request.player.can_vote() and self.request.dynamics.rules.mayor
+        return self.request.player is not None and self.request.player.can_vote(self.request.dynamics, self.request.current_turn) and self.request.dynamics.rules.mayor
 
     def get_fields(self):
         player = self.request.player
-        game = player.game
-        choices = game.get_alive_players()
+        choices = self.request.dynamics.get_alive_players()
         initial = player.recorded_elect
 
         fields = {'target': {'choices': choices, 'initial': initial, 'label': 'Vota per eleggere:'} }
         return fields
 
-    def save_command(self, cleaned_data):
-        player = self.request.player
-        game = player.game
-        target = cleaned_data['target']
-
-        if target == '':
-            target = None
-
-        if target is not None and target not in game.get_alive_players():
-            return False
-
-        command = CommandEvent(player=player, type=ELECT, target=target, turn=game.current_turn, timestamp=get_now())
-        if not command.check_phase(turn=self.request.current_turn):
-            return False
-        dynamics = self.request.player.game.get_dynamics()
-        dynamics.inject_event(command)
-        return True
+    def make_command(self, cleaned_data):
+        return self.validated_command(CommandEvent(type=ELECT, target=cleaned_data['target'] or None))
 
 
 # View for appointing a successor (for mayor only)
@@ -593,37 +717,19 @@ class AppointView(CommandView):
     url_name = 'game:appoint'
 
     def can_execute_action(self):
-        return self.request.player is not None and self.request.player.is_mayor() and self.request.dynamics.rules.mayor and (self.request.game.current_turn.phase in [DAY, NIGHT])
+        return self.request.player is not None and self.request.player.is_mayor(self.request.dynamics) and self.request.dynamics.rules.mayor and (self.request.current_turn.phase in [DAY, NIGHT])
 
     def get_fields(self):
         player = self.request.player
-        game = player.game
-        choices = [p for p in game.get_alive_players() if p.pk != player.pk]
-        initial = game.get_dynamics().appointed_mayor
+        dynamics = self.request.dynamics
+        choices = [p for p in dynamics.get_alive_players() if p.pk != player.pk]
+        initial = dynamics.appointed_mayor
 
         fields = {'target': {'choices': choices, 'initial': initial, 'label': 'Designa come successore:'} }
         return fields
 
-    def save_command(self, cleaned_data):
-        player = self.request.player
-        game = player.game
-        target = cleaned_data['target']
-
-        if target == '':
-            target = None
-
-        if target is not None and target not in game.get_alive_players():
-            return False
-
-        if target is not None and target == player:
-            return False
-
-        command = CommandEvent(player=player, type=APPOINT, target=target, turn=game.current_turn, timestamp=get_now())
-        if not command.check_phase(turn=self.request.current_turn):
-            return False
-        dynamics = self.request.player.game.get_dynamics()
-        dynamics.inject_event(command)
-        return True
+    def make_command(self, cleaned_data):
+        return self.validated_command(CommandEvent(type=APPOINT, target=cleaned_data['target'] or None))
 
 
 
@@ -868,14 +974,9 @@ class NewPlayerView(GameFormView):
     success_url = 'game:status'
 
     def form_valid(self, form):
-        user = form.save(commit=False)
-        user.save()
-        profile = Profile(user=user)
-        profile.gender = form.cleaned_data.get('gender')
-        profile.save()
-        player = Player(game=self.request.game, user=user)
-        player.save()
-        self.request.game.kill_dynamics()
+        data = dict((field, form.cleaned_data.get(field)) for field in ['username', 'first_name', 'last_name', 'email', 'gender'])
+        data['password'] = None
+        create_users([data], game=self.request.game, workers=1)
         return super().form_valid(form)
 
 # View to add or remove masters
@@ -990,10 +1091,10 @@ class AdvanceTurnView(ConfirmView):
         return 'Vuoi davvero avanzare %s%s?' % (next_turn.preposition_to_as_italian_string(), next_turn.turn_as_italian_string())
 
     def can_execute_action(self):
-        game = self.request.game
-        if game.current_turn.phase == CREATION:
-            return game.started and game.get_dynamics().players[0].role is not None and game.get_dynamics().check_missing_soothsayer_propositions() is None
-        return not self.request.game.is_over
+        context = self.request.game_context
+        if context.current_turn.phase == CREATION:
+            return context.started and context.dynamics.players[0].role is not None and context.dynamics.check_missing_soothsayer_propositions() is None
+        return not context.is_over
 
     def form_valid(self, form):
         game = self.request.game
@@ -1388,7 +1489,7 @@ class ForceVictoryView(GameFormView):
         return context
 
     def can_execute_action(self):
-        return not self.request.game.is_over and self.request.game.started
+        return not self.request.game_context.is_over and self.request.game_context.started
 
     def form_valid(self, form):
         self.object = form.save(commit=False)
@@ -1398,6 +1499,94 @@ class ForceVictoryView(GameFormView):
         return render(self.request, 'command_submitted.html', {'classified': True})
 
 
+# View for simulating the dawn with alternative night commands
+class WhatIfForm(forms.Form):
+    def __init__(self, *args, **kwargs):
+        self.game = kwargs.pop('game', None)
+        super().__init__(*args, **kwargs)
+
+        def choices(targets):
+            players = sorted([player for player in targets if player is not None], key=lambda x: x.user.last_name)
+            return [('', 'Come nella partita'), ('None', '(Nessuno)')] + [(player.pk, player.full_name) for player in players]
+
+        # The live dynamics is only read while holding its lock, as in
+        # CommandView
+        dynamics = self.game.get_dynamics()
+        with dynamics.update_lock:
+            turn = dynamics.current_turn
+            self.players = [player for player in dynamics.players if player.can_use_power(dynamics, turn)]
+            for player in self.players:
+                options = dynamics.get_target_options(player.power)
+                if options.targets is None:
+                    continue
+                label = '%s (%s)' % (player.full_name, player.power.name)
+                for i in range(MAX_ALTERNATIVES):
+                    self.fields['alt%d_%d' % (i, player.pk)] = forms.ChoiceField(choices=choices(options.targets), required=False, label=label)
+                    if options.targets2 is not None:
+                        self.fields['alt%d_%d_2' % (i, player.pk)] = forms.ChoiceField(choices=choices(options.targets2), required=False, label=player.power.message2)
+
+    def alternative_fields(self):
+        return [[self[name] for name in self.fields if name.startswith('alt%d_' % i)] for i in range(MAX_ALTERNATIVES)]
+
+    def get_alternatives(self):
+        # Only the players whose target is changed are given a new
+        # command; empty alternatives are left out
+        usernames = dict((str(player.pk), player.user.username) for player in self.players)
+        usernames['None'] = None
+        alternatives = []
+        for i in range(MAX_ALTERNATIVES):
+            commands = []
+            for player in self.players:
+                target = self.cleaned_data.get('alt%d_%d' % (i, player.pk))
+                if not target:
+                    continue
+                target2 = self.cleaned_data.get('alt%d_%d_2' % (i, player.pk)) or 'None'
+                commands.append({'player': player.user.username, 'target': usernames[target], 'target2': usernames[target2]})
+            if commands:
+                alternatives.append(commands)
+        return alternatives
+
+@method_decorator(master_required, name='dispatch')
+class WhatIfView(GameFormView):
+    form_class = WhatIfForm
+    template_name = 'whatif.html'
+    title = 'Simula l\'alba'
+
+    def can_execute_action(self):
+        return self.request.game_context.started and not self.request.game_context.is_over and self.request.current_turn.phase == NIGHT
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.update({
+            'classified' : True,
+        })
+        return context
+
+    def form_valid(self, form):
+        alternatives = form.get_alternatives()
+        try:
+            outcomes = simulate_alternatives(self.request.game, alternatives, timeout=SIMULATION_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            form.add_error(None, 'La simulazione ha richiesto troppo tempo, riprova più tardi.')
+            return self.form_invalid(form)
+
+        # Players are named as in the rest of the site
+        names = dict((player.user.username, player.full_name) for player in self.request.dynamics.players)
+        columns = []
+        for i, outcome in enumerate(outcomes):
+            columns.append({
+                'title': 'Comandi effettivi' if i == 0 else 'Alternativa %d' % i,
+                'commands': [(names[command['player']], names.get(command['target'], '(Nessuno)')) for command in ([] if i == 0 else alternatives[i - 1])],
+                'messages': outcome['messages'],
+                'dead': [names[username] for username in outcome['dead']],
+                'mayor': names.get(outcome['mayor']),
+                'powers': sorted((names[username], success) for username, success in outcome['powers'].items()),
+                'rejected': [names[command['player']] for command in outcome['rejected']],
+                'winners': [TEAM_IT[team] for team in outcome['winners']] if outcome['winners'] is not None else None,
+            })
+        return self.render_to_response(self.get_context_data(form=form, columns=columns))
+
+
 # View for writing comments
 class CommentForm(forms.ModelForm):
     class Meta:
@@ -1417,8 +1606,7 @@ class CommentView(FormView):
     def can_comment(self):
         # Checks if the user can post a comment
         user = self.request.user
-        game = self.request.game
-        current_turn = game.current_turn
+        current_turn = self.request.current_turn
 
         if self.request.is_master:
             return True
@@ -1446,27 +1634,41 @@ class CommentView(FormView):
     def form_valid(self, form):
         user = self.request.user
         game = self.request.game
-        current_turn = game.current_turn
+        current_turn = self.request.current_turn
 
         if self.can_comment():
             text = form.cleaned_data['text']
             last_comment = Comment.objects.filter(user=user).filter(turn__game=game).filter(visible=True).order_by('-timestamp').first()
             # Check against double post
             if last_comment is None or last_comment.text != text:
-                comment = Comment(turn=game.current_turn, user=user, text=text)
+                comment = Comment(turn=current_turn, user=user, text=text)
                 comment.save()
 
         return super().form_valid(form)
 
 
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
 # Dump view (for GM only)
 @method_decorator(user_passes_test(is_staff_check), name='dispatch')
 class DumpView(View):
+    """Stream the dump of the game while it is produced; with
+    ?compact=1 the dump is written without indentation and gzipped."""
     def get(self, request, **kwargs):
         game = request.game
-        response = HttpResponse(content_type='application/json; charset=utf-8')
-        response['Content-Disposition'] = 'attachment; filename="%s.json"' % game.name
-        dump_game(game, response)
+        if request.GET.get('compact'):
+            response = StreamingHttpResponse(gzip_chunks(iter_dump_game(game, compact=True)),
+                                             content_type='application/gzip')
+            response['Content-Disposition'] = 'attachment; filename="%s.json.gz"' % game.name
+        else:
+            response = StreamingHttpResponse(iter_dump_game(game), content_type='application/json; charset=utf-8')
+            response['Content-Disposition'] = 'attachment; filename="%s.json"' % game.name
         return response
 
 # Load view
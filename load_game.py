@@ -22,7 +22,7 @@ def main():
     else:
         start_moment = get_now()
     game = create_game_from_dump(json.load(sys.stdin), start_moment)
-    print >> sys.stdout, game.pk
+    print(game.pk)
 
 if __name__ == '__main__':
     main()
@@ -1,31 +1,37 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+# Usage: load_users.py [GAME_NAME] [PROCESSES] < users.tsv
+#
+# Create the users listed in the standard input, one per line as
+# "Name Surname<TAB>email<TAB>username<TAB>gender[<TAB>password]"
+# (the password defaults to ciaociao). If GAME_NAME is given (and not
+# empty), the users also join that game as players. Passwords are
+# hashed by PROCESSES processes in parallel; nothing is written if
+# any line is wrong or any user already exists.
+
 import sys
 import os
-import json
-import datetime
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "lupus.settings")
 
 import django
 django.setup()
 
-from game.models import *
-from game.tests import *
-from game.utils import *
-from game.constants import *
+from game.models import Game
+from game.onboarding import parse_users_tsv, create_users, OnboardingError, HASHING_WORKERS
 
 def main():
-    for line in sys.stdin:
-        name, email, username, gender = line.strip().split('\t')
-        first_name, last_name = name.split(' ', 1)
-        u = User(first_name=first_name, last_name=last_name, email=email, username=username, password='ciaociao')
-        u.save()
-        profile = Profile(gender=gender)
-        u.profile = profile
-        profile.save()
-        u.save()
+    game = Game.objects.get(name=sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1] != '' else None
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else HASHING_WORKERS
+
+    try:
+        users = create_users(parse_users_tsv(sys.stdin), game=game, workers=processes)
+    except OnboardingError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    print('Created %d users%s' % (len(users), ' in %s' % game.name if game is not None else ''))
 
 if __name__ == '__main__':
     main()
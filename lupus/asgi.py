@@ -0,0 +1,19 @@
+"""
+ASGI config for lupus project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Serving the site through ASGI lets the long polling of live updates and the
+read-only pages (status, personal info, announcements, home) wait without
+keeping a thread busy.
+"""
+
+import os
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "lupus.settings")
+
+from django.core.asgi import get_asgi_application
+application = get_asgi_application()
+
+from django.conf import settings
+if settings.TURN_SCHEDULER:
+    from game.scheduler import start_turn_scheduler
+    start_turn_scheduler()
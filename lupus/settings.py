@@ -39,6 +39,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE = (
+    'game.middleware.QueryCountMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -54,6 +55,7 @@ MIDDLEWARE = (
 ROOT_URLCONF = 'lupus.urls'
 
 WSGI_APPLICATION = 'lupus.wsgi.application'
+ASGI_APPLICATION = 'lupus.asgi.application'
 
 
 # Database
@@ -77,6 +79,23 @@ if False:
             },
         }
 
+# Cache
+# The 'turns' cache keeps the rendered events of the turns that are
+# over; any backend shared by the web processes can be used instead
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'turns': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'turns',
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+        },
+    },
+}
+
 # This should make SQLite a lot faster by disabling fsync(), which has
 # dramatic performance implications when used with AUTOCOMMIT
 # See http://stackoverflow.com/questions/4534992/place-to-set-sqlite-pragma-option-in-django-project
@@ -110,6 +129,33 @@ STATICFILES_DIRS = (
     os.path.join(BASE_DIR, "static"),
 )
 
+# Built by "manage.py collectstatic": file names contain the hash of
+# their content, so the web server can serve them with far-future
+# "Cache-Control: public, max-age=31536000, immutable" headers (and
+# pick the .gz or .br copy, if present, for clients accepting it)
+STATIC_ROOT = os.path.join(BASE_DIR, "collected_static")
+
+STATICFILES_STORAGE = 'game.storage.BundledManifestStorage'
+
+# Files concatenated (and, for style sheets, minified) by collectstatic
+# into a single file each; see the static_bundle template tag
+STATIC_BUNDLES = {
+    'bundle.css': [
+        'reset.css',
+        'text.css',
+        'lupus.css',
+        'responsive.css',
+        'fish.css',
+        'unsemantic-grid-responsive-tablet.css',
+    ],
+    'bundle.js': [
+        'script.js',
+        'jquery-1.11.0.min.js',
+        'fish.js',
+        'slideout.min.js',
+    ],
+}
+
 
 # Templates
 
@@ -193,7 +239,7 @@ LOGGING = {
         },
         'dynamics': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
+            'class': 'game.log.BackgroundFileHandler',
             'filename': os.path.join(BASE_DIR, 'dynamics.log'),
             'formatter': 'simple'
         },
@@ -207,11 +253,24 @@ LOGGING = {
         'game.dynamics': {
             'handlers': ['dynamics'],
             'level': 'DEBUG',
-            'propagate': True,
+            'propagate': False,
         },
     },
 }
 
+# Collect timings and query counts of the dynamics, shown to GMs in
+# the profile page of each game
+PROFILE_DYNAMICS = False
+
+# Advance turns at their deadline from a background thread of each web
+# process, instead of waiting for the first request after it
+TURN_SCHEDULER = False
+
+# Tests run with Django's default runner; for the fast mode (test
+# databases in memory, cloned test games, one process per CPU) run
+#   python manage.py test game --testrunner=game.tests.runner.FastTestRunner
+# or set TEST_RUNNER = 'game.tests.runner.FastTestRunner'
+
 # GeoIP
 # GEOIP_PATH = os.path.join(BASE_DIR, 'geoip')
 
@@ -12,3 +12,8 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "lupus.settings")
 
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
+
+from django.conf import settings
+if settings.TURN_SCHEDULER:
+    from game.scheduler import start_turn_scheduler
+    start_turn_scheduler()
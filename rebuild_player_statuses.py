@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Usage: rebuild_player_statuses.py [GAME_NAME...]
+#
+# Replay the given games (all of them by default) and write again the
+# status of their players in each turn (see PlayerStatus), for
+# example for games played before it was recorded.
+
+import sys
+import os
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "lupus.settings")
+
+import django
+django.setup()
+
+from game.models import Game, PlayerStatus
+from game.dynamics import Dynamics
+
+def main():
+    games = Game.objects.filter(name__in=sys.argv[1:]) if len(sys.argv) > 1 else Game.objects.all()
+    for game in games.order_by('pk'):
+        PlayerStatus.objects.filter(turn__game=game).delete()
+        Dynamics(game).update()
+        print('%s: %d statuses' % (game.name, PlayerStatus.objects.filter(turn__game=game).count()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Usage: run_turn_scheduler.py [POLL_INTERVAL]
+#
+# Advance the turns of all the games as soon as they end, until
+# interrupted, instead of running perform_turn_advance.py from cron
+# (which is still there to advance the running game by hand); to
+# keep the dynamics of the web server warm as well, set
+# TURN_SCHEDULER in the settings instead.
+
+import sys
+import os
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "lupus.settings")
+
+import django
+django.setup()
+
+from game.scheduler import TurnScheduler, POLL_INTERVAL
+
+def main():
+    poll_interval = float(sys.argv[1]) if len(sys.argv) > 1 else POLL_INTERVAL
+    scheduler = TurnScheduler(poll_interval)
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()